@@ -3,6 +3,7 @@ import pandas as pd
 import re
 import sys
 
+import utils.instrument_utils as instrument_utils
 import utils.loaddata_utils as ld_utils
 
 batch_name = "SN0313537"
@@ -23,49 +24,49 @@ output_csv_dir = pathlib.Path(f"/projects/wli19@xsede.org/alsf_preprocess/{batch
 output_csv_dir.mkdir(parents=True, exist_ok=True)
 print(f"Output CSV directory: {output_csv_dir}")
 
-images_folders = list(index_directory.rglob('Images'))
+# Number of plates processed concurrently (1 runs the plates one after another)
+N_WORKERS = 8
 
-# Loop through each folder and create a LoadData CSV
-for folder in images_folders:
-    # Get the first folder directly under the index_directory
-    relative_path = folder.relative_to(index_directory)
-    first_folder = relative_path.parts[0]  # First-level folder
-    
-    # Generate the plate name and find matching config file based on folder structure
-    if first_folder.startswith('BR00'):
-        plate_name = first_folder.split('_')[0]  # Take the first part
-        config_path = config_dir_path / "config.yml"  # Use default config for BR00
+# "native" parses the index files in-process, "pe2loaddata" runs the pe2loaddata command line tool
+LOADDATA_ENGINE = "native"
 
-    elif first_folder.startswith('2024'):
-        second_folder = relative_path.parts[1]  # Second-level folder
-        part1 = '_'.join(first_folder.split('_')[-2:])  # Last two parts of first folder ("CellLine_Re-imaged")
-        part2 = second_folder.split('_')[0]  # First part of second folder (BR00 ID)
+# "csv" or "parquet" (Parquet requires the native engine)
+OUTPUT_FORMAT = "csv"
 
-        # Combine to make plate name for saving CSV
-        plate_name = f"{part1}_{part2}" 
+# Per-plate status and timings are written next to (not inside) the LoadData CSV directory
+report_path = output_csv_dir.parent / "loaddata_generation_report.csv"
 
-        # Find the matching config file by matching part1 with the config file's prefix
-        matching_configs = list(config_dir_path.glob(f"{part1.split('_')[0]}_*.yml"))
-        
-        # Debugging print to check if matching config files are found
-        print(f"Matching configs found: {matching_configs}")
+# Wall time, peak memory and rows/bytes written per plate
+run_report_path = output_csv_dir.parent / "run_reports" / "generate_run_report.json"
 
-        if matching_configs:
-            config_path = matching_configs[0]  # Take the first match
-        else:
-            print(f"No matching config file for: {part1}")
-            continue  # Skip if no matching config file
+# Fingerprints of each plate's index file, config and pe2loaddata version, used to skip unchanged plates
+manifest_path = output_csv_dir.parent / "loaddata_manifest.json"
 
-    else:
-        print(f"Unexpected folder pattern: {folder}")
-        continue  # Skip if not matching patterns
+# Plate name, barcode, re-imaged flag, Images folder and config of every plate, reused while the batch folder is unchanged
+registry_path = output_csv_dir.parent / "plate_registry.json"
 
-    # Create LoadData output path per plate
-    path_to_output_csv = (output_csv_dir / f"{plate_name}_loaddata_original.csv").absolute()
-
-    # Call the function to create the LoadData CSV
-    ld_utils.create_loaddata_csv(
-        index_directory=folder,
-        config_path=config_path,  # Use the matched config file
-        path_to_output=path_to_output_csv,
+# Worker processes re-import this script when not forked, so only the main process finds and runs the jobs
+if __name__ == "__main__":
+    # Collect a LoadData job (plate name, Images folder, matching config and output path) per plate
+    jobs = ld_utils.find_loaddata_jobs(
+        index_directory, config_dir_path, output_csv_dir, file_format=OUTPUT_FORMAT, registry_path=registry_path
     )
+
+    with instrument_utils.record_step("generate", step="total") as record:
+        report_df = ld_utils.create_loaddata_csvs(
+            jobs, n_workers=N_WORKERS, manifest_path=manifest_path, engine=LOADDATA_ENGINE
+        )
+        record.update(rows_out=report_df["rows_out"].sum(), bytes_out=report_df["bytes_out"].sum())
+    report_df.to_csv(report_path, index=False)
+    print(f"Per-plate report saved to {report_path}")
+    instrument_utils.write_run_report(run_report_path, batch=batch_name)
+    print(f"Run report saved to {run_report_path}")
+    print(f"{(report_df['status'] == 'skipped').sum()} unchanged plates were skipped.")
+
+    failed_df = report_df[report_df["status"] == "failed"]
+    if not failed_df.empty:
+        print(f"{len(failed_df)} of {len(report_df)} plates failed:")
+        for _, row in failed_df.iterrows():
+            print(f"Failed: {row['plate_name']}: {row['error']}")
+        sys.exit(1)
+    print(f"All {len(report_df)} plates were successfully processed.")
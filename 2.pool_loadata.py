@@ -1,8 +1,11 @@
 import pathlib
-import pandas as pd
-import re
 import sys
 
+import utils.instrument_utils as instrument_utils
+import utils.io_utils as io_utils
+import utils.plate_utils as plate_utils
+import utils.pool_utils as pool_utils
+
 
 batch_name = "SN0313537"
 index_directory = pathlib.Path(f"/pl/active/koala/ALSF_pilot_data/{batch_name}/")
@@ -22,88 +25,59 @@ output_csv_dir = pathlib.Path(f"/projects/wli19@xsede.org/alsf_preprocess/{batch
 if not output_csv_dir.exists():
     print(f"Output CSV directory {output_csv_dir} does not exist.")
     sys.exit(1)
-output_csv_files = list(output_csv_dir.glob("*.csv"))
+# Per-plate LoadData tables may have been written as csv or Parquet
+output_csv_files = io_utils.list_tables(output_csv_dir)
 if not output_csv_files:
-    print(f"No CSV files found in output directory {output_csv_dir}.")
+    print(f"No CSV or Parquet files found in output directory {output_csv_dir}.")
     sys.exit(1)
 else:
-    print(f"Found {len(output_csv_files)} CSV files in output directory {output_csv_dir}.")
+    print(f"Found {len(output_csv_files)} LoadData files in output directory {output_csv_dir}.")
+
+# "csv" or "parquet" for the pooled LoadData tables
+OUTPUT_FORMAT = "csv"
+
+# Pool only the BR00 IDs whose per-plate tables were added, removed or modified since the last run
+DELTA = False
 
 pooled_csv_dir = pathlib.Path(f"/projects/wli19@xsede.org/alsf_preprocess/{batch_name}/pooled_loaddata_csvs")
 pooled_csv_dir.mkdir(parents=True, exist_ok=True)
 
-# Identify unique BR00 IDs from the filenames
-br00_pattern = re.compile(r"(BR00\d+)")
-br00_ids = {br00_pattern.search(csv_file.stem).group(1) 
-            for csv_file in output_csv_files 
-            if br00_pattern.search(csv_file.stem)}
-br00_ids = sorted(br00_ids, key=lambda x: int(x[4:]))
-print(f"Found {len(br00_ids)} BR00 IDs: {br00_ids}")
-
-br00_dataframes = {br_id: [] for br_id in br00_ids}
-used_files = set()  # Store filenames used in the process
-concat_files = []  # Track new concatenated CSV files
+# Group the per-plate tables by the BR00 ID of their plate in the plate registry written by 1.generate_loaddata.py,
+# which also flags the tables of re-imaged plates
+plate_registry_df = plate_utils.load_plate_registry(
+    output_csv_dir.parent / "plate_registry.json", index_directory, config_dir_path
+)
+br00_groups, reimaged_tables, _ = plate_utils.group_loaddata_tables(plate_registry_df, output_csv_dir)
+print(f"Found {len(br00_groups)} BR00 IDs: {list(br00_groups)}")
 
 # Load one BR00 starting CSV that will have the correct column order
-column_order = pd.read_csv(pathlib.Path(f"{output_csv_dir}/{list(br00_ids)[0]}_loaddata_original.csv"), nrows=0).columns.tolist()
-
-# Step 4: Add 'Metadata_Reimaged' column and group by BR00 ID
-for csv_file in output_csv_files:
-    filename = csv_file.stem
-    match = br00_pattern.search(filename)
-
-    if match:
-        br_id = match.group(1)
-
-        # Read the CSV file into a DataFrame
-        loaddata_df = pd.read_csv(csv_file)
-
-        # Reorder DataFrame columns to match the correct column order
-        loaddata_df = loaddata_df[column_order]  # Ensure the columns are in the correct order
-
-        # Add 'Metadata_Reimaged' column based on filename
-        loaddata_df['Metadata_Reimaged'] = 'Re-imaged' in filename
-
-        # Append the DataFrame to the corresponding BR00 group
-        br00_dataframes[br_id].append(loaddata_df)
-
-        # Track this file as used
-        used_files.add(csv_file.name)
-
-example_id = next(iter(br00_dataframes))  # Get the first BR00 ID
-example_df = pd.concat(br00_dataframes[example_id], ignore_index=True)
-print(f"\nExample DataFrame for BR00 ID: {example_id}")
-example_df.iloc[:, [0, 1, -1]] # Display only the first two and last column
-
-# Concatenate DataFrames, drop duplicates, and save per BR00 ID
-for br_id, dfs in br00_dataframes.items():
-    if dfs:  # Only process if there are matching files
-        concatenated_df = pd.concat(dfs, ignore_index=True)
-
-        # Drop duplicates, prioritizing rows with 'Metadata_Reimaged' == True
-        deduplicated_df = concatenated_df.sort_values(
-            'Metadata_Reimaged', ascending=False
-        ).drop_duplicates(subset=['Metadata_Well', 'Metadata_Site'], keep='first')
-
-        # Sort by 'Metadata_Col', 'Metadata_Row', and 'Metadata_Site
-        sorted_df = deduplicated_df.sort_values(
-            ['Metadata_Col', 'Metadata_Row', "Metadata_Site"], ascending=True
-        )
-
-        # Save the cleaned, concatenated, and sorted DataFrame to a new CSV file
-        output_path = pooled_csv_dir / f"{br_id}_concatenated.csv"
-        sorted_df.to_csv(output_path, index=False)
-
-        print(f"Saved: {output_path}")
-        concat_files.append(output_path)  # Track new concatenated files
-    else:
-        print(f"No files found for {br_id}")
-
-unused_files = set(csv_file.name for csv_file in output_csv_files) - used_files
+column_order = io_utils.read_columns(output_csv_dir / f"{list(br00_groups)[0]}_loaddata_original")
+
+# Pool the original and re-imaged CSVs of each BR00 ID, keeping the re-imaged sites, and save per BR00 ID
+with instrument_utils.record_step("pool", step="total") as record:
+    concat_files, unused_files = pool_utils.pool_loaddata_csvs(
+        output_csv_files,
+        pooled_csv_dir,
+        column_order=column_order,
+        file_format=OUTPUT_FORMAT,
+        groups=br00_groups,
+        reimaged=reimaged_tables,
+        delta=DELTA,
+    )
+    record.update(
+        bytes_in=instrument_utils.file_bytes(output_csv_files),
+        bytes_out=instrument_utils.file_bytes(concat_files),
+    )
+
+# Wall time, peak memory and rows/bytes read and written per BR00 ID
+run_report_path = instrument_utils.write_run_report(
+    pooled_csv_dir.parent / "run_reports" / "pool_run_report.json", batch=batch_name
+)
+print(f"Run report saved to {run_report_path}")
 
 if unused_files:
     print("Warning: Some files were not used in the concatenation!")
     for file in unused_files:
-        print(f"Unused: {file}")
+        print(f"Unused: {file.name}")
 else:
     print("All files were successfully used.")
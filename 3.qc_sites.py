@@ -1,8 +1,8 @@
 import pathlib
 import sys
 
-import pandas as pd
-from scipy.stats import zscore
+import utils.instrument_utils as instrument_utils
+import utils.qc_utils as qc_utils
 
 
 QC_DIR = pathlib.Path("./whole_img_qc_output")
@@ -14,94 +14,45 @@ if not QC_DIR.exists() and not QC_DIR.is_dir():
 QC_OUTPUT_DIR = pathlib.Path("./qc_output")
 QC_OUTPUT_DIR.mkdir(exist_ok=True)
 
-target_channel_keys = ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"]
-
-# Create an empty dictionary to store data frames for each plate
-all_qc_data_frames = {}
-
-# List all plate directories
-plates = [plate.name for plate in QC_DIR.iterdir() if plate.is_dir()]
-
-# Loop through each plate
-for plate in plates:
-    # Read in CSV with all image quality metrics per image for the current plate
-    qc_df = pd.read_csv(QC_DIR / plate / "Image.csv")
-
-    # Store the data frame for the current plate in the dictionary
-    all_qc_data_frames[plate] = qc_df
-
-# Print the plate names to ensure they were loaded correctly
-print(all_qc_data_frames.keys())
-
-# Select the first plate in the list
-first_plate = plates[0]
-print(f"Showing example for the first plate: {first_plate}")
-
-# Access the dataframe for the first plate
-example_df = all_qc_data_frames[first_plate]
-
-# Show the shape and the first few rows of the dataframe for the first plate
-print(example_df.shape)
+# "csv" or "parquet" for the QC exclusion table
+OUTPUT_FORMAT = "csv"
 
-# Create an empty dictionary to store data frames for each channel
-all_combined_dfs = {}
+QC_CONFIG_PATH = pathlib.Path("./qc_config.yml")
 
-# Iterate through each channel
-for channel in target_channel_keys: # excluding input Brightfield since the metrics are not robust to this type of channel
-    # Create an empty list to store data frames for each plate
-    plate_dfs = []
-
-    # Iterate through each plate and create the specified data frame for the channel
-    for plate, qc_df in all_qc_data_frames.items():
-        plate_df = qc_df.filter(like="Metadata_").copy()
-
-        # Add PowerLogLogSlope column (blur metric)
-        plate_df["ImageQuality_PowerLogLogSlope"] = qc_df[
-            f"ImageQuality_PowerLogLogSlope_{channel}"
-        ]
-
-        # Add PercentMaximal column (saturation metric)
-        plate_df["ImageQuality_PercentMaximal"] = qc_df[
-            f"ImageQuality_PercentMaximal_{channel}"
-        ]
-
-        # Add "Channel" column
-        plate_df["Channel"] = channel
-
-        # Add "Metadata_Plate" column
-        plate_df["Metadata_Plate"] = plate
-
-        # Append the data frame to the list
-        plate_dfs.append(plate_df)
-
-    # Concatenate data frames for each plate for the current channel
-    all_combined_dfs[channel] = pd.concat(
-        plate_dfs, keys=list(all_qc_data_frames.keys()), names=["Metadata_Plate", None]
-    )
-
-# Concatenate the channel data frames together for plotting
-df = pd.concat(list(all_combined_dfs.values()), ignore_index=True)
+target_channel_keys = ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"]
 
-print(df.shape)
-print(df.head())
+# Wall time, peak memory and rows/bytes read and written per plate and step
+RUN_REPORT_PATH = QC_OUTPUT_DIR / "qc_run_report.json"
 
-# Calculate Z-scores for the column with all plates
-metric_z_thresh_dict = {
-    "ImageQuality_PowerLogLogSlope": 2.5,
-    "ImageQuality_PercentMaximal": 2,
-}
+# Number of plates whose Image.csv is read at the same time
+N_WORKERS = 8
 
-total_plate_well_site = df[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].drop_duplicates()
-removed_plate_well_site = pd.DataFrame()
+# Keep the cached metrics of unchanged plates and only read the Image.csv of plates added or modified since.
+# The statistics are still computed over the whole batch, so the exclusions of unchanged plates may change.
+DELTA = False
 
-for metric, z_thresh in metric_z_thresh_dict.items():
-    z_scores = zscore(df[metric])
-    outliers = df[abs(z_scores) > z_thresh]
-    removed_plate_well_site = pd.concat(
-        [removed_plate_well_site, outliers[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].drop_duplicates()]
-    )
+# Stream the plates one at a time in two passes (statistics, then scoring) for batches that don't fit in memory
+STREAMING = False
 
-print(f"Out of a total of {total_plate_well_site.shape[0]} plate, well and site combos, {removed_plate_well_site.shape[0]} ({removed_plate_well_site.shape[0] * 100 / total_plate_well_site.shape[0]:.2f}%) removed due to low quality.")
+# List all plate directories
+plates = [plate.name for plate in QC_DIR.iterdir() if plate.is_dir()]
 
-removed_plate_well_site.to_csv(QC_OUTPUT_DIR / 'qc_exclusion.csv', index=False)
-print("QC exclusion CSV saved.")
+# Thresholds, scope and estimator used to score the sites
+qc_config = qc_utils.load_qc_config(QC_CONFIG_PATH)
+
+# Score the sites and save the statistics, site scores and exclusion table, the in-memory long QC table is
+# cached in QC_OUTPUT_DIR and reused while no Image.csv changed
+qc_utils.run_qc(
+    QC_DIR,
+    plates,
+    target_channel_keys,
+    qc_config,
+    QC_OUTPUT_DIR,
+    file_format=OUTPUT_FORMAT,
+    n_workers=N_WORKERS,
+    delta=DELTA,
+    streaming=STREAMING,
+)
+print("QC exclusion table saved.")
+instrument_utils.write_run_report(RUN_REPORT_PATH)
+print(f"Run report saved to {RUN_REPORT_PATH}")
@@ -0,0 +1,84 @@
+import pathlib
+import shutil
+import time
+
+import pandas as pd
+
+import utils.instrument_utils as instrument_utils
+import utils.pipeline_utils as pipeline_utils
+import utils.synthetic_utils as synthetic_utils
+
+
+BENCHMARK_DIR = pathlib.Path("./benchmark_output")
+BENCHMARK_DIR.mkdir(exist_ok=True)
+
+BATCH_NAME = "SYNTHETIC"
+
+# Multiples of the pilot batch (6 barcodes) to benchmark
+SCALES = [1, 10, 100]
+BASE_N_PLATES = 6
+
+# Size of every synthetic plate
+N_WELLS = 24
+N_SITES = 4
+REIMAGED_FRACTION = 0.25
+
+# Number of plates (generate, qc) or barcodes (pool) processed at the same time
+N_WORKERS = 8
+
+# Remove each synthetic batch once benchmarked, the 100x batch holds hundreds of thousands of image files
+CLEAN_UP = True
+
+STAGES = ["generate", "pool", "validate", "qc", "split"]
+
+
+# Worker processes re-import this script when not forked, so only the main process runs the benchmark
+if __name__ == "__main__":
+    results = []
+    for scale in SCALES:
+        n_plates = BASE_N_PLATES * scale
+        scale_dir = BENCHMARK_DIR / f"scale_{scale}x"
+        if scale_dir.exists():
+            shutil.rmtree(scale_dir)
+
+        start = time.perf_counter()
+        config_path = synthetic_utils.synthesize_batch(
+            scale_dir,
+            batch=BATCH_NAME,
+            n_plates=n_plates,
+            n_wells=N_WELLS,
+            n_sites=N_SITES,
+            reimaged_fraction=REIMAGED_FRACTION,
+        )
+        print(f"Synthesized {n_plates} plates in {time.perf_counter() - start:.1f}s")
+
+        config = pipeline_utils.load_pipeline_config(config_path, BATCH_NAME)
+        config["n_workers"] = N_WORKERS
+
+        # Every stage runs from scratch, the records of the previous scale are dropped
+        instrument_utils.RUN_RECORDS.clear()
+        report_df = pipeline_utils.run_pipeline(config, STAGES, force=True)
+        if (report_df["status"] != "success").any():
+            print(report_df)
+            raise RuntimeError(f"The pipeline failed at {scale}x")
+
+        steps_df = instrument_utils.run_report()
+        steps_df.insert(0, "n_plates", n_plates)
+        steps_df.insert(0, "scale", scale)
+        instrument_utils.write_run_report(BENCHMARK_DIR / f"run_report_{scale}x.json", batch=BATCH_NAME)
+        results.append(steps_df)
+
+        if CLEAN_UP:
+            shutil.rmtree(scale_dir)
+
+    results_df = pd.concat(results, ignore_index=True)
+    results_df.to_csv(BENCHMARK_DIR / "benchmark_results.csv", index=False)
+
+    # Wall time of each stage and the time per plate, to spot stages that scale worse than linearly
+    stage_df = results_df[results_df["step"] == "stage"].pivot(index="stage", columns="scale", values="wall_s")
+    stage_df = stage_df.reindex(STAGES)
+    print("Wall time (s) per stage and scale:")
+    print(stage_df.round(2))
+    print("Wall time (ms) per plate:")
+    print((stage_df / (stage_df.columns.to_numpy() * BASE_N_PLATES) * 1000).round(1))
+    print(f"Benchmark results saved to {BENCHMARK_DIR / 'benchmark_results.csv'}")
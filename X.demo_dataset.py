@@ -1,13 +1,21 @@
 import pathlib
 import sys
 
-import pandas as pd
 import matplotlib.pyplot as plt
+import pandas as pd
+import torch
 
-from virtual_stain_flow.transforms.normalizations import MaxScaleNormalize
 from virtual_stain_flow.datasets.cp_loaddata_dataset import CPLoadDataImageDataset
 from virtual_stain_flow.datasets.crop_cell_dataset import CropCellImageDataset
 
+import utils.crop_index_utils as crop_index_utils
+import utils.datasplit_utils as datasplit_utils
+import utils.intensity_utils as intensity_utils
+import utils.io_utils as io_utils
+import utils.metadata_utils as metadata_utils
+import utils.site_key_utils as site_key_utils
+import utils.tensor_store_utils as tensor_store_utils
+
 
 BATCH_NAME = "SN0313537"
 
@@ -18,10 +26,22 @@ if not DATASPLIT_OUTPUT_DIR.exists() and not DATASPLIT_OUTPUT_DIR.is_dir():
     print(f"Data split output directory {DATASPLIT_OUTPUT_DIR} does not exist.")
     sys.exit(1)
 
-LOADDATA_FILE_PATH = DATASPLIT_OUTPUT_DIR / "loaddata_train.csv"
-if not LOADDATA_FILE_PATH.exists() and not LOADDATA_FILE_PATH.is_file():
-    print(f"LoadData file {LOADDATA_FILE_PATH} does not exist.")
-    sys.exit(1)    
+# The split manifest may have been written as csv or Parquet
+try:
+    SPLIT_MANIFEST_PATH = io_utils.find_table(DATASPLIT_OUTPUT_DIR / "split_manifest")
+except FileNotFoundError:
+    print(f"Split manifest {DATASPLIT_OUTPUT_DIR / 'split_manifest.csv'} does not exist.")
+    sys.exit(1)
+
+LOADDATA_CSV_DIR = pathlib.Path(f"../alsf_preprocess/{BATCH_NAME}/pooled_loaddata_csvs")
+PLATEMAP_CSV_DIR = pathlib.Path("./metadata/platemaps")
+PLATEMAP_CACHE_PATH = DATASPLIT_OUTPUT_DIR.parent / "platemap_metadata.parquet"
+
+# Cell centers of the train split with whether a 256-pixel patch fits, written by the crop stage of the pipeline
+CROP_INDEX_PATH = DATASPLIT_OUTPUT_DIR / "crop_index"
+
+# Memory-mapped (site, channel, y, x) store of the train split, written by the pack stage of the pipeline
+TENSOR_STORE_DIR = DATASPLIT_OUTPUT_DIR.parent / "tensor_store"
 
 SC_FEATURES_DIR = pathlib.Path(
     f"/pl/active/koala/ALSF_pilot_data/preprocessed_profiles_{BATCH_NAME}/single_cell_profiles"
@@ -39,32 +59,88 @@ TARGET_CHANNEL_NAMES = ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"]
 
 CONFLUENCE = 1000
 
+# Per-(plate, channel) intensity statistics written by the intensity stage of the pipeline
+INTENSITY_STATISTICS_PATH = DATASPLIT_OUTPUT_DIR / "intensity_statistics"
+# Intensity percentile mapped to 1 by the normalization, the full 16-bit range without the statistics
+NORMALIZATION_PERCENTILE = 99.9
+
 
-loaddata_df = pd.read_csv(LOADDATA_FILE_PATH)
+# Materialize the train sites of the default split from the pooled LoadData
+loaddata_df = datasplit_utils.read_split(
+    SPLIT_MANIFEST_PATH,
+    LOADDATA_CSV_DIR,
+    label=datasplit_utils.TRAIN_LABEL,
+    metadata_df=metadata_utils.load_platemap_metadata(PLATEMAP_CSV_DIR, cache_path=PLATEMAP_CACHE_PATH),
+)
 print(f"Initial loaddata_df shape: {loaddata_df.shape}")
 loaddata_df = loaddata_df.loc[loaddata_df['seeding_density'] == CONFLUENCE]
 print(f"Filtered loaddata_df shape: {loaddata_df.shape}")
 
-sc_feature_files = list(
-        SC_FEATURES_DIR.glob('*_sc_normalized.parquet')
+# Cells of the train split whose 256-pixel patch fits in the field of view, from the crop index of the
+# pipeline when it was built, so the datasets below get the cell centers without scanning the feature tables
+try:
+    sc_features = crop_index_utils.load_crop_index(CROP_INDEX_PATH, valid_only=True)
+except FileNotFoundError:
+    sc_features = crop_index_utils.read_cell_locations(
+        SC_FEATURES_DIR, site_key_utils.site_keys(loaddata_df).to_numpy()
     )
-
-sc_features = pd.DataFrame()
-for plate in loaddata_df['Metadata_Plate'].unique():
-    sc_features_parquet = SC_FEATURES_DIR / f'{plate}_sc_normalized.parquet'
-    if not sc_features_parquet.exists():
-        print(f'{sc_features_parquet} does not exist, skipping...')
-        continue 
-    else:
-        sc_features = pd.concat([
-            sc_features, 
-            pd.read_parquet(
-                sc_features_parquet,
-                columns=['Metadata_Plate', 'Metadata_Well', 'Metadata_Site', 'Metadata_Cells_Location_Center_X', 'Metadata_Cells_Location_Center_Y']
-            )
-        ])
+    sc_features = pd.concat(
+        [site_key_utils.decode_site_keys(sc_features[site_key_utils.SITE_KEY_COLUMN]), sc_features],
+        axis=1,
+    )
+    sc_features = sc_features[crop_index_utils.valid_patches(sc_features, patch_size=256, fov=(1080, 1080))]
+sc_features = sc_features.loc[
+    sc_features[site_key_utils.SITE_KEY_COLUMN].isin(site_key_utils.site_keys(loaddata_df)),
+    [
+        site_key_utils.PLATE_COLUMN,
+        site_key_utils.WELL_COLUMN,
+        site_key_utils.SITE_COLUMN,
+        crop_index_utils.CENTER_X_COLUMN,
+        crop_index_utils.CENTER_Y_COLUMN,
+    ],
+].reset_index(drop=True)
 print(f"Single-cell features shape: {sc_features.shape}")
 
+# One factor per channel, so brightfield and the dim channels are not scaled by the brightest channel
+try:
+    normalization_factors = intensity_utils.normalization_factors(
+        INTENSITY_STATISTICS_PATH,
+        INPUT_CHANNEL_NAMES + TARGET_CHANNEL_NAMES,
+        plates=loaddata_df['Metadata_Plate'].unique().tolist(),
+        percentile=NORMALIZATION_PERCENTILE,
+    )
+except FileNotFoundError:
+    normalization_factors = {channel: 2**16 - 1 for channel in INPUT_CHANNEL_NAMES + TARGET_CHANNEL_NAMES}
+print(f"Normalization factors: {normalization_factors}")
+
+
+class ChannelNormalizedDataset(torch.utils.data.Dataset):
+    """
+    View of an image dataset dividing every input and target channel by its own normalization factor.
+    MaxScaleNormalize of virtual_stain_flow only takes one scalar factor, and the dataset applies the same
+    transform to the input and the target stack, so the per-channel factors are applied here instead.
+    """
+
+    def __init__(self, dataset, factors: dict):
+        self.dataset = dataset
+        self.input_factors = self._factors(factors, dataset.input_channel_keys)
+        self.target_factors = self._factors(factors, dataset.target_channel_keys)
+
+    @staticmethod
+    def _factors(factors: dict, channels: list[str]) -> torch.Tensor:
+        # Shaped (channel, 1, 1) to broadcast over the (channel, y, x) stacks
+        return torch.tensor([factors[c] for c in channels], dtype=torch.float32).reshape(-1, 1, 1)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        input_image, target_image = self.dataset[i]
+        return (
+            torch.as_tensor(input_image, dtype=torch.float32) / self.input_factors,
+            torch.as_tensor(target_image, dtype=torch.float32) / self.target_factors,
+        )
+
 
 def plot_dataset(ids, i, save_path):
     i, t = ids[i]
@@ -85,17 +161,13 @@ def plot_dataset(ids, i, save_path):
 print("Creating CPLoadDataImageDataset...")
 cp_ids = CPLoadDataImageDataset(
     loaddata=loaddata_df,
-    sc_feature=sc_feature_files,
+    sc_feature=sc_features,
     pil_image_mode='I;16',
 )
 cp_ids.input_channel_keys = ['OrigBrightfield']
 cp_ids.target_channel_keys = ['OrigDNA']
-cp_ids.transform = MaxScaleNormalize(
-    p=1, 
-    normalization_factor=2**16-1
-)
 print(f"Number of images in dataset: {len(cp_ids)}")
-plot_dataset(cp_ids, 0, f'demo_whole_{CONFLUENCE}.png')
+plot_dataset(ChannelNormalizedDataset(cp_ids, normalization_factors), 0, f'demo_whole_{CONFLUENCE}.png')
 
 
 print("Creating CropCellImageDataset...")
@@ -108,9 +180,13 @@ crop_ds = CropCellImageDataset.from_dataset(
 )
 crop_ds.input_channel_keys = INPUT_CHANNEL_NAMES
 crop_ds.target_channel_keys = TARGET_CHANNEL_NAMES
-crop_ds.transform = MaxScaleNormalize(
-    p=1, 
-    normalization_factor=2**16 - 1,
-)
 print(f"Number of cropped cells in dataset: {len(crop_ds)}")
-plot_dataset(crop_ds, 0, f'demo_cropped_{CONFLUENCE}.png')
+plot_dataset(ChannelNormalizedDataset(crop_ds, normalization_factors), 0, f'demo_cropped_{CONFLUENCE}.png')
+
+
+# The packed store serves the same sites as zero-copy slices, without decoding any TIFF
+if (TENSOR_STORE_DIR / tensor_store_utils.STORE_METADATA_NAME).exists():
+    store_index_df, store_shards, store_metadata = tensor_store_utils.open_tensor_store(TENSOR_STORE_DIR)
+    print(f"Tensor store: {store_index_df.shape[0]} sites of {store_metadata['channels']}")
+    site = tensor_store_utils.read_site(store_index_df, store_shards, 0)
+    print(f"First site of the tensor store: {site.shape} {site.dtype}")
@@ -0,0 +1,29 @@
+import pytest
+
+import utils.pipeline_utils as pipeline_utils
+import utils.synthetic_utils as synthetic_utils
+
+
+BATCH_NAME = "SYNTHETIC"
+
+
+@pytest.fixture(scope="session")
+def synthetic_batch(tmp_path_factory):
+    """Synthetic batch with its LoadData tables generated and pooled, shared by the pipeline tests"""
+    root = tmp_path_factory.mktemp("synthetic")
+    config_path = synthetic_utils.synthesize_batch(root, batch=BATCH_NAME, n_plates=4, n_wells=12, n_sites=4)
+    config = pipeline_utils.load_pipeline_config(config_path, BATCH_NAME)
+    config["n_workers"] = 2
+
+    report_df = pipeline_utils.run_pipeline(config, ["generate", "pool"], force=True)
+    assert (report_df["status"] == "success").all(), report_df
+    return config
+
+
+@pytest.fixture
+def batch_config(synthetic_batch, tmp_path):
+    """Copy of the synthetic batch config whose QC and split outputs go to a fresh folder"""
+    config = dict(synthetic_batch, qc=dict(synthetic_batch["qc"]), split=dict(synthetic_batch["split"]))
+    config["qc_output_dir"] = tmp_path / "qc_output"
+    config["split_dir"] = tmp_path / "data_split_loaddata"
+    return config
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+import utils.crop_index_utils as crop_index_utils
+import utils.io_utils as io_utils
+import utils.site_key_utils as site_key_utils
+
+
+def write_sc_features(sc_dir, plate: str) -> pd.DataFrame:
+    sc_dir.mkdir(parents=True, exist_ok=True)
+    sc_df = pd.DataFrame({
+        "Metadata_Plate": plate,
+        "Metadata_Well": ["C03", "C03", "C03", "D03", "E03"],
+        "Metadata_Site": ["1", "1", "2", "1", "1"],
+        crop_index_utils.CENTER_X_COLUMN: [50.0, 10.0, 60.0, 70.0, 80.0],
+        crop_index_utils.CENTER_Y_COLUMN: [50.0, 50.0, 95.0, 30.0, 40.0],
+        "Cells_AreaShape_Area": 1.0,
+    })
+    sc_df.to_parquet(sc_dir / crop_index_utils.SC_FEATURES_NAME.format(plate=plate), index=False)
+    return sc_df
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_crop_index_keeps_the_cells_of_the_split(tmp_path, file_format):
+    write_sc_features(tmp_path / "sc", "BR00143976")
+    split_sites = pd.DataFrame({
+        "Metadata_Plate": ["BR00143976", "BR00143976", "BR00143976", "BR00143977"],
+        "Metadata_Well": ["C03", "C03", "E03", "C03"],
+        "Metadata_Site": [1, 2, 1, 1],
+    })
+    manifest_df = pd.DataFrame({
+        site_key_utils.SITE_KEY_COLUMN: site_key_utils.site_keys(split_sites).to_numpy(),
+        "split_seed42": ["train", "train", "heldout", "train"],
+    })
+    manifest_path = io_utils.write_table(manifest_df, tmp_path / "split_manifest")
+
+    crop_index_df = crop_index_utils.build_crop_index(
+        manifest_path,
+        tmp_path / "sc",
+        tmp_path / "crop_index",
+        patch_size=32,
+        fov=(100, 100),
+        n_workers=2,
+        file_format=file_format,
+    )
+
+    # D03 is not in the split, E03 is heldout and BR00143977 has no single-cell table
+    assert list(crop_index_df.columns) == crop_index_utils.CROP_INDEX_COLUMNS
+    assert crop_index_df[crop_index_utils.CENTER_X_COLUMN].tolist() == [50.0, 10.0, 60.0]
+    # The second cell is too close to the left edge and the third to the bottom one
+    assert crop_index_df["valid_patch"].tolist() == [True, False, False]
+
+    loaded_df = crop_index_utils.load_crop_index(tmp_path / "crop_index")
+    assert len(loaded_df) == 1
+    assert loaded_df.loc[0, ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].tolist() == ["BR00143976", "C03", 1]
+    assert len(crop_index_utils.load_crop_index(tmp_path / "crop_index", valid_only=False)) == 3
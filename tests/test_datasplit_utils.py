@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+
+import utils.datasplit_utils as datasplit_utils
+import utils.site_key_utils as site_key_utils
+
+
+@pytest.fixture
+def sites_df():
+    """Three sites in each of six wells of two cell lines"""
+    wells = [f"C{col:02d}" for col in range(3, 9)]
+    return pd.DataFrame(
+        [(cell_line, well, site) for cell_line in ["U2-OS", "A-673"] for well in wells for site in range(1, 4)],
+        columns=["cell_line", "Metadata_Well", "Metadata_Site"],
+    )
+
+
+def heldout_wells(sites_df: pd.DataFrame, labels: pd.Series) -> pd.Series:
+    heldout = sites_df[labels == datasplit_utils.HELDOUT_LABEL]
+    return heldout.groupby("cell_line")["Metadata_Well"].nunique()
+
+
+def test_split_is_deterministic(sites_df):
+    labels = datasplit_utils.assign_splits(sites_df, ["cell_line"], seeds=[1, 2], n_heldout_wells=2)
+    assert list(labels.columns) == ["split_seed1", "split_seed2"]
+    pd.testing.assert_frame_equal(
+        labels, datasplit_utils.assign_splits(sites_df, ["cell_line"], seeds=[1, 2], n_heldout_wells=2)
+    )
+
+    # The draws don't depend on the row order
+    shuffled_df = sites_df.sample(frac=1, random_state=0)
+    shuffled_labels = datasplit_utils.assign_splits(shuffled_df, ["cell_line"], seeds=[1, 2], n_heldout_wells=2)
+    pd.testing.assert_frame_equal(shuffled_labels.loc[labels.index], labels)
+
+
+@pytest.mark.parametrize("n_heldout_wells", [1, 2, 3])
+def test_heldout_counts(sites_df, n_heldout_wells):
+    labels = datasplit_utils.assign_splits(sites_df, ["cell_line"], seeds=[42], n_heldout_wells=n_heldout_wells)
+    n_wells = heldout_wells(sites_df, labels["split_seed42"])
+
+    assert (n_wells == n_heldout_wells).all()
+    assert set(n_wells.index) == {"U2-OS", "A-673"}
+    # Whole wells are held out, never single sites
+    assert (labels.groupby([sites_df["cell_line"], sites_df["Metadata_Well"]])["split_seed42"].nunique() == 1).all()
+
+
+def test_folds_hold_out_every_well_once(sites_df):
+    labels = datasplit_utils.assign_splits(sites_df, ["cell_line"], seeds=[42], n_folds=3)
+    assert list(labels.columns) == [f"split_seed42_fold{k}" for k in range(3)]
+
+    n_folds_heldout = (labels == datasplit_utils.HELDOUT_LABEL).sum(axis=1)
+    assert (n_folds_heldout == 1).all()
+    for column in labels.columns:
+        assert (heldout_wells(sites_df, labels[column]) == 2).all()
+
+
+def test_update_keeps_the_labels_of_unchanged_conditions(sites_df):
+    # One plate per cell line, as both cell lines use the same wells
+    plates = {"U2-OS": "BR00143976", "A-673": "BR00143977"}
+    plate_df = sites_df.assign(Metadata_Plate=sites_df["cell_line"].map(plates))
+    metadata_df = plate_df[["Metadata_Plate", "Metadata_Well", "cell_line"]].drop_duplicates()
+    metadata_df = metadata_df.rename(columns={"Metadata_Plate": "barcode", "Metadata_Well": "well"})
+    labels = datasplit_utils.assign_splits(plate_df, ["cell_line"], seeds=[42])
+
+    # Hold out another A-673 well than the draw would, to tell kept labels from re-drawn ones
+    a673 = plate_df["cell_line"] == "A-673"
+    train_well = plate_df.loc[a673 & (labels["split_seed42"] == "train"), "Metadata_Well"].iloc[0]
+    heldout = plate_df["Metadata_Well"] == train_well
+    labels.loc[a673, "split_seed42"] = datasplit_utils.TRAIN_LABEL
+    labels.loc[a673 & heldout, "split_seed42"] = datasplit_utils.HELDOUT_LABEL
+    previous_manifest_df = pd.concat(
+        [site_key_utils.site_keys(plate_df).rename(site_key_utils.SITE_KEY_COLUMN), labels], axis=1
+    )
+
+    # A new plate adds a U2-OS well
+    new_df = pd.DataFrame({
+        "cell_line": "U2-OS", "Metadata_Well": "C09", "Metadata_Site": [1, 2, 3], "Metadata_Plate": "BR00143978"
+    })
+    current_df = pd.concat([plate_df, new_df], ignore_index=True)
+    metadata_df = pd.concat(
+        [metadata_df, pd.DataFrame({"barcode": ["BR00143978"], "well": ["C09"], "cell_line": ["U2-OS"]})],
+        ignore_index=True,
+    )
+
+    updated, changed_df = datasplit_utils.update_splits(current_df, ["cell_line"], previous_manifest_df, metadata_df)
+
+    assert changed_df["cell_line"].tolist() == ["U2-OS"]
+    kept = (current_df["cell_line"] == "A-673").to_numpy()
+    assert updated["split_seed42"][kept].astype(str).tolist() == labels["split_seed42"][a673].astype(str).tolist()
+    redrawn = datasplit_utils.assign_splits(current_df, ["cell_line"], seeds=[42])
+    assert (redrawn["split_seed42"][kept] != updated["split_seed42"][kept]).any()
+    pd.testing.assert_series_equal(updated["split_seed42"][~kept], redrawn["split_seed42"][~kept])
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import utils.image_utils as image_utils
+
+
+def write_tiff(path, shape=(24, 32)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(np.arange(np.prod(shape), dtype=np.uint16).reshape(shape)).save(path)
+    return path
+
+
+def test_tiff_header_is_read_without_decoding(tmp_path):
+    path = write_tiff(tmp_path / "image.tiff")
+    header = image_utils.read_tiff_header(path)
+
+    assert header["width"] == 32 and header["height"] == 24
+    assert header["bits_per_sample"] == 16
+    assert header["samples_per_pixel"] == 1
+    assert header["data_end"] <= path.stat().st_size
+
+
+def test_image_statuses(tmp_path):
+    ok_path = write_tiff(tmp_path / "ok.tiff")
+    truncated_path = write_tiff(tmp_path / "truncated.tiff")
+    # PIL writes the IFD before the pixels, so dropping the end of the file keeps the header readable
+    truncated_path.write_bytes(truncated_path.read_bytes()[:-100])
+    (tmp_path / "empty.tiff").touch()
+    (tmp_path / "text.tiff").write_text("not an image")
+
+    statuses = {
+        name: image_utils.validate_image(str(tmp_path / name))["status"]
+        for name in ["ok.tiff", "truncated.tiff", "missing.tiff", "empty.tiff", "text.tiff"]
+    }
+    assert statuses == {
+        "ok.tiff": "ok",
+        "truncated.tiff": "truncated",
+        "missing.tiff": "missing",
+        "empty.tiff": "empty",
+        "text.tiff": "not_tiff",
+    }
+    assert image_utils.validate_image(str(ok_path))["width"] == 32
+
+
+def test_index_is_reused_for_unchanged_images(tmp_path, monkeypatch):
+    paths = [str(write_tiff(tmp_path / f"{name}.tiff")) for name in ["a", "b", "c"]]
+    index_path = tmp_path / "image_index.parquet"
+    validated = []
+    validate_image = image_utils.validate_image
+    monkeypatch.setattr(image_utils, "validate_image", lambda path: validated.append(path) or validate_image(path))
+
+    first_df = image_utils.validate_images(paths, index_path=index_path, n_workers=2)
+    assert sorted(validated) == paths
+
+    validated.clear()
+    write_tiff(tmp_path / "b.tiff", shape=(48, 32))
+    second_df = image_utils.validate_images(paths, index_path=index_path, n_workers=2)
+    assert validated == [paths[1]]
+    assert (second_df["status"] == "ok").all()
+    second_df = second_df.set_index("path")
+    assert second_df.loc[paths[1], "height"] == 48
+    assert second_df.loc[paths[0], "mtime_ns"] == first_df.set_index("path").loc[paths[0], "mtime_ns"]
+
+
+def test_images_of_an_unexpected_shape_are_invalid(tmp_path):
+    for well in ["C03", "D03", "E03"]:
+        write_tiff(tmp_path / f"{well}.tiff")
+    write_tiff(tmp_path / "F03.tiff", shape=(12, 32))
+    loaddata_df = pd.DataFrame({
+        "Metadata_Plate": "BR00143976",
+        "Metadata_Well": ["C03", "D03", "E03", "F03", "G03"],
+        "Metadata_Site": 1,
+        "PathName_OrigDNA": str(tmp_path),
+        "FileName_OrigDNA": [f"{well}.tiff" for well in ["C03", "D03", "E03", "F03", "G03"]],
+    })
+
+    image_df = image_utils.image_paths(loaddata_df)
+    invalid_df = image_utils.invalid_images(image_df, image_utils.validate_images(image_df["path"], n_workers=2))
+
+    assert invalid_df["Metadata_Well"].tolist() == ["F03", "G03"]
+    assert invalid_df["status"].tolist() == ["unexpected_shape", "missing"]
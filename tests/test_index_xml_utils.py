@@ -0,0 +1,19 @@
+import numpy as np
+
+import utils.index_xml_utils as index_xml_utils
+import utils.synthetic_utils as synthetic_utils
+
+
+def test_channel_ids_are_sorted_as_numbers(tmp_path, monkeypatch):
+    channels = {channel: (f"Channel {channel}", f"Orig{channel:02d}") for channel in range(1, 12)}
+    monkeypatch.setattr(synthetic_utils, "HARMONY_CHANNELS", channels)
+    images_dir = tmp_path / "Images"
+    synthetic_utils.write_index_file(images_dir, "BR00143976", ["C03"], 2, np.random.default_rng(0))
+    synthetic_utils.write_configs(tmp_path / "config_files", cell_lines=[])
+
+    loaddata_df = index_xml_utils.create_loaddata_df(images_dir, tmp_path / "config_files" / "config.yml")
+
+    file_columns = [c for c in loaddata_df.columns if c.startswith("FileName_")]
+    assert file_columns == [f"FileName_Orig{channel:02d}" for channel in range(1, 12)]
+    assert loaddata_df["FileName_Orig10"].str.endswith("-ch10sk1fk1fl1.tiff").all()
+    assert len(loaddata_df) == 2
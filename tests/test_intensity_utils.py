@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+import utils.intensity_utils as intensity_utils
+
+
+def test_histogram_percentiles_match_numpy():
+    rng = np.random.default_rng(0)
+    values = np.concatenate([rng.integers(100, 3000, 5000), rng.integers(60000, 2**16, 20)]).astype(np.uint16)
+    histogram = np.bincount(values, minlength=intensity_utils.N_BINS)
+
+    stats = intensity_utils.histogram_statistics(histogram)
+
+    assert stats["n_pixels"] == len(values)
+    assert (stats["min"], stats["max"]) == (values.min(), values.max())
+    assert stats["mean"] == pytest.approx(values.mean())
+    assert stats["std"] == pytest.approx(values.std())
+    for q in intensity_utils.DEFAULT_PERCENTILES:
+        assert stats[f"p{q:g}"] == np.percentile(values, q, method="inverted_cdf")
+
+
+def test_statistics_and_factors_are_per_plate_and_channel(tmp_path):
+    rows = []
+    # The ER channel is ten times brighter than the DNA channel, and the second plate twice the first
+    for plate, scale in [("BR00143976", 1), ("BR00143977", 2)]:
+        row = {"Metadata_Plate": plate, "Metadata_Well": "C03", "Metadata_Site": 1}
+        for channel, brightness in [("OrigDNA", 100), ("OrigER", 1000)]:
+            image = np.full((8, 8), brightness * scale, dtype=np.uint16)
+            Image.fromarray(image).save(tmp_path / f"{plate}_{channel}.tiff")
+            row[f"PathName_{channel}"] = str(tmp_path)
+            row[f"FileName_{channel}"] = f"{plate}_{channel}.tiff"
+        rows.append(row)
+    loaddata_df = pd.DataFrame(rows)
+
+    accumulator = intensity_utils.compute_intensity_statistics(loaddata_df, n_workers=2)
+    stats_df = intensity_utils.write_intensity_statistics(accumulator, tmp_path / "intensity_statistics")
+
+    assert stats_df[["Metadata_Plate", "Channel", "p99.9"]].values.tolist() == [
+        ["BR00143976", "OrigDNA", 100],
+        ["BR00143976", "OrigER", 1000],
+        ["BR00143977", "OrigDNA", 200],
+        ["BR00143977", "OrigER", 2000],
+    ]
+    assert intensity_utils.normalization_factors(tmp_path / "intensity_statistics", ["OrigER", "OrigDNA"]) == {
+        "OrigER": 2000.0, "OrigDNA": 200.0
+    }
+    assert intensity_utils.normalization_factors(
+        tmp_path / "intensity_statistics", ["OrigDNA"], plates=["BR00143976"]
+    ) == {"OrigDNA": 100.0}
+    with pytest.raises(ValueError, match="OrigMito"):
+        intensity_utils.normalization_factors(tmp_path / "intensity_statistics", ["OrigMito"])
@@ -0,0 +1,24 @@
+import os
+
+import pandas as pd
+
+import utils.io_utils as io_utils
+
+
+def test_tables_round_trip_in_both_formats(tmp_path):
+    df = pd.DataFrame({"FileName_OrigDNA": ["a.tiff", "b.tiff"], "Metadata_Site": [1, 2]})
+    for file_format in io_utils.TABLE_FORMATS:
+        path = io_utils.write_table(df, tmp_path / "table", file_format=file_format)
+        assert path.suffix == f".{file_format}"
+        pd.testing.assert_frame_equal(io_utils.read_table(path), df, check_dtype=False, check_categorical=False)
+
+
+def test_list_tables_keeps_the_newest_format_of_each_table(tmp_path):
+    df = pd.DataFrame({"Metadata_Site": [1]})
+    old_path = io_utils.write_table(df, tmp_path / "BR00143976_concatenated", file_format="csv")
+    new_path = io_utils.write_table(df, tmp_path / "BR00143976_concatenated", file_format="parquet")
+    other_path = io_utils.write_table(df, tmp_path / "BR00143977_concatenated", file_format="csv")
+    os.utime(old_path, (0, 0))
+
+    assert io_utils.list_tables(tmp_path) == [new_path, other_path]
+    assert io_utils.find_table(tmp_path / "BR00143976_concatenated") == new_path
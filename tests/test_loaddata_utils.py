@@ -0,0 +1,85 @@
+import pathlib
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.io_utils as io_utils
+import utils.loaddata_utils as loaddata_utils
+import utils.synthetic_utils as synthetic_utils
+
+
+# Written by pe2loaddata from the index of `write_channels_index` (3 wells, 2 sites, seed 0),
+# with the image folder replaced by its name relative to the test folder
+EXPECTED_LOADDATA_PATH = pathlib.Path(__file__).parent / "data" / "BR00143976_loaddata_expected.csv"
+
+
+def write_channels_index(root: pathlib.Path, n_wells: int, n_sites: int) -> tuple[pathlib.Path, pathlib.Path]:
+    """Write a synthetic index and a config whose channels are identified by name, which pe2loaddata reads"""
+    images_dir = root / "Images"
+    synthetic_utils.write_index_file(
+        images_dir, "BR00143976", synthetic_utils.well_names(n_wells), n_sites, np.random.default_rng(0)
+    )
+    # Channels identified by name rather than by the channel ids of the Harmony v7 configs
+    config_path = root / "config.yml"
+    lines = ["channels:"] + [f"    {name}: {key}" for name, key in synthetic_utils.HARMONY_CHANNELS.values()]
+    lines += ["metadata:"] + [f"    {key}: {key}" for key in synthetic_utils.CONFIG_METADATA]
+    config_path.write_text("\n".join(lines) + "\n")
+    return images_dir, config_path
+
+
+def test_native_engine_matches_the_expected_table(tmp_path):
+    images_dir, config_path = write_channels_index(tmp_path, n_wells=3, n_sites=2)
+    loaddata_utils.create_loaddata_csv(images_dir, config_path, tmp_path / "native.csv", engine="native")
+
+    native_df = pd.read_csv(tmp_path / "native.csv")
+    path_columns = [c for c in native_df.columns if c.startswith("PathName_")]
+    assert (native_df[path_columns] == str(images_dir)).all().all()
+    native_df[path_columns] = images_dir.name
+    pd.testing.assert_frame_equal(native_df, pd.read_csv(EXPECTED_LOADDATA_PATH))
+
+
+@pytest.mark.skipif(shutil.which("pe2loaddata") is None, reason="pe2loaddata is not installed")
+def test_native_engine_matches_pe2loaddata_on_channels_config(tmp_path):
+    images_dir, config_path = write_channels_index(tmp_path, n_wells=4, n_sites=3)
+
+    for engine in ["native", "pe2loaddata"]:
+        loaddata_utils.create_loaddata_csv(images_dir, config_path, tmp_path / f"{engine}.csv", engine=engine)
+
+    native_df = pd.read_csv(tmp_path / "native.csv")
+    assert len(native_df) == 4 * 3
+    pd.testing.assert_frame_equal(native_df, pd.read_csv(tmp_path / "pe2loaddata.csv"))
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_illum_csv_is_derived_from_the_base_table(tmp_path, file_format):
+    base_df = pd.DataFrame({
+        "FileName_OrigDNA": ["r03c03f01p01-ch5sk1fk1fl1.tiff"],
+        "PathName_OrigDNA": ["/images"],
+        "FileName_OrigER": ["r03c03f01p01-ch2sk1fk1fl1.tiff"],
+        "PathName_OrigER": ["/images"],
+        "Metadata_Plate": ["BR00143976"],
+        "Metadata_Well": ["C03"],
+        "Metadata_Site": ["01"],
+    })
+    io_utils.write_table(base_df, tmp_path / "BR00143976_loaddata_original", file_format=file_format)
+
+    # The index directory does not exist, so the base table must be the only input
+    illum_path = tmp_path / "illum" / "BR00143976_loaddata_with_illum.csv"
+    loaddata_utils.create_loaddata_illum_csv(
+        tmp_path / "missing" / "Images",
+        tmp_path / "config.yml",
+        tmp_path / "BR00143976_loaddata_original",
+        pathlib.Path("/illum"),
+        "BR00143976",
+        illum_path,
+    )
+
+    illum_df = pd.read_csv(illum_path, dtype=str)
+    assert list(illum_df.columns) == list(base_df.columns) + [
+        "FileName_IllumDNA", "PathName_IllumDNA", "FileName_IllumER", "PathName_IllumER"
+    ]
+    assert illum_df["FileName_IllumER"].tolist() == ["BR00143976_IllumER.npy"]
+    assert illum_df["PathName_IllumDNA"].tolist() == ["/illum"]
+    pd.testing.assert_frame_equal(illum_df[base_df.columns], base_df)
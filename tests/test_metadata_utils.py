@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils.metadata_utils as metadata_utils
+import utils.synthetic_utils as synthetic_utils
+
+
+def write_metadata(platemap_dir) -> pd.DataFrame:
+    return synthetic_utils.write_platemaps(
+        platemap_dir, ["BR00143976", "BR00143977"], ["C03", "D03"], np.random.default_rng(0)
+    )
+
+
+def test_metadata_is_typed_and_cached_until_a_platemap_changes(tmp_path):
+    platemap_dir = tmp_path / "platemaps"
+    write_metadata(platemap_dir)
+    cache_path = tmp_path / "platemap_metadata.parquet"
+
+    metadata_df = metadata_utils.load_platemap_metadata(platemap_dir, cache_path=cache_path)
+    assert len(metadata_df) == 4
+    assert metadata_df["cell_line"].dtype == "category"
+    assert metadata_df["seeding_density"].dtype == "int64"
+
+    # A stale-looking cache is still used while the platemaps are older than it
+    stale_df = metadata_df.assign(seeding_density=0)
+    stale_df.to_parquet(cache_path, index=False)
+    assert (metadata_utils.load_platemap_metadata(platemap_dir, cache_path=cache_path)["seeding_density"] == 0).all()
+
+    platemap_path = platemap_dir / f"{synthetic_utils.PLATEMAP_FILES[0]}.csv"
+    os.utime(platemap_path, (cache_path.stat().st_mtime + 10,) * 2)
+    rebuilt_df = metadata_utils.load_platemap_metadata(platemap_dir, cache_path=cache_path)
+    pd.testing.assert_frame_equal(rebuilt_df, metadata_df)
+
+
+def test_conditions_are_attached_by_barcode_and_well(tmp_path):
+    write_metadata(tmp_path)
+    metadata_df = metadata_utils.load_platemap_metadata(tmp_path)
+    loaddata_df = pd.DataFrame({
+        "Metadata_Plate": ["BR00143977", "BR00143976", "BR00999999"],
+        "Metadata_Well": ["D03", "C03", "C03"],
+    })
+
+    inner_df = metadata_utils.attach_conditions(loaddata_df, metadata_df, columns=["platemap_file", "cell_line"])
+    assert inner_df["Metadata_Plate"].tolist() == ["BR00143977", "BR00143976"]
+    # The synthetic barcodes alternate between the platemaps
+    assert inner_df["platemap_file"].tolist() == synthetic_utils.PLATEMAP_FILES[::-1]
+    assert inner_df["cell_line"].dtype == "category"
+
+    left_df = metadata_utils.attach_conditions(loaddata_df, metadata_df, columns=["cell_line"], how="left")
+    assert len(left_df) == 3
+    assert left_df["cell_line"].isna().tolist() == [False, False, True]
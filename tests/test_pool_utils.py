@@ -0,0 +1,84 @@
+import pandas as pd
+
+import utils.io_utils as io_utils
+import utils.pool_utils as pool_utils
+
+
+def loaddata(plate: str, wells: list[str], folder: str) -> pd.DataFrame:
+    return pd.DataFrame({
+        "FileName_OrigDNA": [f"{well}-ch5.tiff" for well in wells],
+        "PathName_OrigDNA": folder,
+        "Metadata_Plate": plate,
+        "Metadata_Well": wells,
+        "Metadata_Site": 1,
+        "Metadata_Row": [ord(well[0]) - ord("A") + 1 for well in wells],
+        "Metadata_Col": [int(well[1:]) for well in wells],
+    })
+
+
+def test_reimaged_sites_take_precedence():
+    original_df = loaddata("BR00143976", ["C03", "D03", "C04"], "/original")
+    reimaged_df = loaddata("BR00143976", ["D03"], "/reimaged")
+
+    pooled_df = pool_utils.pool_loaddata([reimaged_df, original_df], reimaged=[True, False])
+
+    assert list(pooled_df.columns) == list(original_df.columns) + ["Metadata_Reimaged"]
+    assert pooled_df["Metadata_Well"].tolist() == ["C03", "D03", "C04"]
+    assert pooled_df["PathName_OrigDNA"].tolist() == ["/original", "/reimaged", "/original"]
+    assert pooled_df["Metadata_Reimaged"].tolist() == [False, True, False]
+
+
+def test_pool_uses_the_reimaged_flags_of_the_groups(tmp_path):
+    # The re-imaged plate's table name does not say "Re-imaged", only the registry flag does
+    original_path = io_utils.write_table(
+        loaddata("BR00143976", ["C03", "D03"], "/original"), tmp_path / "BR00143976_loaddata_original"
+    )
+    reimaged_path = io_utils.write_table(
+        loaddata("BR00143976", ["D03"], "/reimaged"), tmp_path / "U2-OS_BR00143976_loaddata_original"
+    )
+    pooled_dir = tmp_path / "pooled"
+    pooled_dir.mkdir()
+
+    concat_files, unused = pool_utils.pool_loaddata_csvs(
+        [original_path, reimaged_path],
+        pooled_dir,
+        groups={"BR00143976": [original_path, reimaged_path]},
+        reimaged={original_path: False, reimaged_path: True},
+    )
+
+    pooled_df = io_utils.read_table(concat_files[0])
+    assert unused == []
+    assert pooled_df["PathName_OrigDNA"].tolist() == ["/original", "/reimaged"]
+    assert pooled_df["Metadata_Reimaged"].tolist() == [False, True]
+
+
+def test_delta_pools_only_the_changed_barcodes(tmp_path, monkeypatch):
+    groups = {
+        plate: [
+            io_utils.write_table(loaddata(plate, ["C03", "D03"], "/original"), tmp_path / f"{plate}_loaddata_original")
+        ]
+        for plate in ["BR00143976", "BR00143977"]
+    }
+    pooled_dir = tmp_path / "pooled"
+    pooled_dir.mkdir()
+    pool_utils.pool_loaddata_csvs([], pooled_dir, groups=groups, delta=True)
+    assert pool_utils.changed_barcodes(groups, pooled_dir) == []
+
+    # A re-imaged plate is added to the second barcode
+    reimaged_path = io_utils.write_table(
+        loaddata("BR00143977", ["D03"], "/reimaged"), tmp_path / "BR00143977_Re-imaged_loaddata_original"
+    )
+    groups["BR00143977"].append(reimaged_path)
+    assert pool_utils.changed_barcodes(groups, pooled_dir) == ["BR00143977"]
+
+    pooled = []
+    pool_barcode = pool_utils._pool_barcode
+    monkeypatch.setattr(
+        pool_utils, "_pool_barcode", lambda br_id, *args: pooled.append(br_id) or pool_barcode(br_id, *args)
+    )
+    concat_files, _ = pool_utils.pool_loaddata_csvs([], pooled_dir, groups=groups, delta=True)
+
+    assert pooled == ["BR00143977"]
+    assert [path.name for path in concat_files] == ["BR00143976_concatenated.csv", "BR00143977_concatenated.csv"]
+    assert io_utils.read_table(concat_files[1])["PathName_OrigDNA"].tolist() == ["/original", "/reimaged"]
+    assert pool_utils.changed_barcodes(groups, pooled_dir) == []
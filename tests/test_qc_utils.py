@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.qc_utils as qc_utils
+
+
+METRICS = ["ImageQuality_PowerLogLogSlope", "ImageQuality_PercentMaximal"]
+
+
+def long_qc_table(seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product(
+        [["BR00143976", "BR00143977"], ["C03", "D03", "E03"], range(1, 6), ["OrigDNA", "OrigER"]],
+        names=qc_utils.SITE_COLUMNS + ["Channel"],
+    )
+    long_df = index.to_frame(index=False)
+    long_df["ImageQuality_PowerLogLogSlope"] = rng.normal(-2, 0.1, len(long_df))
+    long_df["ImageQuality_PercentMaximal"] = rng.normal(0.1, 0.01, len(long_df))
+    # The second plate is imaged brighter, so its saturation baseline is shifted
+    long_df.loc[long_df["Metadata_Plate"] == "BR00143977", "ImageQuality_PercentMaximal"] += 0.1
+    return long_df
+
+
+@pytest.mark.parametrize("estimator", qc_utils.QC_ESTIMATORS)
+@pytest.mark.parametrize("scope", list(qc_utils.QC_SCOPES))
+def test_accumulated_statistics_match_the_in_memory_ones(scope, estimator):
+    long_df = long_qc_table()
+    expected = qc_utils.compute_qc_statistics(long_df, METRICS, scope=scope, estimator=estimator)
+
+    accumulator = qc_utils.QCStatisticsAccumulator(METRICS, scope=scope, estimator=estimator)
+    for _, plate_df in long_df.groupby("Metadata_Plate"):
+        accumulator.update(plate_df)
+
+    pd.testing.assert_frame_equal(accumulator.finalize()[expected.columns], expected, check_index_type=False)
+
+
+def test_median_mad_statistics():
+    long_df = long_qc_table()
+    stats = qc_utils.compute_qc_statistics(long_df, METRICS, scope="channel", estimator="median_mad")
+
+    values = long_df.loc[long_df["Channel"] == "OrigER", "ImageQuality_PercentMaximal"]
+    median = values.median()
+    assert stats.loc["OrigER", "ImageQuality_PercentMaximal_center"] == pytest.approx(median)
+    assert stats.loc["OrigER", "ImageQuality_PercentMaximal_scale"] == pytest.approx(
+        (values - median).abs().median() * qc_utils.MAD_SCALE
+    )
+
+
+def test_plate_scope_flags_outliers_of_their_own_plate():
+    long_df = long_qc_table()
+    # Saturated for the first plate but within the range of the second one
+    outlier = (long_df["Metadata_Plate"] == "BR00143976") & (long_df["Metadata_Well"] == "C03")
+    outlier &= (long_df["Metadata_Site"] == 1) & (long_df["Channel"] == "OrigDNA")
+    long_df.loc[outlier, "ImageQuality_PercentMaximal"] = 0.17
+    thresholds = {metric: 4.0 for metric in METRICS}
+
+    failed = {}
+    for scope in ["global", "plate"]:
+        stats = qc_utils.compute_qc_statistics(long_df, METRICS, scope=scope, estimator="median_mad")
+        site_df = qc_utils.flag_sites(long_df, qc_utils.score_qc(long_df, stats, METRICS, scope=scope), thresholds)
+        failed[scope] = site_df.loc[site_df["QC_Fail"], qc_utils.SITE_COLUMNS].values.tolist()
+
+    assert failed["plate"] == [["BR00143976", "C03", 1]]
+    assert ["BR00143976", "C03", 1] not in failed["global"]
+
+
+def test_qc_config_rejects_unknown_scopes(tmp_path):
+    config_path = tmp_path / "qc_config.yml"
+    config_path.write_text("scope: well\nmetrics:\n    ImageQuality_PercentMaximal: 3\n")
+    with pytest.raises(ValueError, match="Unknown QC scope"):
+        qc_utils.load_qc_config(config_path)
+
+    config_path.write_text("scope: plate\nestimator: median_mad\nmetrics:\n    ImageQuality_PercentMaximal: 3\n")
+    assert qc_utils.load_qc_config(config_path) == {
+        "scope": "plate",
+        "estimator": "median_mad",
+        "metrics": {"ImageQuality_PercentMaximal": 3.0},
+    }
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+import utils.site_key_utils as site_key_utils
+
+
+def test_site_keys_round_trip():
+    df = pd.DataFrame({
+        "Metadata_Plate": ["BR00143976", "BR00143976", "BR00143981", "BR00999999", "BR000012345", "BR0012345"],
+        "Metadata_Well": ["C03", "N22", "A01", "AF64", "C03", "C03"],
+        "Metadata_Site": [1, 9, 0, site_key_utils.N_SITES - 1, 1, 1],
+    })
+    keys = site_key_utils.site_keys(df)
+
+    assert keys.dtype == np.int64
+    assert keys.is_unique
+    pd.testing.assert_frame_equal(site_key_utils.decode_site_keys(keys), df)
+
+
+def test_missing_values_get_missing_key():
+    keys = site_key_utils.encode_site_keys(
+        pd.Series(["BR00143976", None, "BR00143976"]),
+        pd.Series(["C03", "C03", None]),
+        pd.Series([1, 1, 1]),
+    )
+    assert keys[0] != site_key_utils.MISSING_KEY
+    assert (keys[1:] == site_key_utils.MISSING_KEY).all()
+
+
+def test_key_plates_keep_leading_zeros():
+    plates = pd.Series(["BR00143976", "BR000012345", "BR000012345"])
+    keys = site_key_utils.encode_site_keys(plates, pd.Series(["C03"] * 3), pd.Series([1, 2, 3]))
+    assert site_key_utils.key_plates(keys) == ["BR000012345", "BR00143976"]
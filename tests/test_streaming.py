@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+import utils.datasplit_utils as datasplit_utils
+import utils.io_utils as io_utils
+import utils.pipeline_utils as pipeline_utils
+import utils.qc_utils as qc_utils
+import utils.site_key_utils as site_key_utils
+
+
+def run_stages(config: dict, stages: list[str]):
+    report_df = pipeline_utils.run_pipeline(config, stages, force=True)
+    assert (report_df["status"] == "success").all(), report_df
+
+
+def read_exclusions(config: dict) -> pd.DataFrame:
+    exclusion_path = io_utils.table_path(config["qc_output_dir"] / "qc_exclusion", config["output_format"])
+    return io_utils.read_table(exclusion_path).sort_values(qc_utils.SITE_COLUMNS).reset_index(drop=True)
+
+
+def read_site_scores(config: dict) -> pd.DataFrame:
+    scores_path = io_utils.table_path(config["qc_output_dir"] / "qc_site_scores", config["output_format"])
+    return io_utils.read_table(scores_path).sort_values(qc_utils.SITE_COLUMNS).reset_index(drop=True)
+
+
+def read_manifest(config: dict) -> pd.DataFrame:
+    manifest_path = io_utils.table_path(config["split_dir"] / "split_manifest", config["output_format"])
+    manifest_df = io_utils.read_table(manifest_path)
+    return manifest_df.sort_values(site_key_utils.SITE_KEY_COLUMN).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet"])
+def test_streaming_qc_matches_in_memory(batch_config, output_format):
+    batch_config["output_format"] = output_format
+    batch_config["qc"]["streaming"] = False
+    run_stages(batch_config, ["qc"])
+    exclusion_df = read_exclusions(batch_config)
+    site_scores_df = read_site_scores(batch_config)
+    assert not exclusion_df.empty
+
+    batch_config["qc"]["streaming"] = True
+    run_stages(batch_config, ["qc"])
+    # Parquet keeps the categorical plate and well columns of the in-memory table, the streamed one holds strings
+    pd.testing.assert_frame_equal(
+        read_exclusions(batch_config), exclusion_df, check_dtype=False, check_categorical=False
+    )
+    pd.testing.assert_frame_equal(
+        read_site_scores(batch_config), site_scores_df, check_dtype=False, check_categorical=False
+    )
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet"])
+def test_streaming_split_matches_in_memory(batch_config, output_format):
+    batch_config["output_format"] = output_format
+    run_stages(batch_config, ["qc"])
+
+    batch_config["split"]["streaming"] = False
+    run_stages(batch_config, ["split"])
+    manifest_df = read_manifest(batch_config)
+    assert (manifest_df["split_seed42"] == datasplit_utils.HELDOUT_LABEL).any()
+
+    batch_config["split"]["streaming"] = True
+    run_stages(batch_config, ["split"])
+    pd.testing.assert_frame_equal(read_manifest(batch_config), manifest_df)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+import utils.io_utils as io_utils
+import utils.site_key_utils as site_key_utils
+import utils.tensor_store_utils as tensor_store_utils
+
+
+CHANNELS = ["OrigDNA", "OrigER"]
+
+
+def write_sites(folder, n_sites: int, shape=(16, 24)) -> tuple[pd.DataFrame, np.ndarray]:
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 2**16, size=(n_sites, len(CHANNELS), *shape), dtype=np.uint16)
+    rows = []
+    for site in range(n_sites):
+        row = {"Metadata_Plate": "BR00143976", "Metadata_Well": "C03", "Metadata_Site": site + 1}
+        for channel, image in zip(CHANNELS, images[site]):
+            Image.fromarray(image).save(folder / f"{site}_{channel}.tiff")
+            row[f"PathName_{channel}"] = str(folder)
+            row[f"FileName_{channel}"] = f"{site}_{channel}.tiff"
+        rows.append(row)
+    return pd.DataFrame(rows), images
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_store_round_trips_the_images(tmp_path, file_format):
+    loaddata_df, images = write_sites(tmp_path / "images", n_sites=5)
+    store_dir = tmp_path / "store"
+
+    tensor_store_utils.build_tensor_store(
+        loaddata_df, store_dir, CHANNELS, sites_per_shard=2, n_workers=2, file_format=file_format
+    )
+    index_df, shards, metadata = tensor_store_utils.open_tensor_store(store_dir)
+
+    assert metadata["n_shards"] == 3 and metadata["image_shape"] == [16, 24]
+    assert [shard.shape[0] for shard in shards] == [2, 2, 1]
+    assert index_df[site_key_utils.SITE_KEY_COLUMN].tolist() == site_key_utils.site_keys(loaddata_df).tolist()
+    for i in range(len(loaddata_df)):
+        np.testing.assert_array_equal(tensor_store_utils.read_site(index_df, shards, i), images[i])
+    np.testing.assert_array_equal(tensor_store_utils.read_site(index_df, shards, 4, channels=[1]), images[4, [1]])
+    # A slice of the channels stays a view of the memory-mapped shard
+    assert np.shares_memory(tensor_store_utils.read_site(index_df, shards, 3), shards[1])
+
+
+def test_images_of_another_shape_are_rejected(tmp_path):
+    loaddata_df, _ = write_sites(tmp_path / "images", n_sites=2)
+    other_df, _ = write_sites(tmp_path / "other", n_sites=1, shape=(8, 8))
+
+    with pytest.raises(ValueError, match="expected"):
+        tensor_store_utils.build_tensor_store(
+            pd.concat([loaddata_df, other_df], ignore_index=True), tmp_path / "store", CHANNELS, n_workers=1
+        )
+
+
+def test_split_store_follows_the_manifest_order(tmp_path):
+    loaddata_df, images = write_sites(tmp_path / "images", n_sites=4)
+    pooled_dir = tmp_path / "pooled"
+    pooled_dir.mkdir()
+    io_utils.write_table(loaddata_df, pooled_dir / "BR00143976_concatenated")
+    manifest_df = pd.DataFrame({
+        site_key_utils.SITE_KEY_COLUMN: site_key_utils.site_keys(loaddata_df).to_numpy()[[3, 0, 2, 1]],
+        "split_seed42": ["train", "train", "heldout", "train"],
+    })
+    manifest_path = io_utils.write_table(manifest_df, tmp_path / "split_manifest")
+
+    index_df = tensor_store_utils.build_split_store(manifest_path, pooled_dir, tmp_path / "store", n_workers=1)
+
+    assert index_df["Metadata_Site"].tolist() == [4, 1, 2]
+    _, shards, metadata = tensor_store_utils.open_tensor_store(tmp_path / "store")
+    assert metadata["channels"] == CHANNELS and metadata["label"] == "train"
+    np.testing.assert_array_equal(shards[0][:3], images[[3, 0, 1]])
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import utils.tensor_store_utils as tensor_store_utils
+import utils.thumbnail_utils as thumbnail_utils
+
+
+def write_site(folder, well: str, value: int) -> pd.DataFrame:
+    folder.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(np.full((32, 32), value, dtype=np.uint16)).save(folder / f"{well}.tiff")
+    return pd.DataFrame({
+        "Metadata_Plate": ["BR00143976"],
+        "Metadata_Well": [well],
+        "Metadata_Site": [1],
+        "PathName_OrigDNA": [str(folder)],
+        "FileName_OrigDNA": [f"{well}.tiff"],
+    })
+
+
+def test_cache_is_reused_until_a_site_points_at_new_images(tmp_path, monkeypatch):
+    decoded = []
+    read_image = tensor_store_utils.read_image
+    monkeypatch.setattr(tensor_store_utils, "read_image", lambda path: decoded.append(path) or read_image(path))
+    cache_dir = tmp_path / "thumbnails"
+
+    sites_df = pd.concat(
+        [write_site(tmp_path / "original", "C03", 100), write_site(tmp_path / "original", "D03", 200)],
+        ignore_index=True,
+    )
+    thumbnail_utils.build_plate_thumbnails(sites_df, cache_dir, ["OrigDNA"], size=16, n_levels=2)
+    thumbnail_utils.build_plate_thumbnails(sites_df, cache_dir, ["OrigDNA"], size=16, n_levels=2)
+    assert len(decoded) == 2
+
+    # A re-imaged plate points D03 at another file, only that site is decoded again
+    reimaged_df = pd.concat([sites_df.iloc[:1], write_site(tmp_path / "reimaged", "D03", 900)], ignore_index=True)
+    thumbnail_utils.build_plate_thumbnails(reimaged_df, cache_dir, ["OrigDNA"], size=16, n_levels=2)
+    assert decoded[2:] == [str(tmp_path / "reimaged" / "D03.tiff")]
+
+    thumbnails, keys, _ = thumbnail_utils.read_thumbnails(cache_dir, "BR00143976")
+    assert thumbnails.shape == (2, 1, 16, 16)
+    assert thumbnails[:, 0, 0, 0].tolist() == [100, 900]
+
+
+def test_montages_are_paginated(tmp_path):
+    wells = [f"C{col:02d}" for col in range(3, 8)]
+    review_df = pd.concat([write_site(tmp_path / "images", well, 100) for well in wells], ignore_index=True)
+    review_df["qc_status"] = thumbnail_utils.EXCLUDED_STATUS
+    output_dir = tmp_path / "thumbnails"
+
+    index_df = thumbnail_utils.build_review_thumbnails(
+        review_df, output_dir, ["OrigDNA"], size=16, n_levels=1, n_workers=1, max_montage_sites=2
+    )
+
+    montages = ["BR00143976_montage.png", "BR00143976_montage_2.png", "BR00143976_montage_3.png"]
+    assert index_df["montage"].tolist() == [montages[0]] * 2 + [montages[1]] * 2 + [montages[2]]
+    assert sorted(path.name for path in output_dir.glob("*.png")) == montages
+    with Image.open(output_dir / montages[0]) as montage:
+        assert montage.height == 2 * (16 + 2 * 2)
@@ -0,0 +1,201 @@
+"""
+This file contains functions to build the single-cell crop index of a split: the site key and center
+of every cell of the split's sites, with whether a patch centered on the cell fits in the field of
+view. The single-cell feature tables are read once, in parallel, with only the location columns and
+only the rows of the split's wells, so building a crop dataset becomes a load of this small index.
+"""
+
+
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import datasplit_utils, io_utils, site_key_utils
+
+
+CENTER_X_COLUMN = "Metadata_Cells_Location_Center_X"
+CENTER_Y_COLUMN = "Metadata_Cells_Location_Center_Y"
+
+# Single-cell feature tables are named after their plate
+SC_FEATURES_NAME = "{plate}_sc_normalized.parquet"
+
+CROP_INDEX_COLUMNS = [site_key_utils.SITE_KEY_COLUMN, CENTER_X_COLUMN, CENTER_Y_COLUMN, "valid_patch"]
+
+
+def _read_plate_locations(path: pathlib.Path, wells: list[str]) -> pd.DataFrame:
+    return pd.read_parquet(
+        path,
+        columns=[
+            site_key_utils.PLATE_COLUMN,
+            site_key_utils.WELL_COLUMN,
+            site_key_utils.SITE_COLUMN,
+            CENTER_X_COLUMN,
+            CENTER_Y_COLUMN,
+        ],
+        filters=[(site_key_utils.WELL_COLUMN, "in", wells)],
+    )
+
+
+def read_cell_locations(
+    sc_features_dir: pathlib.Path,
+    site_keys: np.ndarray,
+    n_workers: int = 8,
+) -> pd.DataFrame:
+    """
+    Read the cell centers of some sites from the per-plate single-cell feature tables
+
+    Parameters
+    ----------
+    sc_features_dir : pathlib.Path
+        folder with one `{plate}_sc_normalized.parquet` table per plate
+    site_keys : np.ndarray
+        int64 keys of the sites to read, from `site_key_utils`
+    n_workers : int
+        number of plate tables read at the same time
+
+    Returns
+    -------
+    pd.DataFrame
+        the site key and center x/y of every cell of the sites, plates without a table are skipped
+    """
+    site_keys = np.unique(np.asarray(site_keys, dtype=np.int64))
+    sites_df = site_key_utils.decode_site_keys(site_keys)
+    plate_wells = sites_df.groupby(site_key_utils.PLATE_COLUMN)[site_key_utils.WELL_COLUMN].unique()
+
+    jobs = []
+    for plate, wells in plate_wells.items():
+        path = sc_features_dir / SC_FEATURES_NAME.format(plate=plate)
+        if not path.exists():
+            print(f"{path} does not exist, skipping...")
+            continue
+        jobs.append((path, list(wells)))
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        location_dfs = list(executor.map(lambda job: _read_plate_locations(*job), jobs))
+    if not location_dfs:
+        return pd.DataFrame(columns=CROP_INDEX_COLUMNS[:-1])
+
+    locations_df = pd.concat(location_dfs, ignore_index=True)
+    keys = site_key_utils.encode_site_keys(
+        locations_df[site_key_utils.PLATE_COLUMN],
+        locations_df[site_key_utils.WELL_COLUMN],
+        pd.to_numeric(locations_df[site_key_utils.SITE_COLUMN]),
+    )
+    locations_df.insert(0, site_key_utils.SITE_KEY_COLUMN, keys)
+    # The wells were pushed down to the reads, the sites are matched here
+    locations_df = locations_df[np.isin(keys, site_keys)]
+    return locations_df[CROP_INDEX_COLUMNS[:-1]].reset_index(drop=True)
+
+
+def valid_patches(
+    locations_df: pd.DataFrame,
+    patch_size: int,
+    fov: tuple[int, int],
+) -> np.ndarray:
+    """
+    Check which cells can be cropped without the patch leaving the field of view
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        table with the cell center x/y columns
+    patch_size : int
+        side of the square patch centered on each cell, in pixels
+    fov : tuple[int, int]
+        height and width of the field of view, in pixels
+
+    Returns
+    -------
+    np.ndarray
+        boolean mask, True where the whole patch is inside the field of view
+    """
+    half = patch_size / 2
+    x = locations_df[CENTER_X_COLUMN].to_numpy(dtype=float)
+    y = locations_df[CENTER_Y_COLUMN].to_numpy(dtype=float)
+    return (x - half >= 0) & (x + half <= fov[1]) & (y - half >= 0) & (y + half <= fov[0])
+
+
+def build_crop_index(
+    manifest_path: pathlib.Path,
+    sc_features_dir: pathlib.Path,
+    output_path: pathlib.Path,
+    patch_size: int = 256,
+    fov: tuple[int, int] = (1080, 1080),
+    label: str = datasplit_utils.TRAIN_LABEL,
+    split_column: str | None = None,
+    n_workers: int = 8,
+    file_format: str = "csv",
+) -> pd.DataFrame:
+    """
+    Build and write the crop index of one split
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        path to the split manifest, with or without a file extension
+    sc_features_dir : pathlib.Path
+        folder with one `{plate}_sc_normalized.parquet` table per plate
+    output_path : pathlib.Path
+        path to the crop index, the extension is set by `file_format`
+    patch_size : int
+        side of the square patch centered on each cell, in pixels
+    fov : tuple[int, int]
+        height and width of the field of view, in pixels
+    label : str
+        "train", "heldout" or "eval"
+    split_column : str | None
+        label column of the manifest, None uses the first one
+    n_workers : int
+        number of plate tables read at the same time
+    file_format : str
+        "csv" or "parquet"
+
+    Returns
+    -------
+    pd.DataFrame
+        the crop index, one row per cell with its site key, center x/y and `valid_patch` flag
+    """
+    if split_column is None:
+        split_column = datasplit_utils.split_columns(manifest_path)[0]
+    manifest_df = io_utils.read_table(manifest_path, columns=[site_key_utils.SITE_KEY_COLUMN, split_column])
+    keys = manifest_df.loc[manifest_df[split_column] == label, site_key_utils.SITE_KEY_COLUMN].to_numpy()
+
+    crop_index_df = read_cell_locations(sc_features_dir, keys, n_workers=n_workers)
+    crop_index_df["valid_patch"] = valid_patches(crop_index_df, patch_size, fov)
+    io_utils.write_table(crop_index_df, output_path, file_format=file_format)
+    return crop_index_df
+
+
+def load_crop_index(
+    path: pathlib.Path,
+    valid_only: bool = True,
+    decode: bool = True,
+) -> pd.DataFrame:
+    """
+    Load a crop index
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the crop index, with or without a file extension
+    valid_only : bool
+        only return the cells whose patch fits in the field of view
+    decode : bool
+        add the `Metadata_Plate`, `Metadata_Well` and `Metadata_Site` of each cell's site key
+
+    Returns
+    -------
+    pd.DataFrame
+        the crop index
+    """
+    crop_index_df = io_utils.read_table(path)
+    if valid_only:
+        crop_index_df = crop_index_df[crop_index_df["valid_patch"]].reset_index(drop=True)
+    if decode:
+        crop_index_df = pd.concat(
+            [site_key_utils.decode_site_keys(crop_index_df[site_key_utils.SITE_KEY_COLUMN]), crop_index_df],
+            axis=1,
+        )
+    return crop_index_df
@@ -0,0 +1,694 @@
+"""
+This file contains functions to split LoadData rows into train and heldout wells within each
+condition. Every condition draws from its own `numpy.random.Generator` seeded by the split seed and
+the condition values, so a condition's split does not depend on which other conditions are present,
+and many seeds or folds are assigned at once as one label column each.
+
+Splits are stored as a compact manifest of site keys and split labels, and any split is materialized
+on demand from the pooled LoadData tables with `read_split`. `stream_split_manifest` builds the same
+manifest one pooled table at a time for batches whose LoadData does not fit in memory.
+`update_splits` keeps the labels of a previous manifest for the conditions whose wells did not change,
+and `load_previous_manifest` only returns a manifest drawn with the same split parameters.
+`run_split` runs the whole split step for both `4.datasplit.py` and the pipeline runner.
+"""
+
+
+import json
+import pathlib
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from . import instrument_utils, io_utils, metadata_utils, site_key_utils
+
+
+TRAIN_LABEL = "train"
+HELDOUT_LABEL = "heldout"
+EVAL_LABEL = "eval"
+SPLIT_LABELS = [TRAIN_LABEL, HELDOUT_LABEL, EVAL_LABEL]
+
+# Label columns of the split manifest are named `split_seed{seed}` or `split_seed{seed}_fold{k}`
+SPLIT_COLUMN_PREFIX = "split_"
+
+DEFAULT_SEEDS = (42,)
+
+# Parameters the split manifest was drawn with, saved next to it
+SPLIT_PARAMS_NAME = "split_params.json"
+
+
+def condition_mask(df: pd.DataFrame, condition_kwargs: dict, strict: bool = True) -> pd.Series:
+    """
+    Select the rows matching every condition
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table with one column per condition key
+    condition_kwargs : dict
+        column name to a value, or to a list of accepted values
+    strict : bool
+        raise a ValueError when no row matches, e.g. False for one chunk of a larger table
+
+    Returns
+    -------
+    pd.Series
+        boolean mask of the matching rows
+    """
+    mask = pd.Series(True, index=df.index)
+    for k, v in condition_kwargs.items():
+        mask &= df[k].isin(v) if isinstance(v, list) else df[k] == v
+        if strict and not mask.any():
+            raise ValueError(f'No data found for {k}={v}')
+    return mask
+
+
+def condition_rng(seed: int, condition: tuple) -> np.random.Generator:
+    """
+    Get the random generator of one condition for one split seed
+
+    Parameters
+    ----------
+    seed : int
+        split seed
+    condition : tuple
+        values of the condition columns
+
+    Returns
+    -------
+    np.random.Generator
+        generator seeded by the split seed and a stable hash of the condition values
+    """
+    condition_hash = zlib.crc32(repr(tuple(str(v) for v in condition)).encode())
+    return np.random.default_rng([seed, condition_hash])
+
+
+def _well_ranks(wells_df: pd.DataFrame, condition_columns: list[str], seed: int) -> np.ndarray:
+    """Rank the wells of each condition in a random order drawn from the condition's generator"""
+    condition_ids = wells_df.groupby(condition_columns, observed=True, sort=False).ngroup().to_numpy()
+    keys = np.empty(len(wells_df))
+    for condition_id, condition in enumerate(
+        wells_df[condition_columns].drop_duplicates().itertuples(index=False, name=None)
+    ):
+        in_condition = condition_ids == condition_id
+        keys[in_condition] = condition_rng(seed, condition).random(in_condition.sum())
+    return (
+        pd.Series(keys).groupby(condition_ids).rank(method="first").to_numpy(dtype=np.int64) - 1
+    )
+
+
+def assign_splits(
+    df: pd.DataFrame,
+    condition_columns: list[str],
+    well_column: str = "Metadata_Well",
+    seeds: tuple[int, ...] | list[int] = DEFAULT_SEEDS,
+    n_heldout_wells: int = 1,
+    n_folds: int | None = None,
+) -> pd.DataFrame:
+    """
+    Assign every row a train or heldout label, holding out whole wells within each condition
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        rows to split, with the condition and well columns
+    condition_columns : list[str]
+        columns whose combination identifies a condition
+    well_column : str
+        name of the well column
+    seeds : tuple[int, ...] | list[int]
+        split seeds, each gives one `split_seed{seed}` label column (or one set of fold columns)
+    n_heldout_wells : int
+        number of wells held out per condition for each seed, ignored when `n_folds` is given
+    n_folds : int | None
+        if given, the wells of each condition are dealt into this many folds and each fold gives
+        a `split_seed{seed}_fold{k}` column holding out the wells of fold k
+
+    Returns
+    -------
+    pd.DataFrame
+        one categorical label column per seed (and fold), aligned with the rows of `df`
+    """
+    key_columns = condition_columns + [well_column]
+    # Wells are sorted by value (categoricals as strings) so the draws don't depend on the row order of `df`
+    wells_df = (
+        df[key_columns].drop_duplicates()
+        .sort_values(key_columns, key=lambda column: column.astype(str))
+        .reset_index(drop=True)
+    )
+
+    # Map every row to its (condition, well) once, labels are then broadcast with a take
+    row_wells = pd.MultiIndex.from_frame(wells_df).get_indexer(pd.MultiIndex.from_frame(df[key_columns]))
+    categories = pd.CategoricalDtype(SPLIT_LABELS)
+
+    labels = {}
+    for seed in seeds:
+        ranks = _well_ranks(wells_df, condition_columns, seed)
+        if n_folds is None:
+            heldout = {f"split_seed{seed}": ranks < n_heldout_wells}
+        else:
+            folds = ranks % n_folds
+            heldout = {f"split_seed{seed}_fold{k}": folds == k for k in range(n_folds)}
+        for column, well_heldout in heldout.items():
+            codes = np.where(well_heldout, SPLIT_LABELS.index(HELDOUT_LABEL), SPLIT_LABELS.index(TRAIN_LABEL))
+            labels[column] = pd.Categorical.from_codes(codes[row_wells], dtype=categories)
+
+    return pd.DataFrame(labels, index=df.index)
+
+
+def update_splits(
+    df: pd.DataFrame,
+    condition_columns: list[str],
+    previous_manifest_df: pd.DataFrame,
+    metadata_df: pd.DataFrame,
+    well_column: str = "Metadata_Well",
+    seeds: tuple[int, ...] | list[int] = DEFAULT_SEEDS,
+    n_heldout_wells: int = 1,
+    n_folds: int | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Assign split labels while keeping the labels of a previous manifest for every condition whose
+    wells did not change, so adding plates only re-draws the conditions they add wells to (or remove
+    wells from) and the labels of every other site stay the same
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        rows to split, with the condition and well columns
+    condition_columns : list[str]
+        columns whose combination identifies a condition
+    previous_manifest_df : pd.DataFrame
+        split manifest of the previous run drawn with the same parameters, from `load_previous_manifest`
+    metadata_df : pd.DataFrame
+        table from `metadata_utils.load_platemap_metadata`, gives the conditions of the previous sites
+    well_column : str
+        name of the well column
+    seeds : tuple[int, ...] | list[int]
+        split seeds, see `assign_splits`
+    n_heldout_wells : int
+        number of wells held out per condition, see `assign_splits`
+    n_folds : int | None
+        number of folds, see `assign_splits`
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        the labels as returned by `assign_splits`, and the condition values of the re-drawn conditions
+    """
+    split_labels = assign_splits(
+        df, condition_columns, well_column=well_column, seeds=seeds, n_heldout_wells=n_heldout_wells, n_folds=n_folds
+    )
+    key_columns = condition_columns + [well_column]
+    previous_columns = [c for c in previous_manifest_df.columns if c.startswith(SPLIT_COLUMN_PREFIX)]
+    if previous_columns != list(split_labels.columns):
+        # Other seeds or folds, nothing can be kept
+        print("The previous split manifest has other splits, every condition is re-drawn")
+        return split_labels, df[condition_columns].drop_duplicates().reset_index(drop=True)
+
+    # (condition, well) labels of the previous train and heldout sites, every site of a well has the same labels
+    previous_df = previous_manifest_df[previous_manifest_df[previous_columns[0]].astype(str) != EVAL_LABEL]
+    previous_df = pd.concat(
+        [
+            site_key_utils.decode_site_keys(previous_df[site_key_utils.SITE_KEY_COLUMN]),
+            previous_df[previous_columns].astype(str).reset_index(drop=True),
+        ],
+        axis=1,
+    )
+    previous_df = metadata_utils.attach_conditions(
+        previous_df, metadata_df, columns=condition_columns, well_column=well_column
+    )
+    previous_wells = previous_df.drop_duplicates(key_columns).reset_index(drop=True)
+
+    # Conditions with a well that is only in the current rows or only in the previous manifest
+    current_keys = pd.MultiIndex.from_frame(df[key_columns].astype(str))
+    previous_keys = pd.MultiIndex.from_frame(previous_wells[key_columns].astype(str))
+    changed_keys = current_keys.unique().symmetric_difference(previous_keys)
+    changed_conditions = pd.MultiIndex.from_frame(changed_keys.to_frame(index=False)[condition_columns])
+    redrawn = pd.MultiIndex.from_frame(df[condition_columns].astype(str)).isin(changed_conditions)
+    positions = previous_keys.get_indexer(current_keys)
+
+    categories = pd.CategoricalDtype(SPLIT_LABELS)
+    for column in split_labels.columns:
+        # Re-drawn rows may have no previous well (position -1), they take the appended placeholder
+        previous_codes = np.append(pd.Categorical(previous_wells[column], dtype=categories).codes, 0)
+        codes = np.where(redrawn, split_labels[column].cat.codes.to_numpy(), previous_codes[positions])
+        split_labels[column] = pd.Categorical.from_codes(codes, dtype=categories)
+
+    changed_df = df.loc[redrawn, condition_columns].drop_duplicates().reset_index(drop=True)
+    n_conditions = len(df[condition_columns].drop_duplicates())
+    print(f"{len(changed_df)} of {n_conditions} conditions changed and were re-drawn, the others kept their labels")
+    return split_labels, changed_df
+
+
+def split_params(
+    train_conditions: dict,
+    seeds: tuple[int, ...] | list[int] = DEFAULT_SEEDS,
+    n_heldout_wells: int = 1,
+    n_folds: int | None = None,
+) -> dict:
+    """
+    Get the parameters a split manifest is drawn with, as stored in `split_params.json`
+
+    Parameters
+    ----------
+    train_conditions : dict
+        condition column to a value or list of values selecting the train data
+    seeds : tuple[int, ...] | list[int]
+        split seeds, see `assign_splits`
+    n_heldout_wells : int
+        number of wells held out per condition, see `assign_splits`
+    n_folds : int | None
+        number of folds, see `assign_splits`
+
+    Returns
+    -------
+    dict
+        the parameters with json types, so they compare equal to the ones read back
+    """
+    return json.loads(json.dumps({
+        "train_conditions": train_conditions,
+        "seeds": list(seeds),
+        "n_heldout_wells": n_heldout_wells,
+        "n_folds": n_folds,
+    }))
+
+
+def write_split_params(params: dict, manifest_path: pathlib.Path) -> pathlib.Path:
+    """
+    Save the parameters of a split manifest next to it
+
+    Parameters
+    ----------
+    params : dict
+        parameters from `split_params`
+    manifest_path : pathlib.Path
+        path to the split manifest, with or without a file extension
+
+    Returns
+    -------
+    pathlib.Path
+        path to the `split_params.json` file
+    """
+    params_path = pathlib.Path(manifest_path).parent / SPLIT_PARAMS_NAME
+    with open(params_path, "w") as f:
+        json.dump(params, f, indent=4)
+    return params_path
+
+
+def load_previous_manifest(manifest_path: pathlib.Path, params: dict) -> pd.DataFrame | None:
+    """
+    Load the split manifest of a previous run if it was drawn with the same parameters
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        path to the split manifest, with or without a file extension
+    params : dict
+        parameters of the current run, from `split_params`
+
+    Returns
+    -------
+    pd.DataFrame | None
+        the previous manifest, None if there is none or its parameters differ (every condition is re-drawn)
+    """
+    try:
+        manifest_path = io_utils.find_table(manifest_path)
+    except FileNotFoundError:
+        print("No previous split manifest, every condition is drawn")
+        return None
+    params_path = manifest_path.parent / SPLIT_PARAMS_NAME
+    previous_params = None
+    if params_path.exists():
+        with open(params_path, "r") as f:
+            previous_params = json.load(f)
+    if previous_params != params:
+        print("The split parameters changed since the previous split manifest, every condition is re-drawn")
+        return None
+    return io_utils.read_table(manifest_path)
+
+
+def build_split_manifest(
+    train_df: pd.DataFrame,
+    split_labels: pd.DataFrame,
+    eval_df: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """
+    Build the split manifest, one row per site with its site key and one label per split
+
+    Parameters
+    ----------
+    train_df : pd.DataFrame
+        rows that were split into train and heldout, with the plate, well and site columns
+    split_labels : pd.DataFrame
+        labels of `train_df` from `assign_splits`
+    eval_df : pd.DataFrame | None
+        rows kept for evaluation, labelled "eval" in every split
+
+    Returns
+    -------
+    pd.DataFrame
+        the `Metadata_SiteKey` column followed by the label columns
+    """
+    manifest_df = split_labels.reset_index(drop=True)
+    manifest_df.insert(0, site_key_utils.SITE_KEY_COLUMN, site_key_utils.site_keys(train_df).to_numpy())
+    if eval_df is not None and not eval_df.empty:
+        eval_labels = pd.Categorical.from_codes(
+            np.full(len(eval_df), SPLIT_LABELS.index(EVAL_LABEL)), dtype=pd.CategoricalDtype(SPLIT_LABELS)
+        )
+        eval_manifest_df = pd.DataFrame(
+            {column: eval_labels for column in split_labels.columns}
+        )
+        eval_manifest_df.insert(0, site_key_utils.SITE_KEY_COLUMN, site_key_utils.site_keys(eval_df).to_numpy())
+        manifest_df = pd.concat([manifest_df, eval_manifest_df], ignore_index=True)
+    return manifest_df
+
+
+def split_columns(manifest_path: pathlib.Path) -> list[str]:
+    """
+    List the label columns of a split manifest
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        path to the split manifest, with or without a file extension
+
+    Returns
+    -------
+    list[str]
+        the `split_*` columns, the first one is the default split
+    """
+    return [c for c in io_utils.read_columns(manifest_path) if c.startswith(SPLIT_COLUMN_PREFIX)]
+
+
+def read_split(
+    manifest_path: pathlib.Path,
+    loaddata_dir: pathlib.Path,
+    label: str = TRAIN_LABEL,
+    split_column: str | None = None,
+    columns: list[str] | None = None,
+    metadata_df: pd.DataFrame | None = None,
+    condition_columns: list[str] = metadata_utils.CONDITION_COLUMNS,
+) -> pd.DataFrame:
+    """
+    Materialize one split by selecting its sites from the pooled LoadData tables
+
+    Only the manifest's site key and label column are read, and each pooled table is read with only
+    the requested columns and the plates of the split, so a split never needs its own LoadData copy.
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        path to the split manifest, with or without a file extension
+    loaddata_dir : pathlib.Path
+        folder with the pooled LoadData tables
+    label : str
+        "train", "heldout" or "eval"
+    split_column : str | None
+        label column of the manifest, None uses the first one
+    columns : list[str] | None
+        LoadData columns to return (the plate, well and site columns are always read), None reads all
+    metadata_df : pd.DataFrame | None
+        table from `metadata_utils.load_platemap_metadata`, if given the condition columns are attached
+    condition_columns : list[str]
+        condition columns attached when `metadata_df` is given
+
+    Returns
+    -------
+    pd.DataFrame
+        the LoadData rows of the split, in the order of the pooled tables
+    """
+    if label not in SPLIT_LABELS:
+        raise ValueError(f"Unknown split label: {label}, expected one of {SPLIT_LABELS}")
+    if split_column is None:
+        split_column = split_columns(manifest_path)[0]
+
+    manifest_df = io_utils.read_table(
+        manifest_path, columns=[site_key_utils.SITE_KEY_COLUMN, split_column]
+    )
+    keys = manifest_df.loc[manifest_df[split_column] == label, site_key_utils.SITE_KEY_COLUMN].to_numpy()
+    # The plates of the split, so pooled tables only yield the row groups that can match
+    plates = site_key_utils.key_plates(keys)
+
+    if columns is not None:
+        site_columns = [site_key_utils.PLATE_COLUMN, site_key_utils.WELL_COLUMN, site_key_utils.SITE_COLUMN]
+        columns = list(dict.fromkeys(columns + site_columns))
+
+    split_dfs = []
+    for path in io_utils.list_tables(loaddata_dir):
+        df = io_utils.read_table(
+            path, columns=columns, filters={site_key_utils.PLATE_COLUMN: plates}
+        )
+        split_dfs.append(df[site_key_utils.site_keys(df).isin(keys)])
+    split_df = pd.concat(split_dfs, ignore_index=True)
+
+    if metadata_df is not None:
+        split_df = metadata_utils.attach_conditions(
+            split_df, metadata_df, columns=condition_columns
+        ).reset_index(drop=True)
+    return split_df
+
+
+def stream_split_manifest(
+    loaddata_files: list[pathlib.Path],
+    metadata_df: pd.DataFrame,
+    train_conditions: dict,
+    output_dir: pathlib.Path,
+    exclude_df: pd.DataFrame | None = None,
+    seeds: tuple[int, ...] | list[int] = DEFAULT_SEEDS,
+    n_heldout_wells: int = 1,
+    n_folds: int | None = None,
+    write_split_tables: bool = False,
+    file_format: str = "csv",
+    previous_manifest_df: pd.DataFrame | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Build the split manifest one pooled LoadData table (one barcode) at a time, so that memory holds
+    one table plus a few compact columns per site however many plates the batch has.
+
+    The first pass reads only the plate, well and site columns of each table, attaches the train
+    conditions, removes the excluded sites and keeps the site columns and conditions. The wells are
+    split from those compact columns, giving the same manifest as splitting the whole batch in memory.
+    If `write_split_tables` is set, a second pass reads each table in full and appends its rows of the
+    first split to the `loaddata_train`, `loaddata_heldout` and `loaddata_eval` tables.
+
+    Parameters
+    ----------
+    loaddata_files : list[pathlib.Path]
+        pooled LoadData tables
+    metadata_df : pd.DataFrame
+        table from `metadata_utils.load_platemap_metadata`
+    train_conditions : dict
+        condition column to a value or list of values selecting the train data, see `condition_mask`
+    output_dir : pathlib.Path
+        folder of the split manifest and split tables
+    exclude_df : pd.DataFrame | None
+        plate, well and site of the sites to remove, e.g. the QC exclusion table
+    seeds : tuple[int, ...] | list[int]
+        split seeds, see `assign_splits`
+    n_heldout_wells : int
+        number of wells held out per condition, see `assign_splits`
+    n_folds : int | None
+        number of folds, see `assign_splits`
+    write_split_tables : bool
+        also write full LoadData tables of the first split
+    file_format : str
+        "csv" or "parquet"
+    previous_manifest_df : pd.DataFrame | None
+        split manifest of a previous run whose labels are kept for unchanged conditions, see
+        `load_previous_manifest` and `update_splits`
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        the split manifest, and the compact train rows it was split from (site columns, conditions
+        and one label column per split)
+    """
+    site_columns = [site_key_utils.PLATE_COLUMN, site_key_utils.WELL_COLUMN, site_key_utils.SITE_COLUMN]
+    condition_columns = list(train_conditions)
+
+    def select_sites(df: pd.DataFrame, columns: list[str]) -> tuple[pd.DataFrame, np.ndarray]:
+        df = metadata_utils.attach_conditions(df, metadata_df, columns=columns)
+        if exclude_df is not None:
+            df = site_key_utils.exclude_sites(df, exclude_df)
+        return df, condition_mask(df, train_conditions, strict=False).to_numpy()
+
+    train_chunks, eval_chunks = [], []
+    for path in loaddata_files:
+        with instrument_utils.record_step("split", step="read_sites", plate=path.stem) as record:
+            sites_df, train_mask = select_sites(io_utils.read_table(path, columns=site_columns), condition_columns)
+            train_chunks.append(sites_df[train_mask])
+            eval_chunks.append(sites_df.loc[~train_mask, site_columns])
+            record.update(rows_in=len(sites_df), bytes_in=instrument_utils.file_bytes(path))
+
+    train_df = pd.concat(train_chunks, ignore_index=True)
+    eval_df = pd.concat(eval_chunks, ignore_index=True)
+    if train_df.empty:
+        raise ValueError(f"No data found for {train_conditions}")
+    if previous_manifest_df is None:
+        split_labels = assign_splits(
+            train_df, condition_columns, seeds=seeds, n_heldout_wells=n_heldout_wells, n_folds=n_folds
+        )
+    else:
+        split_labels, _ = update_splits(
+            train_df, condition_columns, previous_manifest_df, metadata_df,
+            seeds=seeds, n_heldout_wells=n_heldout_wells, n_folds=n_folds,
+        )
+    manifest_df = build_split_manifest(train_df, split_labels, eval_df)
+    io_utils.write_table(manifest_df, output_dir / "split_manifest", file_format=file_format)
+    write_split_params(split_params(train_conditions, seeds, n_heldout_wells, n_folds), output_dir / "split_manifest")
+
+    if write_split_tables:
+        # Labels of the first split, looked up by site key for every chunk
+        key_index = pd.Index(manifest_df[site_key_utils.SITE_KEY_COLUMN])
+        first_labels = manifest_df[split_labels.columns[0]].to_numpy()
+        writers = {
+            label: io_utils.TableWriter(output_dir / f"loaddata_{label}", file_format=file_format)
+            for label in SPLIT_LABELS
+        }
+        for path in loaddata_files:
+            with instrument_utils.record_step("split", step="write_tables", plate=path.stem) as record:
+                loaddata_df, _ = select_sites(io_utils.read_table(path), metadata_utils.CONDITION_COLUMNS)
+                positions = key_index.get_indexer(site_key_utils.site_keys(loaddata_df))
+                labels = np.where(positions >= 0, first_labels[positions], None)
+                for label, writer in writers.items():
+                    writer.write(loaddata_df[labels == label])
+                record.update(rows_in=len(loaddata_df), bytes_in=instrument_utils.file_bytes(path))
+        for writer in writers.values():
+            writer.close()
+
+    return manifest_df, train_df.assign(**{c: split_labels[c] for c in split_labels.columns})
+
+
+def run_split(
+    loaddata_files: list[pathlib.Path],
+    metadata_df: pd.DataFrame,
+    train_conditions: dict,
+    output_dir: pathlib.Path,
+    exclude_df: pd.DataFrame | None = None,
+    seeds: tuple[int, ...] | list[int] = DEFAULT_SEEDS,
+    n_heldout_wells: int = 1,
+    n_folds: int | None = None,
+    write_split_tables: bool = False,
+    file_format: str = "csv",
+    delta: bool = False,
+    streaming: bool = False,
+) -> pd.DataFrame:
+    """
+    Split the pooled LoadData of a batch and save the split manifest and its parameters, shared by
+    `4.datasplit.py` and the split stage of the pipeline runner
+
+    Parameters
+    ----------
+    loaddata_files : list[pathlib.Path]
+        pooled LoadData tables
+    metadata_df : pd.DataFrame
+        table from `metadata_utils.load_platemap_metadata`
+    train_conditions : dict
+        condition column to a value or list of values selecting the train data, see `condition_mask`
+    output_dir : pathlib.Path
+        folder of the split manifest and split tables
+    exclude_df : pd.DataFrame | None
+        plate, well and site of the sites to remove, e.g. the QC exclusion table
+    seeds : tuple[int, ...] | list[int]
+        split seeds, see `assign_splits`
+    n_heldout_wells : int
+        number of wells held out per condition, see `assign_splits`
+    n_folds : int | None
+        number of folds, see `assign_splits`
+    write_split_tables : bool
+        also write full LoadData tables of the first split as `loaddata_train`, `loaddata_heldout` and `loaddata_eval`
+    file_format : str
+        "csv" or "parquet"
+    delta : bool
+        keep the labels of the previous manifest for every condition whose wells did not change, see `update_splits`
+    streaming : bool
+        read one pooled table at a time for batches that don't fit in memory, see `stream_split_manifest`
+
+    Returns
+    -------
+    pd.DataFrame
+        the split manifest
+    """
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    condition_columns = list(train_conditions)
+    split_kwargs = {"seeds": seeds, "n_heldout_wells": n_heldout_wells, "n_folds": n_folds}
+
+    # The previous manifest is read before it is overwritten and only kept if drawn with the same parameters
+    params = split_params(train_conditions, **split_kwargs)
+    previous_manifest_df = None
+    if delta:
+        previous_manifest_df = load_previous_manifest(output_dir / "split_manifest", params)
+
+    if streaming:
+        manifest_df, train_df = stream_split_manifest(
+            loaddata_files,
+            metadata_df,
+            train_conditions,
+            output_dir,
+            exclude_df=exclude_df,
+            **split_kwargs,
+            write_split_tables=write_split_tables,
+            file_format=file_format,
+            previous_manifest_df=previous_manifest_df,
+        )
+        split_labels = train_df[[c for c in train_df.columns if c.startswith(SPLIT_COLUMN_PREFIX)]]
+    else:
+        with instrument_utils.record_step("split", step="read") as record:
+            loaddata_df = pd.concat([io_utils.read_table(f) for f in loaddata_files], ignore_index=True)
+            record.update(rows_in=len(loaddata_df), bytes_in=instrument_utils.file_bytes(loaddata_files))
+
+        # Wells missing from the LoadData or the platemaps are dropped
+        with instrument_utils.record_step("split", step="merge") as record:
+            df = metadata_utils.attach_conditions(loaddata_df, metadata_df).reset_index(drop=True)
+            record.update(rows_in=len(loaddata_df), rows_out=len(df))
+
+        if exclude_df is not None:
+            with instrument_utils.record_step("split", step="exclude") as record:
+                record["rows_in"] = len(df)
+                df = site_key_utils.exclude_sites(df, exclude_df)
+                record["rows_out"] = len(df)
+            print(f"{record['rows_in'] - record['rows_out']} excluded sites removed, {len(df)} sites left")
+
+        train_mask = condition_mask(df, train_conditions)
+        train_df, eval_df = df[train_mask], df[~train_mask]
+
+        # Hold out wells within each condition, one label column per seed and fold
+        with instrument_utils.record_step("split", step="split") as record:
+            if previous_manifest_df is None:
+                split_labels = assign_splits(train_df, condition_columns, **split_kwargs)
+            else:
+                split_labels, changed_conditions = update_splits(
+                    train_df, condition_columns, previous_manifest_df, metadata_df, **split_kwargs
+                )
+                for condition in changed_conditions.itertuples(index=False, name=None):
+                    print(f"Re-drawn condition: {dict(zip(condition_columns, condition))}")
+            record.update(rows_in=len(train_df), rows_out=len(split_labels))
+
+        # One row per site with its key and split labels, splits are read back with `read_split`
+        with instrument_utils.record_step("split", step="write") as record:
+            manifest_df = build_split_manifest(train_df, split_labels, eval_df)
+            output_paths = [io_utils.write_table(manifest_df, output_dir / "split_manifest", file_format=file_format)]
+            write_split_params(params, output_dir / "split_manifest")
+
+            if write_split_tables:
+                # Full LoadData copies of the first split, for consumers that do not read the manifest yet
+                heldout_mask = (split_labels.iloc[:, 0] == HELDOUT_LABEL).to_numpy()
+                output_paths += [
+                    io_utils.write_table(train_df[heldout_mask], output_dir / "loaddata_heldout", file_format=file_format),
+                    io_utils.write_table(train_df[~heldout_mask], output_dir / "loaddata_train", file_format=file_format),
+                    io_utils.write_table(eval_df, output_dir / "loaddata_eval", file_format=file_format),
+                ]
+            record.update(rows_out=len(manifest_df), bytes_out=instrument_utils.file_bytes(output_paths))
+
+    n_eval = int((manifest_df[split_labels.columns[0]] == EVAL_LABEL).sum())
+    print(f"{len(train_df)} sites for train and heldout, {n_eval} sites for evaluation")
+    for split_column in split_labels.columns:
+        heldout_mask = (split_labels[split_column] == HELDOUT_LABEL).to_numpy()
+        heldout_wells = train_df[heldout_mask].groupby(condition_columns, observed=True)["Metadata_Well"].unique()
+        for condition, wells in heldout_wells.items():
+            condition = condition if isinstance(condition, tuple) else (condition,)
+            print(f"{split_column} for condition {dict(zip(condition_columns, condition))}: heldout wells {list(wells)}")
+        print(f"{split_column}: {heldout_mask.sum()} sites heldout, {(~heldout_mask).sum()} sites for training")
+    print(f"Split manifest with {len(manifest_df)} sites and {split_labels.shape[1]} splits saved to {output_dir}")
+    return manifest_df
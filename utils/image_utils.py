@@ -0,0 +1,283 @@
+"""
+This file contains functions to validate the images referenced by the `PathName_*`/`FileName_*`
+columns of LoadData tables before they reach a dataset: every file is stat-ed and its TIFF header read
+(dimensions, bit depth and whether the strips or tiles fit in the file) in a thread pool. The results
+are cached in an index keyed by path, modification time and size, so re-validation only reads the
+headers of changed files.
+"""
+
+
+import os
+import pathlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# Baseline TIFF tags read from the first IFD
+TIFF_TAGS = {
+    256: "width",
+    257: "height",
+    258: "bits_per_sample",
+    277: "samples_per_pixel",
+    273: "strip_offsets",
+    279: "strip_byte_counts",
+    324: "tile_offsets",
+    325: "tile_byte_counts",
+}
+
+# TIFF field type to struct format, only the integer types used by the tags above
+TIFF_TYPES = {1: "B", 3: "H", 4: "I", 16: "Q"}
+
+IMAGE_INDEX_COLUMNS = [
+    "path", "mtime_ns", "size", "status", "width", "height", "bits_per_sample", "samples_per_pixel"
+]
+
+# Statuses of an image, every status but "ok" makes its site invalid
+IMAGE_STATUSES = ["ok", "missing", "empty", "not_tiff", "truncated", "unexpected_shape"]
+
+
+def read_tiff_header(path: pathlib.Path) -> dict:
+    """
+    Read the dimensions and bit depth of a classic or BigTIFF file from its first IFD
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the TIFF file
+
+    Returns
+    -------
+    dict
+        the `width`, `height`, `bits_per_sample`, `samples_per_pixel` and `data_end`, the offset of
+        the end of the last strip or tile
+    """
+    with open(path, "rb") as f:
+        head = f.read(16)
+        if head[:2] == b"II":
+            byte_order = "<"
+        elif head[:2] == b"MM":
+            byte_order = ">"
+        else:
+            raise ValueError(f"{path} is not a TIFF file")
+
+        magic = struct.unpack(byte_order + "H", head[2:4])[0]
+        # Classic TIFF uses 2-byte entry counts and 4-byte value counts and offsets, BigTIFF 8-byte ones
+        if magic == 42:
+            ifd_offset = struct.unpack(byte_order + "I", head[4:8])[0]
+            n_entries_format, offset_format = "H", "I"
+        elif magic == 43:
+            ifd_offset = struct.unpack(byte_order + "Q", head[8:16])[0]
+            n_entries_format, offset_format = "Q", "Q"
+        else:
+            raise ValueError(f"{path} is not a TIFF file")
+        offset_size = struct.calcsize(offset_format)
+        entry_size = 4 + 2 * offset_size
+
+        f.seek(ifd_offset)
+        n_entries_size = struct.calcsize(n_entries_format)
+        n_entries = struct.unpack(byte_order + n_entries_format, f.read(n_entries_size))[0]
+        entries = f.read(n_entries * entry_size)
+        if len(entries) < n_entries * entry_size:
+            raise ValueError(f"{path} has a truncated IFD")
+
+        fields = {}
+        for i in range(n_entries):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = struct.unpack(byte_order + "HH", entry[:4])
+            if tag not in TIFF_TAGS or field_type not in TIFF_TYPES:
+                continue
+            n_values = struct.unpack(byte_order + offset_format, entry[4:4 + offset_size])[0]
+            value_format = f"{byte_order}{n_values}{TIFF_TYPES[field_type]}"
+            value_size = struct.calcsize(value_format)
+            data = entry[4 + offset_size:]
+            # Values that don't fit in the entry are stored at the offset it holds
+            if value_size > offset_size:
+                f.seek(struct.unpack(byte_order + offset_format, data)[0])
+                data = f.read(value_size)
+                if len(data) < value_size:
+                    raise ValueError(f"{path} has a truncated IFD")
+            fields[TIFF_TAGS[tag]] = struct.unpack(value_format, data[:value_size])
+
+    offsets = fields.get("strip_offsets", fields.get("tile_offsets", ()))
+    byte_counts = fields.get("strip_byte_counts", fields.get("tile_byte_counts", ()))
+    return {
+        "width": fields["width"][0],
+        "height": fields["height"][0],
+        "bits_per_sample": fields.get("bits_per_sample", (1,))[0],
+        "samples_per_pixel": fields.get("samples_per_pixel", (1,))[0],
+        "data_end": max((o + c for o, c in zip(offsets, byte_counts)), default=0),
+    }
+
+
+def validate_image(path: str) -> dict:
+    """
+    Stat an image and read its TIFF header
+
+    Parameters
+    ----------
+    path : str
+        path to the image
+
+    Returns
+    -------
+    dict
+        one row of the image index, see `IMAGE_INDEX_COLUMNS`
+    """
+    record = {column: None for column in IMAGE_INDEX_COLUMNS}
+    record["path"] = path
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        record["status"] = "missing"
+        return record
+
+    record.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    if stat.st_size == 0:
+        record["status"] = "empty"
+        return record
+    try:
+        header = read_tiff_header(path)
+    except (ValueError, KeyError, struct.error):
+        record["status"] = "not_tiff"
+        return record
+
+    record.update({k: v for k, v in header.items() if k in record})
+    record["status"] = "truncated" if header["data_end"] > stat.st_size else "ok"
+    return record
+
+
+def _stat(path: str) -> tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_mtime_ns, stat.st_size
+
+
+def image_paths(loaddata_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the path of every image of a LoadData table, one row per site and channel
+
+    Parameters
+    ----------
+    loaddata_df : pd.DataFrame
+        LoadData table with `PathName_{channel}` and `FileName_{channel}` columns
+
+    Returns
+    -------
+    pd.DataFrame
+        the `Metadata_Plate`, `Metadata_Well`, `Metadata_Site`, `Channel` and `path` of every image
+    """
+    channels = [c[len("FileName_"):] for c in loaddata_df.columns if c.startswith("FileName_")]
+    channels = [channel for channel in channels if f"PathName_{channel}" in loaddata_df.columns]
+    site_columns = ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+
+    paths = [
+        loaddata_df[f"PathName_{channel}"].astype(str).str.rstrip("/") + "/" + loaddata_df[f"FileName_{channel}"].astype(str)
+        for channel in channels
+    ]
+    return pd.DataFrame({
+        **{column: np.tile(loaddata_df[column].to_numpy(), len(channels)) for column in site_columns},
+        "Channel": pd.Categorical(np.repeat(channels, len(loaddata_df)), categories=channels),
+        "path": np.concatenate([p.to_numpy() for p in paths]) if paths else np.array([], dtype=object),
+    })
+
+
+def validate_images(
+    paths: list[str],
+    index_path: pathlib.Path | None = None,
+    n_workers: int = 32,
+) -> pd.DataFrame:
+    """
+    Validate many images in a thread pool, reading only the headers of images that changed since
+    they were last indexed
+
+    Parameters
+    ----------
+    paths : list[str]
+        paths to the images
+    index_path : pathlib.Path | None
+        path to the cached Parquet image index, None validates every image
+    n_workers : int
+        number of files stat-ed or read at the same time
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per unique path, see `IMAGE_INDEX_COLUMNS`
+    """
+    paths = pd.unique(pd.Series(paths, dtype=object))
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        stats = np.array(list(executor.map(_stat, paths)), dtype=np.int64).reshape(-1, 2)
+
+        cached_df = pd.DataFrame(columns=IMAGE_INDEX_COLUMNS)
+        if index_path is not None and index_path.exists():
+            cached_df = pd.read_parquet(index_path)
+        cached_df = cached_df.set_index("path").reindex(paths)
+
+        # A cached result is reused when the file still exists with the same mtime and size
+        unchanged = (
+            (stats[:, 0] >= 0)
+            & (cached_df["mtime_ns"].astype("Int64").fillna(-2).to_numpy(dtype=np.int64) == stats[:, 0])
+            & (cached_df["size"].astype("Int64").fillna(-2).to_numpy(dtype=np.int64) == stats[:, 1])
+        )
+        # Object dtype keeps the nanosecond mtimes exact, a float column would round them
+        changed_df = pd.DataFrame(
+            list(executor.map(validate_image, paths[~unchanged])), columns=IMAGE_INDEX_COLUMNS, dtype=object
+        )
+
+    index_df = pd.concat(
+        [cached_df[unchanged].reset_index(names="path"), changed_df], ignore_index=True
+    )[IMAGE_INDEX_COLUMNS]
+    index_df = index_df.astype({
+        "mtime_ns": "Int64", "size": "Int64", "width": "Int64", "height": "Int64",
+        "bits_per_sample": "Int64", "samples_per_pixel": "Int64",
+    })
+    print(f"Validated {len(changed_df)} new or changed images, reused {int(unchanged.sum())} cached results")
+
+    if index_path is not None:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        index_df.to_parquet(index_path, index=False)
+    return index_df
+
+
+def invalid_images(image_df: pd.DataFrame, index_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the images that are missing, unreadable, truncated or whose shape or bit depth differs from
+    the most common one of their channel
+
+    Parameters
+    ----------
+    image_df : pd.DataFrame
+        images of the sites, from `image_paths`
+    index_df : pd.DataFrame
+        image index from `validate_images`
+
+    Returns
+    -------
+    pd.DataFrame
+        the rows of `image_df` with a bad image, with the `status`, `width`, `height` and `bits_per_sample`
+    """
+    df = image_df.merge(
+        index_df[["path", "status", "width", "height", "bits_per_sample"]], on="path", how="left"
+    )
+    shape_columns = ["width", "height", "bits_per_sample"]
+    ok = df["status"] == "ok"
+    if ok.any():
+        expected = (
+            df[ok].groupby(["Channel"] + shape_columns, observed=True).size()
+            .reset_index(name="n").sort_values("n").drop_duplicates("Channel", keep="last")
+        )
+        df = df.merge(expected[["Channel"] + shape_columns].rename(
+            columns={c: f"expected_{c}" for c in shape_columns}
+        ), on="Channel", how="left")
+        # Only ok images have a shape, the others are -1 on both sides and never mismatch
+        actual = df[shape_columns].fillna(-1).to_numpy(dtype=np.int64)
+        expected = df[[f"expected_{c}" for c in shape_columns]].fillna(-1).to_numpy(dtype=np.int64)
+        mismatch = ok & (actual != expected).any(axis=1)
+        df.loc[mismatch, "status"] = "unexpected_shape"
+        df = df.drop(columns=[f"expected_{c}" for c in shape_columns])
+    return df[df["status"] != "ok"].reset_index(drop=True)
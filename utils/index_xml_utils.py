@@ -0,0 +1,289 @@
+"""
+This file contains an in-process engine that converts a Harmony `Index.idx.xml` file into a
+LoadData table, following the same channel, metadata and column conventions as pe2loaddata.
+The index file is read with an incremental parser that keeps only the fields needed for the
+LoadData rows, so memory stays bounded on very large plates.
+"""
+
+
+import csv
+import os
+import pathlib
+import xml.etree.ElementTree as ET
+from collections.abc import Iterator
+
+import pandas as pd
+import yaml
+
+
+# Bumped whenever the output of this engine changes so that cached LoadData csvs are regenerated
+ENGINE_VERSION = "1"
+
+# Image fields needed to assemble rows in addition to the requested metadata
+_IMAGE_FIELDS = ("URL", "FieldID", "PlaneID", "TimepointID", "ChannelID", "ChannelName")
+
+
+def load_loaddata_config(config_path: pathlib.Path) -> tuple[dict, dict, dict]:
+    """
+    Load the channel and metadata mappings from a pe2loaddata config file
+
+    Parameters
+    ----------
+    config_path : pathlib.Path
+        path to the `config.yml' file with the `channels`, `channelid` and `metadata` mappings
+
+    Returns
+    -------
+    tuple[dict, dict, dict]
+        channel name (without spaces) to LoadData channel name, channel id to LoadData channel name,
+        and metadata key to metadata name
+    """
+    with open(config_path, "r") as f:
+        config = yaml.load(f, Loader=yaml.BaseLoader)
+
+    if isinstance(config, list):
+        config = config[0]
+
+    # Strip spaces because the channel names in the index file are compared without them
+    channels = {
+        str(k).replace(" ", ""): v for k, v in (config.get("channels") or {}).items()
+    }
+    channelid = {str(k): v for k, v in (config.get("channelid") or {}).items()}
+    metadata = config.get("metadata") or {}
+
+    if not channels and not channelid:
+        raise ValueError(f"No `channels` or `channelid` mapping found in {config_path}")
+
+    return channels, channelid, metadata
+
+
+def _local_name(tag: str) -> str:
+    """Strip the xml namespace from a tag"""
+    return tag.rpartition("}")[2]
+
+
+def _child_text(elem: ET.Element) -> dict:
+    """Map the local names of the direct children of an element to their stripped text"""
+    return {_local_name(child.tag): (child.text or "").strip() for child in elem}
+
+
+def parse_index_file(index_file: pathlib.Path, metadata_keys: list[str]) -> tuple[dict, dict, dict, dict]:
+    """
+    Incrementally parse a Harmony index file, keeping only what is needed for the LoadData rows
+
+    Parameters
+    ----------
+    index_file : pathlib.Path
+        path to the `Index.idx.xml` file
+    metadata_keys : list[str]
+        image metadata fields requested by the config file
+
+    Returns
+    -------
+    tuple[dict, dict, dict, dict]
+        plate name to well ids, well id to (well name, image ids), image id to image fields,
+        and channel id to the channel fields from the `Maps` section
+    """
+    image_fields = set(_IMAGE_FIELDS) | set(metadata_keys)
+
+    plates, wells, images, maps = {}, {}, {}, {}
+    stack = []
+    for event, elem in ET.iterparse(index_file, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        name = _local_name(elem.tag)
+        parent = _local_name(stack[-1].tag) if stack else None
+
+        if name == "Image" and parent == "Images":
+            fields = _child_text(elem)
+            images[fields["id"]] = {k: v for k, v in fields.items() if k in image_fields}
+        elif name == "Well" and parent == "Wells":
+            fields = _child_text(elem)
+            well_name = chr(ord("A") + int(fields["Row"]) - 1) + "%02d" % int(fields["Col"])
+            image_ids = [child.get("id") for child in elem if _local_name(child.tag) == "Image"]
+            wells[fields["id"]] = (well_name, image_ids)
+        elif name == "Plate" and parent == "Plates":
+            fields = _child_text(elem)
+            plates[fields.get("Name")] = [
+                child.get("id") for child in elem if _local_name(child.tag) == "Well"
+            ]
+        elif name == "Entry" and parent == "Map":
+            maps.setdefault(elem.get("ChannelID"), {}).update(_child_text(elem))
+        else:
+            continue
+
+        # Drop the element from the tree once consumed so the parsed document never accumulates
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+    return plates, wells, images, maps
+
+
+def iter_loaddata_rows(
+    index_directory: pathlib.Path,
+    config_path: pathlib.Path,
+) -> Iterator[list[str]]:
+    """
+    Generate the LoadData header followed by one row per complete field of view
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the folder containing the `Index.idx.xml` file and the images for the plate
+    config_path : pathlib.Path
+        path to the `config.yml' file with the `channels`, `channelid` and `metadata` mappings
+
+    Yields
+    ------
+    list[str]
+        the header, then the values of each row
+    """
+    index_directory = pathlib.Path(index_directory)
+    index_files = sorted(index_directory.glob("Index*xml"))
+    if not index_files:
+        raise FileNotFoundError(f"No Index*xml file found in {index_directory}")
+
+    channels, channelid, metadata = load_loaddata_config(config_path)
+    metadata_keys = sorted(metadata.keys())
+    plates, wells, images, maps = parse_index_file(index_files[0], metadata_keys)
+
+    # Channels are identified by name when the config lists them, otherwise by channel id (Harmony v7)
+    channel_map = channels if channels else channelid
+    # Channel ids are sorted as numbers like pe2loaddata does, so channel 10 comes after channel 2
+    channel_keys = sorted(channel_map.keys()) if channels else sorted(channel_map.keys(), key=int)
+    # Per-channel metadata columns follow the order of the config file rather than the sorted order
+    config_keys = list(channel_map.keys())
+
+    def resolve(image: dict) -> tuple[str, dict]:
+        channel_fields = maps.get(image.get("ChannelID"), {})
+        values = {key: image.get(key, channel_fields.get(key, "")) for key in metadata_keys}
+        if channels:
+            key = (image.get("ChannelName") or channel_fields.get("ChannelName", "")).replace(" ", "")
+        else:
+            key = image.get("ChannelID")
+        return key, values
+
+    def group_fields(image_ids: list[str]) -> dict:
+        fields = {}
+        for image_id in image_ids:
+            image = images.get(image_id)
+            if image is None:
+                continue
+            key, values = resolve(image)
+            if key not in channel_map:
+                continue
+            # FieldID, PlaneID and TimepointID together identify every image of multi-Z and multi-T experiments
+            field_id = (
+                int(image["FieldID"]),
+                int(image.get("PlaneID", 1)),
+                int(image.get("TimepointID", 1)),
+            )
+            fields.setdefault(field_id, {})[key] = (image["URL"], values)
+        return fields
+
+    # Metadata that differs between channels gets one column per channel, decided on the first complete field
+    per_channel_keys = set()
+    for well_id in next(iter(plates.values()), []):
+        complete = [
+            d for d in group_fields(wells[well_id][1]).values() if len(d) == len(channel_keys)
+        ]
+        if complete:
+            sample = complete[0]
+            per_channel_keys = {
+                k for k in metadata_keys if len({sample[c][1][k] for c in channel_keys}) > 1
+            }
+            break
+
+    header = sum(
+        [[f"FileName_{channel_map[c]}", f"PathName_{channel_map[c]}"] for c in channel_keys], []
+    )
+    header += ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+    for k in metadata_keys:
+        if k in per_channel_keys:
+            header += [f"Metadata_{k}_{channel_map[c]}" for c in config_keys]
+        else:
+            header.append(f"Metadata_{k}")
+    yield header
+
+    # Like pe2loaddata, fields with a missing channel or image file are left out
+    available_files = set(os.listdir(index_directory))
+    path_name = str(index_directory)
+
+    for plate_name in sorted(plates):
+        for well_id in plates[plate_name]:
+            well_name, image_ids = wells[well_id]
+            fields = group_fields(image_ids)
+            for field_id in sorted(fields):
+                d = fields[field_id]
+                if any(c not in d or d[c][0] not in available_files for c in channel_keys):
+                    continue
+
+                row = sum([[d[c][0], path_name] for c in channel_keys], [])
+                row += [plate_name, well_name, str(field_id[0])]
+                for k in metadata_keys:
+                    if k in per_channel_keys:
+                        row += [d[c][1][k] for c in config_keys]
+                    else:
+                        row.append(d[channel_keys[0]][1][k])
+                yield row
+
+
+def write_loaddata_csv(
+    index_directory: pathlib.Path,
+    config_path: pathlib.Path,
+    path_to_output: pathlib.Path,
+):
+    """
+    Stream the LoadData rows for a plate straight to a csv file
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the folder containing the `Index.idx.xml` file and the images for the plate
+    config_path : pathlib.Path
+        path to the `config.yml' file with the `channels`, `channelid` and `metadata` mappings
+    path_to_output : pathlib.Path
+        path to the LoadData csv to create
+    """
+    path_to_output = pathlib.Path(path_to_output)
+    path_to_output.parent.mkdir(parents=True, exist_ok=True)
+    with open(path_to_output, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerows(iter_loaddata_rows(index_directory, config_path))
+
+
+def create_loaddata_df(
+    index_directory: pathlib.Path,
+    config_path: pathlib.Path,
+) -> pd.DataFrame:
+    """
+    Create the LoadData table for a plate as a DataFrame, typed as if read back from the csv
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the folder containing the `Index.idx.xml` file and the images for the plate
+    config_path : pathlib.Path
+        path to the `config.yml' file with the `channels`, `channelid` and `metadata` mappings
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per field of view with the FileName/PathName columns of each channel and the metadata
+    """
+    rows = iter_loaddata_rows(index_directory, config_path)
+    header = next(rows)
+    loaddata_df = pd.DataFrame(list(rows), columns=header)
+
+    for column in loaddata_df.columns:
+        if column.startswith("Metadata_"):
+            try:
+                loaddata_df[column] = pd.to_numeric(loaddata_df[column])
+            except (ValueError, TypeError):
+                pass
+
+    return loaddata_df
@@ -0,0 +1,189 @@
+"""
+This file contains a lightweight instrumentation layer recording the wall time, peak resident memory
+and the rows and bytes read and written by each stage, and by each plate within a stage, so that a
+run report can show which plates or stages regress as batches grow.
+
+Steps are recorded with the `record_step` context manager into a process-wide list of records, which
+`write_run_report` writes as json or Parquet at the end of a run.
+"""
+
+
+import datetime
+import json
+import pathlib
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from collections.abc import Iterator
+
+import pandas as pd
+
+
+RECORD_COLUMNS = [
+    "stage",
+    "step",
+    "plate",
+    "status",
+    "wall_s",
+    "peak_rss_mb",
+    "rows_in",
+    "rows_out",
+    "bytes_in",
+    "bytes_out",
+]
+
+# Records of every step of the current process, in the order the steps finished
+RUN_RECORDS: list[dict] = []
+
+
+def peak_rss_mb() -> float:
+    """
+    Get the peak resident memory of this process and its finished child processes
+
+    Returns
+    -------
+    float
+        the larger of the two high-water marks in MiB
+    """
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def file_bytes(paths: pathlib.Path | list[pathlib.Path]) -> int:
+    """
+    Get the total size of files, missing files count as empty
+
+    Parameters
+    ----------
+    paths : pathlib.Path | list[pathlib.Path]
+        one or more file paths
+
+    Returns
+    -------
+    int
+        total size in bytes
+    """
+    paths = [paths] if isinstance(paths, (str, pathlib.Path)) else paths
+    return sum(pathlib.Path(path).stat().st_size for path in paths if pathlib.Path(path).is_file())
+
+
+def add_record(record: dict, records: list[dict] = RUN_RECORDS):
+    """
+    Add a record measured elsewhere, e.g. in a worker process, keeping only the known columns
+
+    Parameters
+    ----------
+    record : dict
+        record with some of the `RECORD_COLUMNS`
+    records : list[dict]
+        list the record is appended to
+    """
+    records.append({column: record.get(column) for column in RECORD_COLUMNS})
+
+
+@contextmanager
+def record_step(
+    stage: str,
+    step: str | None = None,
+    plate: str | None = None,
+    records: list[dict] = RUN_RECORDS,
+) -> Iterator[dict]:
+    """
+    Record the wall time and peak memory of a block, the block fills in the rows and bytes it handled
+
+    Parameters
+    ----------
+    stage : str
+        pipeline stage, e.g. "pool"
+    step : str | None
+        step within the stage, e.g. "read"
+    plate : str | None
+        plate or barcode the step processed, None for a step over the whole batch
+    records : list[dict]
+        list the record is appended to when the block exits
+
+    Yields
+    ------
+    dict
+        the record, set its `rows_in`, `rows_out`, `bytes_in` and `bytes_out` inside the block
+    """
+    record = {column: None for column in RECORD_COLUMNS}
+    record.update(stage=stage, step=step, plate=plate, status="success")
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "failed"
+        raise
+    finally:
+        record["wall_s"] = time.perf_counter() - start
+        record["peak_rss_mb"] = peak_rss_mb()
+        records.append(record)
+
+
+def run_report(records: list[dict] = RUN_RECORDS) -> pd.DataFrame:
+    """
+    Get the recorded steps as a table
+
+    Parameters
+    ----------
+    records : list[dict]
+        recorded steps
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per step with the `RECORD_COLUMNS`
+    """
+    return pd.DataFrame(records, columns=RECORD_COLUMNS).astype(
+        {column: "Int64" for column in ["rows_in", "rows_out", "bytes_in", "bytes_out"]}
+    )
+
+
+def write_run_report(
+    path: pathlib.Path,
+    batch: str | None = None,
+    records: list[dict] = RUN_RECORDS,
+) -> pathlib.Path:
+    """
+    Write the recorded steps of a run as json (with the run metadata) or Parquet (the steps only)
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path of the report, a `.parquet` suffix writes Parquet, anything else json
+    batch : str | None
+        batch name stored with the run metadata
+    records : list[dict]
+        recorded steps
+
+    Returns
+    -------
+    pathlib.Path
+        path of the written report
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    report_df = run_report(records)
+    if path.suffix == ".parquet":
+        report_df.to_parquet(path, index=False)
+        return path
+
+    report = {
+        "batch": batch,
+        "written_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "peak_rss_mb": peak_rss_mb(),
+        # Round-trip through pandas json so numpy and missing values serialize
+        "steps": json.loads(report_df.to_json(orient="records")),
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
@@ -0,0 +1,247 @@
+"""
+This file contains functions to compute per-(plate, channel) intensity statistics of the images of
+pooled LoadData tables, so normalization can look up precomputed constants instead of using a fixed
+factor or scanning images at training time.
+
+Every 16-bit image is reduced to a histogram with one bin per intensity value, and histograms are
+summed per plate and channel, so memory is bounded by the number of plates and channels however
+many images there are, and the percentiles, mean and std derived from the summed histograms are exact.
+"""
+
+
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import image_utils, io_utils, tensor_store_utils
+
+
+# One bin per uint16 intensity value
+N_BINS = 2**16
+
+DEFAULT_PERCENTILES = [0.1, 1, 50, 99, 99.9]
+
+GROUP_COLUMNS = ["Metadata_Plate", "Channel"]
+
+
+def image_histogram(path: str) -> np.ndarray:
+    """
+    Get the intensity histogram of a 16-bit image
+
+    Parameters
+    ----------
+    path : str
+        path to the image
+
+    Returns
+    -------
+    np.ndarray
+        int64 count of every intensity value, of length `N_BINS`
+    """
+    image = tensor_store_utils.read_image(path)
+    return np.bincount(image.ravel(), minlength=N_BINS)
+
+
+def histogram_statistics(histogram: np.ndarray, percentiles: list[float] = DEFAULT_PERCENTILES) -> dict:
+    """
+    Derive summary statistics from an intensity histogram
+
+    Parameters
+    ----------
+    histogram : np.ndarray
+        count of every intensity value
+    percentiles : list[float]
+        percentiles to compute, in [0, 100]
+
+    Returns
+    -------
+    dict
+        the `n_pixels`, `min`, `max`, `mean`, `std` and a `p{q}` entry per percentile
+    """
+    n_pixels = int(histogram.sum())
+    if n_pixels == 0:
+        return {"n_pixels": 0, **{k: np.nan for k in ["min", "max", "mean", "std"] + [f"p{q:g}" for q in percentiles]}}
+
+    values = np.arange(len(histogram), dtype=np.float64)
+    mean = float((histogram * values).sum() / n_pixels)
+    variance = float((histogram * (values - mean) ** 2).sum() / n_pixels)
+    nonzero = np.flatnonzero(histogram)
+
+    # Smallest intensity whose cumulative count reaches the percentile, as np.percentile(method="inverted_cdf")
+    cumulative = np.cumsum(histogram)
+    ranks = np.maximum(np.ceil(np.asarray(percentiles, dtype=float) / 100 * n_pixels), 1)
+    percentile_values = np.searchsorted(cumulative, ranks, side="left")
+    return {
+        "n_pixels": n_pixels,
+        "min": int(nonzero[0]),
+        "max": int(nonzero[-1]),
+        "mean": mean,
+        "std": variance**0.5,
+        **{f"p{q:g}": int(v) for q, v in zip(percentiles, percentile_values)},
+    }
+
+
+class IntensityHistogramAccumulator:
+    """
+    Sum image histograms per (plate, channel), one histogram of `N_BINS` counts per group.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+
+    def update(self, plate: str, channel: str, histogram: np.ndarray):
+        """Add the histogram of one image"""
+        key = (plate, channel)
+        if key in self.histograms:
+            self.histograms[key] += histogram
+        else:
+            self.histograms[key] = histogram.astype(np.int64)
+
+    def finalize(self, percentiles: list[float] = DEFAULT_PERCENTILES) -> pd.DataFrame:
+        """
+        Get the statistics of every (plate, channel)
+
+        Parameters
+        ----------
+        percentiles : list[float]
+            percentiles to compute, in [0, 100]
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per plate and channel, see `histogram_statistics`
+        """
+        rows = [
+            {"Metadata_Plate": plate, "Channel": channel, **histogram_statistics(histogram, percentiles)}
+            for (plate, channel), histogram in sorted(self.histograms.items())
+        ]
+        return pd.DataFrame(rows)
+
+
+def compute_intensity_statistics(
+    loaddata_df: pd.DataFrame,
+    channels: list[str] | None = None,
+    exclude_paths: set | None = None,
+    sites_per_plate: int | None = None,
+    n_workers: int = 8,
+    seed: int = 0,
+) -> IntensityHistogramAccumulator:
+    """
+    Accumulate the intensity histograms of the images of LoadData rows in a thread pool
+
+    Parameters
+    ----------
+    loaddata_df : pd.DataFrame
+        LoadData table with `PathName_{channel}` and `FileName_{channel}` columns
+    channels : list[str] | None
+        channels to summarize, None summarizes every channel
+    exclude_paths : set | None
+        image paths to skip, e.g. the invalid images of the validate stage
+    sites_per_plate : int | None
+        number of sites drawn at random per plate, None reads every site
+    n_workers : int
+        number of images decoded at the same time
+    seed : int
+        seed of the site sampling
+
+    Returns
+    -------
+    IntensityHistogramAccumulator
+        the summed histograms of every plate and channel
+    """
+    if sites_per_plate is not None:
+        # Rank the sites of each plate by a random draw and keep the first ones
+        draws = pd.Series(np.random.default_rng(seed).random(len(loaddata_df)), index=loaddata_df.index)
+        ranks = draws.groupby(loaddata_df["Metadata_Plate"], observed=True).rank(method="first")
+        loaddata_df = loaddata_df[ranks <= sites_per_plate]
+    image_df = image_utils.image_paths(loaddata_df)
+    if channels is not None:
+        image_df = image_df[image_df["Channel"].isin(channels)]
+    if exclude_paths:
+        image_df = image_df[~image_df["path"].isin(exclude_paths)]
+
+    accumulator = IntensityHistogramAccumulator()
+    plates = image_df["Metadata_Plate"].astype(str).to_numpy()
+    image_channels = image_df["Channel"].astype(str).to_numpy()
+    paths = image_df["path"].to_numpy()
+    # Images are decoded a few batches at a time, so at most that many histograms wait to be summed
+    chunk_size = max(n_workers, 1) * 4
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for start in range(0, len(paths), chunk_size):
+            histograms = executor.map(image_histogram, paths[start:start + chunk_size])
+            for i, histogram in enumerate(histograms, start=start):
+                accumulator.update(plates[i], image_channels[i], histogram)
+    return accumulator
+
+
+def write_intensity_statistics(
+    accumulator: IntensityHistogramAccumulator,
+    output_path: pathlib.Path,
+    percentiles: list[float] = DEFAULT_PERCENTILES,
+    file_format: str = "csv",
+) -> pd.DataFrame:
+    """
+    Write the statistics table and the summed histograms of every (plate, channel)
+
+    Parameters
+    ----------
+    accumulator : IntensityHistogramAccumulator
+        accumulated histograms
+    output_path : pathlib.Path
+        path to the statistics table, the extension is set by `file_format`; the histograms are
+        written next to it as `{name}_histograms.npz`
+    percentiles : list[float]
+        percentiles to compute, in [0, 100]
+    file_format : str
+        "csv" or "parquet"
+
+    Returns
+    -------
+    pd.DataFrame
+        the statistics table
+    """
+    stats_df = accumulator.finalize(percentiles)
+    io_utils.write_table(stats_df, output_path, file_format=file_format)
+    np.savez_compressed(
+        output_path.parent / f"{output_path.stem}_histograms.npz",
+        **{f"{plate}/{channel}": histogram for (plate, channel), histogram in accumulator.histograms.items()},
+    )
+    return stats_df
+
+
+def normalization_factors(
+    stats_path: pathlib.Path,
+    channels: list[str],
+    plates: list[str] | None = None,
+    percentile: float = 99.9,
+) -> dict:
+    """
+    Look up a normalization factor per channel from the intensity statistics
+
+    Parameters
+    ----------
+    stats_path : pathlib.Path
+        path to the statistics table, with or without a file extension
+    channels : list[str]
+        channels to look up
+    plates : list[str] | None
+        plates the factor has to cover, None uses every plate
+    percentile : float
+        percentile used as the factor, it must be one of the computed percentiles
+
+    Returns
+    -------
+    dict
+        channel to the largest percentile value over the plates
+    """
+    column = f"p{percentile:g}"
+    stats_df = io_utils.read_table(stats_path, columns=GROUP_COLUMNS + [column])
+    if plates is not None:
+        stats_df = stats_df[stats_df["Metadata_Plate"].isin(plates)]
+    factors = stats_df.groupby("Channel")[column].max()
+    missing = [c for c in channels if c not in factors.index]
+    if missing:
+        raise ValueError(f"No intensity statistics for channels: {missing}")
+    return {c: float(factors[c]) for c in channels}
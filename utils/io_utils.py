@@ -0,0 +1,264 @@
+"""
+This file contains functions to write and read the tables produced by each stage as either csv
+or Parquet, so that every downstream stage can read whichever format an upstream stage wrote.
+"""
+
+
+import pathlib
+
+import pandas as pd
+
+
+TABLE_FORMATS = ("csv", "parquet")
+
+# Long, highly repeated strings that Parquet stores dictionary encoded
+DICTIONARY_PREFIXES = ("FileName_", "PathName_")
+
+
+def table_path(path: pathlib.Path, file_format: str) -> pathlib.Path:
+    """
+    Get the path of a table with the file extension of the requested format
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the table, with or without a file extension
+    file_format : str
+        "csv" or "parquet"
+
+    Returns
+    -------
+    pathlib.Path
+        the path with the extension of the format
+    """
+    if file_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format: {file_format}, expected one of {TABLE_FORMATS}")
+    path = pathlib.Path(path)
+    if path.suffix in (".csv", ".parquet"):
+        path = path.with_suffix("")
+    return path.with_name(f"{path.name}.{file_format}")
+
+
+def write_table(df: pd.DataFrame, path: pathlib.Path, file_format: str = "csv") -> pathlib.Path:
+    """
+    Write a table as csv or Parquet, dictionary encoding the `FileName_*`/`PathName_*` columns in Parquet
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table to write, its index is not written
+    path : pathlib.Path
+        path to the table, the file extension is replaced with the one of the format
+    file_format : str
+        "csv" or "parquet"
+
+    Returns
+    -------
+    pathlib.Path
+        path of the written table
+    """
+    path = table_path(path, file_format)
+    if file_format == "csv":
+        df.to_csv(path, index=False)
+    else:
+        path_columns = [c for c in df.columns if str(c).startswith(DICTIONARY_PREFIXES)]
+        df.astype({c: "category" for c in path_columns}).to_parquet(path, index=False)
+    return path
+
+
+def find_table(path: pathlib.Path) -> pathlib.Path:
+    """
+    Find an existing table in either format
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the table, with or without a file extension
+
+    Returns
+    -------
+    pathlib.Path
+        the given path if it exists, otherwise the most recently written of the csv and Parquet tables
+    """
+    path = pathlib.Path(path)
+    if path.suffix in (".csv", ".parquet") and path.is_file():
+        return path
+    candidates = [table_path(path, file_format) for file_format in TABLE_FORMATS]
+    candidates = [candidate for candidate in candidates if candidate.is_file()]
+    if not candidates:
+        raise FileNotFoundError(f"No csv or Parquet table found for {path}")
+    return max(candidates, key=lambda candidate: candidate.stat().st_mtime)
+
+
+def list_tables(directory: pathlib.Path, pattern: str = "*") -> list[pathlib.Path]:
+    """
+    List the csv and Parquet tables in a directory, one per table name
+
+    A table left in the other format after a change of output format is not listed twice: like
+    `find_table`, the most recently written of its csv and Parquet files is kept.
+
+    Parameters
+    ----------
+    directory : pathlib.Path
+        directory to search
+    pattern : str
+        glob pattern of the file names without the extension
+
+    Returns
+    -------
+    list[pathlib.Path]
+        sorted paths of the matching tables
+    """
+    tables = {}
+    for file_format in TABLE_FORMATS:
+        for path in directory.glob(f"{pattern}.{file_format}"):
+            if path.stem not in tables or path.stat().st_mtime > tables[path.stem].stat().st_mtime:
+                tables[path.stem] = path
+    return sorted(tables.values())
+
+
+def read_columns(path: pathlib.Path) -> list[str]:
+    """
+    Read only the column names of a table
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to a csv or Parquet table
+
+    Returns
+    -------
+    list[str]
+        the column names
+    """
+    path = find_table(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(path).names
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+def read_table(
+    path: pathlib.Path,
+    columns: list[str] | None = None,
+    dtype: dict | None = None,
+    filters: dict | None = None,
+) -> pd.DataFrame:
+    """
+    Read a csv or Parquet table, detecting the format from the file extension
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the table, with or without a file extension
+    columns : list[str] | None
+        only read these columns, None reads every column
+    dtype : dict | None
+        column name to dtype of the returned table
+    filters : dict | None
+        column name to the accepted values, only the matching rows are returned (pushed down to the
+        row groups of Parquet tables)
+
+    Returns
+    -------
+    pd.DataFrame
+        the table
+    """
+    path = find_table(path)
+    if path.suffix == ".parquet":
+        parquet_filters = [(c, "in", list(v)) for c, v in filters.items()] if filters else None
+        df = pd.read_parquet(path, columns=columns, filters=parquet_filters)
+        if dtype:
+            df = df.astype({c: t for c, t in dtype.items() if c in df.columns})
+        return df
+    df = pd.read_csv(path, usecols=columns, dtype=dtype)
+    for c, v in (filters or {}).items():
+        df = df[df[c].isin(v)]
+    return df
+
+
+def count_rows(path: pathlib.Path) -> int:
+    """
+    Count the rows of a table without parsing it
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to a csv or Parquet table, with or without a file extension
+
+    Returns
+    -------
+    int
+        number of rows, read from the Parquet footer or counted as csv lines after the header
+    """
+    path = find_table(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, "rb") as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+class TableWriter:
+    """
+    Append chunks of rows to one csv or Parquet table, so a table larger than memory can be written
+    one chunk (e.g. one plate) at a time. Every chunk is written with the columns of the first one.
+    """
+
+    def __init__(self, path: pathlib.Path, file_format: str = "csv", columns: list[str] | None = None):
+        self.path = table_path(path, file_format)
+        self.file_format = file_format
+        self.columns = columns
+        self.n_rows = 0
+        self._started = False
+        self._parquet_writer = None
+        self._schema = None
+
+    def write(self, df: pd.DataFrame):
+        """Append the rows of a chunk"""
+        if self.columns is None:
+            self.columns = list(df.columns)
+        df = df[self.columns]
+        if self.file_format == "csv":
+            df.to_csv(self.path, mode="a" if self._started else "w", header=not self._started, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            path_columns = [c for c in df.columns if str(c).startswith(DICTIONARY_PREFIXES)]
+            table = pa.Table.from_pandas(df.astype({c: "category" for c in path_columns}), preserve_index=False)
+            if self._parquet_writer is None:
+                # Wide dictionary indices so later chunks with more distinct paths fit the same schema
+                self._schema = pa.schema([
+                    field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+                    if pa.types.is_dictionary(field.type) else field
+                    for field in table.schema
+                ])
+                self._parquet_writer = pq.ParquetWriter(self.path, self._schema)
+            self._parquet_writer.write_table(table.cast(self._schema))
+        self._started = True
+        self.n_rows += len(df)
+
+    def close(self) -> pathlib.Path:
+        """
+        Finish the table, writing an empty one with the known columns if no chunk was written
+
+        Returns
+        -------
+        pathlib.Path
+            path of the written table
+        """
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        elif not self._started:
+            write_table(pd.DataFrame(columns=self.columns or []), self.path, file_format=self.file_format)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -4,15 +4,25 @@ for specific CellProfiler pipelines.
 """
 
 
+import hashlib
+import json
 import os
 import subprocess
 import pathlib
+import time
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from . import index_xml_utils, instrument_utils, io_utils, plate_utils
 
 
 def create_loaddata_csv(
     index_directory: pathlib.Path,
     config_path: pathlib.Path,
     path_to_output: pathlib.Path,
+    engine: str = "native",
 ):
     """
     Create LoadData csv for CellProfiler
@@ -24,19 +34,73 @@ def create_loaddata_csv(
     config_path : pathlib.Path
         path to the `config.yml' file for pe2loaddata to process the csv
     path_to_output : pathlib.Path
-        path to the `wave1_loaddata.csv' file used for generating the illumination correction functions for each channel
-    """
-    command = [
-        "pe2loaddata",
-        "--index-directory",
-        f'{index_directory}',
-        str(config_path),
-        str(path_to_output),
-    ]
-    subprocess.run(command, check=True)
+        path to the `wave1_loaddata.csv' file used for generating the illumination correction functions for each channel,
+        a `.parquet` extension writes Parquet instead of csv (native engine only)
+    engine : str
+        "native" to parse the index file in-process, or "pe2loaddata" to run the pe2loaddata command line tool
+    """
+    if path_to_output.suffix == ".parquet":
+        if engine != "native":
+            raise ValueError("Only the native engine can write Parquet LoadData")
+        loaddata_df = index_xml_utils.create_loaddata_df(index_directory, config_path)
+        io_utils.write_table(loaddata_df, path_to_output, file_format="parquet")
+    elif engine == "native":
+        index_xml_utils.write_loaddata_csv(index_directory, config_path, path_to_output)
+    elif engine == "pe2loaddata":
+        command = [
+            "pe2loaddata",
+            "--index-directory",
+            f'{index_directory}',
+            str(config_path),
+            str(path_to_output),
+        ]
+        subprocess.run(command, check=True)
+    else:
+        raise ValueError(f"Unknown LoadData engine: {engine}")
     print(f"{path_to_output.name} is created!")
 
 
+def add_illum_columns(
+    loaddata_df: pd.DataFrame,
+    illum_directory: pathlib.Path,
+    plate_id: str,
+    illum_filetype: str = ".npy",
+) -> pd.DataFrame:
+    """
+    Add the `FileName_Illum*`/`PathName_Illum*` columns for each channel of a LoadData table,
+    following the pe2loaddata naming of the illumination correction functions
+
+    Parameters
+    ----------
+    loaddata_df : pd.DataFrame
+        base LoadData table with the `FileName_*`/`PathName_*` columns of each channel
+    illum_directory : pathlib.Path
+        path to folder where the illumination correction functions (.npy files) are located
+    plate_id : str
+        string of the name of the plate the illumination correction functions were computed for
+    illum_filetype : str
+        file extension of the illumination correction functions
+
+    Returns
+    -------
+    pd.DataFrame
+        copy of the LoadData table with the illum columns appended
+    """
+    channel_names = sorted(
+        column[len("FileName_"):]
+        for column in loaddata_df.columns
+        if column.startswith("FileName_") and not column.startswith("FileName_Illum")
+    )
+
+    illum_columns = {}
+    for channel in channel_names:
+        illum_name = channel.replace("Orig", "")
+        illum_columns[f"FileName_Illum{illum_name}"] = f"{plate_id}_Illum{illum_name}{illum_filetype}"
+        illum_columns[f"PathName_Illum{illum_name}"] = str(illum_directory)
+
+    return loaddata_df.assign(**illum_columns)
+
+
 def create_loaddata_illum_csv(
     index_directory: pathlib.Path,
     config_path: pathlib.Path,
@@ -44,9 +108,12 @@ def create_loaddata_illum_csv(
     illum_directory: pathlib.Path,
     plate_id: str,
     illum_output_path: pathlib.Path,
+    loaddata_df: pd.DataFrame | None = None,
 ):
     """
-    Create LoadData csv with illum correction functions for CellProfiler (used for analysis pipelines)
+    Create LoadData csv with illum correction functions for CellProfiler (used for analysis pipelines).
+    The illum columns are added to an existing base LoadData table, so the index file is only parsed
+    when neither `loaddata_df` nor the table at `path_to_output` is available.
 
     Parameters
     ----------
@@ -55,31 +122,315 @@ def create_loaddata_illum_csv(
     config_path : pathlib.Path
         path to the `config.yml' file for pe2loaddata to process the csv
     path_to_output : pathlib.Path
-        path to the `wave1_loaddata.csv' file used for generating the illumination correction functions for each channel
+        path to an already generated `wave1_loaddata` csv or Parquet table without the illumination
+        correction functions, with or without a file extension
     illum_directory : pathlib.Path
         path to folder where the illumination correction functions (.npy files) are located
     plate_id : str
         string of the name of the plate to create the csv
     illum_output_path : pathlib.Path
         path to where the new csv will be created along with the name (e.g. path/to/wave1_loaddata_with_illum.csv)
+    loaddata_df : pd.DataFrame | None
+        in-memory base LoadData table, used instead of reading `path_to_output` when given
     """
-    command = [
-        "pe2loaddata",
-        "--index-directory",
-        str(index_directory),
-        str(config_path),
-        str(path_to_output),
-        "--illum",
-        "--illum-directory",
-        str(illum_directory),
-        "--plate-id",
-        plate_id,
-        "--illum-output",
-        str(illum_output_path),
-    ]
-    subprocess.run(command, check=True)
+    if loaddata_df is None:
+        try:
+            # The base table may have been written as csv or Parquet
+            base_path = io_utils.find_table(path_to_output)
+        except FileNotFoundError:
+            base_path = None
+        if base_path is None:
+            loaddata_df = index_xml_utils.create_loaddata_df(index_directory, config_path)
+        elif base_path.suffix == ".csv":
+            # Read every value as text so the base table is written back unchanged
+            loaddata_df = pd.read_csv(base_path, dtype=str, keep_default_na=False)
+        else:
+            loaddata_df = io_utils.read_table(base_path)
+
+    illum_output_path.parent.mkdir(parents=True, exist_ok=True)
+    add_illum_columns(loaddata_df, illum_directory, plate_id).to_csv(illum_output_path, index=False)
     print(f"{illum_output_path.name} is created!")
 
-    # remove the LoadData CSV that is created without the illum functions as it is not needed
-    os.remove(path_to_output)
-    print(f"The {path_to_output.name} CSV file has been removed as it does not contain the IC functions.")
\ No newline at end of file
+
+def get_pe2loaddata_version(engine: str = "native") -> str:
+    """
+    Get the version of the LoadData engine, used so that upgrading the engine regenerates every plate
+
+    Parameters
+    ----------
+    engine : str
+        "native" for the in-process engine, or "pe2loaddata" for the pe2loaddata command line tool
+
+    Returns
+    -------
+    str
+        the engine version, "unknown" if pe2loaddata is not installed as a distribution
+    """
+    if engine == "native":
+        return f"native-{index_xml_utils.ENGINE_VERSION}"
+    try:
+        return metadata.version("pe2loaddata")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _hash_file(path: pathlib.Path) -> str:
+    """Return the sha256 hex digest of the contents of a file"""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def compute_loaddata_fingerprint(
+    index_directory: pathlib.Path,
+    config_path: pathlib.Path,
+    pe2loaddata_version: str,
+) -> str:
+    """
+    Compute a fingerprint of everything a plate's LoadData csv depends on
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the folder containing the `Index.idx.xml` file for the plate
+    config_path : pathlib.Path
+        path to the `config.yml' file for pe2loaddata to process the csv
+    pe2loaddata_version : str
+        version of pe2loaddata used to create the csv
+
+    Returns
+    -------
+    str
+        sha256 hex digest combining the index file, the config file and the pe2loaddata version
+    """
+    index_files = sorted(pathlib.Path(index_directory).glob("Index*xml"))
+    if not index_files:
+        raise FileNotFoundError(f"No Index*xml file found in {index_directory}")
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(_hash_file(index_files[0]).encode())
+    fingerprint.update(_hash_file(config_path).encode())
+    fingerprint.update(pe2loaddata_version.encode())
+    return fingerprint.hexdigest()
+
+
+def load_manifest(manifest_path: pathlib.Path) -> dict:
+    """
+    Load the LoadData manifest mapping each plate name to the fingerprint of its last successful run
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        path to the manifest json file
+
+    Returns
+    -------
+    dict
+        plate name to fingerprint, empty if the manifest does not exist yet
+    """
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, manifest_path: pathlib.Path):
+    """
+    Save the LoadData manifest, writing to a temporary file first so an interrupted run cannot corrupt it
+
+    Parameters
+    ----------
+    manifest : dict
+        plate name to fingerprint
+    manifest_path : pathlib.Path
+        path to the manifest json file
+    """
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _run_loaddata_job(job: dict) -> dict:
+    """
+    Run a single plate LoadData job and record its outcome instead of raising,
+    so that one failing plate does not abort the rest of the batch.
+
+    Parameters
+    ----------
+    job : dict
+        dictionary with the `plate_name`, `index_directory`, `config_path` and `path_to_output` of the plate,
+        the `engine`, and optionally the `previous_fingerprint` and `pe2loaddata_version` to skip unchanged plates
+
+    Returns
+    -------
+    dict
+        the plate name, status ("success", "skipped" or "failed"), elapsed seconds, fingerprint,
+        error message (if any), peak memory of the worker so far (its high-water mark over every plate it ran)
+        and the rows and bytes written
+    """
+    start = time.perf_counter()
+    fingerprint = None
+    try:
+        if "pe2loaddata_version" in job:
+            fingerprint = compute_loaddata_fingerprint(
+                job["index_directory"], job["config_path"], job["pe2loaddata_version"]
+            )
+            if fingerprint == job.get("previous_fingerprint") and job["path_to_output"].exists():
+                return {
+                    "plate_name": job["plate_name"],
+                    "status": "skipped",
+                    "elapsed_s": time.perf_counter() - start,
+                    "fingerprint": fingerprint,
+                    "error": None,
+                    "peak_rss_mb": instrument_utils.peak_rss_mb(),
+                    "rows_out": None,
+                    "bytes_out": None,
+                }
+
+        create_loaddata_csv(
+            index_directory=job["index_directory"],
+            config_path=job["config_path"],
+            path_to_output=job["path_to_output"],
+            engine=job.get("engine", "native"),
+        )
+        status, error = "success", None
+        rows_out = io_utils.count_rows(job["path_to_output"])
+    except Exception as e:
+        status, error, rows_out = "failed", str(e), None
+
+    return {
+        "plate_name": job["plate_name"],
+        "status": status,
+        "elapsed_s": time.perf_counter() - start,
+        "fingerprint": fingerprint,
+        "error": error,
+        "peak_rss_mb": instrument_utils.peak_rss_mb(),
+        "rows_out": rows_out,
+        "bytes_out": instrument_utils.file_bytes(job["path_to_output"]) if rows_out is not None else None,
+    }
+
+
+def create_loaddata_csvs(
+    jobs: list[dict],
+    n_workers: int = 1,
+    manifest_path: pathlib.Path | None = None,
+    engine: str = "native",
+) -> pd.DataFrame:
+    """
+    Create LoadData csvs for many plates, optionally running the plates concurrently.
+    When a manifest is given, plates whose index file, config file and pe2loaddata version
+    are unchanged since their last successful run are skipped.
+
+    Parameters
+    ----------
+    jobs : list[dict]
+        one dictionary per plate with the `plate_name`, `index_directory`, `config_path` and `path_to_output`
+    n_workers : int
+        number of worker processes, 1 runs the plates one after another in the current process
+    manifest_path : pathlib.Path | None
+        path to the manifest json file recording the fingerprint of each plate, None always regenerates every plate
+    engine : str
+        "native" to parse the index files in-process, or "pe2loaddata" to run the pe2loaddata command line tool
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per plate with the plate name, status, elapsed seconds, fingerprint, error message,
+        peak memory and the rows and bytes written. Workers are reused across plates, so the peak memory
+        of a plate is the high-water mark of its worker (or of the current process) up to that plate
+    """
+    jobs = [{**job, "engine": engine} for job in jobs]
+    if manifest_path is not None:
+        manifest = load_manifest(manifest_path)
+        pe2loaddata_version = get_pe2loaddata_version(engine)
+        jobs = [
+            {
+                **job,
+                "previous_fingerprint": manifest.get(job["plate_name"]),
+                "pe2loaddata_version": pe2loaddata_version,
+            }
+            for job in jobs
+        ]
+
+    if n_workers <= 1:
+        results = [_run_loaddata_job(job) for job in jobs]
+    else:
+        results = []
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_run_loaddata_job, job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"{result['plate_name']}: {result['status']} ({result['elapsed_s']:.1f}s)")
+                results.append(result)
+
+    if manifest_path is not None:
+        # Only successful runs are recorded so failed plates are retried on the next run
+        for result in results:
+            if result["status"] != "failed":
+                manifest[result["plate_name"]] = result["fingerprint"]
+        save_manifest(manifest, manifest_path)
+
+    # Per-plate records of the run report, measured in the worker that ran the plate
+    for result in results:
+        instrument_utils.add_record({
+            **result,
+            "stage": "generate",
+            "step": "loaddata",
+            "plate": result["plate_name"],
+            "wall_s": result["elapsed_s"],
+        })
+
+    return pd.DataFrame(
+        results,
+        columns=[
+            "plate_name", "status", "elapsed_s", "fingerprint", "error", "peak_rss_mb", "rows_out", "bytes_out"
+        ],
+    ).sort_values("plate_name", ignore_index=True)
+
+
+def find_loaddata_jobs(
+    index_directory: pathlib.Path,
+    config_dir_path: pathlib.Path,
+    output_csv_dir: pathlib.Path,
+    file_format: str = "csv",
+    registry_path: pathlib.Path | None = None,
+) -> list[dict]:
+    """
+    Find the `Images` folder of every plate of a batch and build its LoadData job
+
+    Plates are resolved by `plate_utils`: original plates (`BR00*` folders) use `config.yml`,
+    re-imaged plates (`2024*` folders) use the config whose file name starts with the cell line of the folder.
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the batch folder containing the plate folders
+    config_dir_path : pathlib.Path
+        path to the folder with the pe2loaddata config files
+    output_csv_dir : pathlib.Path
+        path to the folder where the LoadData tables are written
+    file_format : str
+        "csv" or "parquet" for the LoadData tables
+    registry_path : pathlib.Path | None
+        path to the plate registry json file, reused while the batch folder is unchanged, None walks
+        the batch folder without saving a registry
+
+    Returns
+    -------
+    list[dict]
+        one job per plate, see `create_loaddata_csvs`
+    """
+    if registry_path is None:
+        registry_df, _ = plate_utils.discover_plates(index_directory, config_dir_path)
+    else:
+        registry_df = plate_utils.load_plate_registry(registry_path, index_directory, config_dir_path)
+
+    return [
+        {
+            "plate_name": plate["plate_name"],
+            "index_directory": pathlib.Path(plate["images_dir"]),
+            "config_path": pathlib.Path(plate["config_path"]),
+            "path_to_output": (output_csv_dir / f"{plate['plate_name']}_loaddata_original.{file_format}").absolute(),
+        }
+        for plate in registry_df.to_dict(orient="records")
+    ]
@@ -0,0 +1,143 @@
+"""
+This file contains functions to load the barcode and platemap metadata under `metadata/platemaps/`
+into one typed table keyed by (barcode, well), cache it on disk, and attach the conditions of each
+well to LoadData rows through a keyed lookup.
+"""
+
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+
+METADATA_DTYPES = {
+    "barcode": "category",
+    "platemap_file": "category",
+    "cell_line": "category",
+    "well": "category",
+    "row": "category",
+    "column": "int64",
+    "seeding_density": "int64",
+}
+
+# Columns describing the condition of a well, attached to LoadData rows
+CONDITION_COLUMNS = ["time_point", "platemap_file", "cell_line", "row", "column", "seeding_density"]
+
+
+def build_platemap_metadata(platemap_dir: pathlib.Path) -> pd.DataFrame:
+    """
+    Read every `Barcode_*.csv` and the platemaps they reference into one table
+
+    Parameters
+    ----------
+    platemap_dir : pathlib.Path
+        path to the folder with the `Barcode_*.csv` files and one `{platemap_file}.csv` per platemap
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per barcode and well with the barcode, time point, platemap file and the platemap columns
+    """
+    barcode_df = pd.concat(
+        [pd.read_csv(f) for f in sorted(platemap_dir.glob("Barcode_*.csv"))], ignore_index=True
+    )
+    platemap_files = barcode_df["platemap_file"].unique()
+    platemap_df = pd.concat(
+        [pd.read_csv(platemap_dir / f"{platemap}.csv") for platemap in platemap_files],
+        keys=platemap_files,
+        names=["platemap_file", None],
+    ).reset_index(level="platemap_file")
+
+    metadata_df = barcode_df.merge(platemap_df, on="platemap_file", how="inner")
+    return metadata_df.astype(
+        {column: dtype for column, dtype in METADATA_DTYPES.items() if column in metadata_df.columns}
+    )
+
+
+def load_platemap_metadata(
+    platemap_dir: pathlib.Path,
+    cache_path: pathlib.Path | None = None,
+) -> pd.DataFrame:
+    """
+    Load the typed barcode/platemap table, reusing the cached copy while no platemap csv has changed
+
+    Parameters
+    ----------
+    platemap_dir : pathlib.Path
+        path to the folder with the `Barcode_*.csv` files and the platemaps
+    cache_path : pathlib.Path | None
+        path to the cached Parquet table, None always rebuilds the table
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per barcode and well, see `build_platemap_metadata`
+    """
+    if cache_path is not None and cache_path.exists():
+        # The folder mtime changes when a platemap is added or removed, the file mtimes when one is edited
+        source_mtime = max(
+            [platemap_dir.stat().st_mtime] + [f.stat().st_mtime for f in platemap_dir.glob("*.csv")]
+        )
+        if cache_path.stat().st_mtime > source_mtime:
+            return pd.read_parquet(cache_path)
+
+    metadata_df = build_platemap_metadata(platemap_dir)
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        metadata_df.to_parquet(cache_path, index=False)
+    return metadata_df
+
+
+def attach_conditions(
+    df: pd.DataFrame,
+    metadata_df: pd.DataFrame,
+    columns: list[str] = CONDITION_COLUMNS,
+    plate_column: str = "Metadata_Plate",
+    well_column: str = "Metadata_Well",
+    how: str = "inner",
+) -> pd.DataFrame:
+    """
+    Attach the condition columns of each row's barcode and well through a keyed lookup
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table with a plate (barcode) and well column, e.g. a LoadData table
+    metadata_df : pd.DataFrame
+        table from `load_platemap_metadata`
+    columns : list[str]
+        condition columns to attach
+    plate_column : str
+        name of the plate column of `df`
+    well_column : str
+        name of the well column of `df`
+    how : str
+        "inner" drops rows without metadata, "left" keeps them with missing conditions
+
+    Returns
+    -------
+    pd.DataFrame
+        `df` with the condition columns appended
+    """
+    key_index = pd.MultiIndex.from_arrays(
+        [metadata_df["barcode"].astype(str), metadata_df["well"].astype(str)]
+    )
+    if not key_index.is_unique:
+        raise ValueError("The platemap metadata has more than one row for a barcode and well")
+
+    positions = key_index.get_indexer(
+        pd.MultiIndex.from_arrays([df[plate_column].astype(str), df[well_column].astype(str)])
+    )
+    found = positions >= 0
+    if how == "inner":
+        df, positions = df[found], positions[found]
+    elif how != "left":
+        raise ValueError(f"Unknown join: {how}, expected 'inner' or 'left'")
+
+    conditions = {}
+    for column in columns:
+        values = metadata_df[column].take(np.where(positions >= 0, positions, 0))
+        # `.array` keeps categorical columns categorical
+        conditions[column] = values.where(positions >= 0).array if how == "left" else values.array
+    return df.assign(**conditions)
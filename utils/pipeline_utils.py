@@ -0,0 +1,540 @@
+"""
+This file contains the pipeline runner behind the `alpine-vs-preprocess` command. The preprocessing of
+a batch is split into stages (generate -> pool -> validate, qc, intensity, thumbnails, then split -> pack, crop) that declare the stages they depend
+on and their input and output files, so that only stages whose outputs are missing or older than
+their inputs are re-run. Every path and parameter comes from `pipeline_config.yml`.
+"""
+
+
+import argparse
+import pathlib
+import time
+
+import pandas as pd
+import yaml
+
+from . import (
+    datasplit_utils,
+    image_utils,
+    instrument_utils,
+    intensity_utils,
+    io_utils,
+    loaddata_utils,
+    metadata_utils,
+    plate_utils,
+    pool_utils,
+    qc_utils,
+    crop_index_utils,
+    site_key_utils,
+    tensor_store_utils,
+    thumbnail_utils,
+)
+
+
+PIPELINE_CONFIG_PATH = pathlib.Path("./pipeline_config.yml")
+
+# Config entries holding a path, `{batch}` is replaced with the batch name
+PATH_KEYS = (
+    "index_directory",
+    "output_directory",
+    "config_dir",
+    "qc_dir",
+    "qc_output_dir",
+    "qc_config",
+    "platemap_dir",
+)
+
+# Path entries only needed by some stages
+OPTIONAL_PATH_KEYS = ("sc_features_dir",)
+
+
+def load_pipeline_config(config_path: pathlib.Path, batch: str) -> dict:
+    """
+    Load the pipeline config of one batch
+
+    Parameters
+    ----------
+    config_path : pathlib.Path
+        path to the `pipeline_config.yml` file
+    batch : str
+        batch name, e.g. "SN0313537"
+
+    Returns
+    -------
+    dict
+        the config with every path resolved for the batch, plus the `loaddata_dir`, `pooled_dir`
+        `split_dir` and `store_dir` folders under the output directory
+    """
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    config = {**config, "batch": batch, "config_path": pathlib.Path(config_path)}
+    for key in PATH_KEYS + tuple(k for k in OPTIONAL_PATH_KEYS if config.get(k) is not None):
+        config[key] = pathlib.Path(str(config[key]).format(batch=batch))
+    if config["output_format"] not in io_utils.TABLE_FORMATS:
+        raise ValueError(f"Unknown table format: {config['output_format']}, expected one of {io_utils.TABLE_FORMATS}")
+
+    output_directory = config["output_directory"]
+    config["loaddata_dir"] = output_directory / "loaddata_csvs"
+    config["pooled_dir"] = output_directory / "pooled_loaddata_csvs"
+    config["split_dir"] = output_directory / "data_split_loaddata"
+    config["store_dir"] = output_directory / "tensor_store"
+    return config
+
+
+def is_stale(inputs: list[pathlib.Path] | None, outputs: list[pathlib.Path]) -> bool:
+    """
+    Check whether a stage has to run
+
+    Parameters
+    ----------
+    inputs : list[pathlib.Path] | None
+        files the stage reads, None for stages that track their inputs themselves
+    outputs : list[pathlib.Path]
+        files the stage writes
+
+    Returns
+    -------
+    bool
+        True if an output is missing or older than an input, or the stage tracks its own inputs
+    """
+    if inputs is None or not outputs or not all(path.exists() for path in outputs):
+        return True
+    newest_input = max((path.stat().st_mtime for path in inputs), default=0.0)
+    return newest_input > min(path.stat().st_mtime for path in outputs)
+
+
+## generate: one LoadData table per plate, unchanged plates are skipped through the fingerprint manifest
+
+def _generate_outputs(config: dict) -> list[pathlib.Path]:
+    return [config["loaddata_dir"]]
+
+
+def _run_generate(config: dict):
+    config["loaddata_dir"].mkdir(parents=True, exist_ok=True)
+    jobs = loaddata_utils.find_loaddata_jobs(
+        config["index_directory"].resolve(strict=True),
+        config["config_dir"].absolute(),
+        config["loaddata_dir"],
+        file_format=config["output_format"],
+        registry_path=config["output_directory"] / "plate_registry.json",
+    )
+    report_df = loaddata_utils.create_loaddata_csvs(
+        jobs,
+        n_workers=config["n_workers"],
+        manifest_path=config["output_directory"] / "loaddata_manifest.json",
+        engine=config["loaddata_engine"],
+    )
+    report_df.to_csv(config["output_directory"] / "loaddata_generation_report.csv", index=False)
+    print(f"{(report_df['status'] == 'skipped').sum()} unchanged plates were skipped.")
+
+    failed_df = report_df[report_df["status"] == "failed"]
+    if not failed_df.empty:
+        raise RuntimeError(f"{len(failed_df)} of {len(report_df)} plates failed: {failed_df['plate_name'].tolist()}")
+
+
+## pool: one LoadData table per barcode, only barcodes with a newer per-plate table are re-pooled
+
+def _pool_inputs(config: dict) -> list[pathlib.Path]:
+    return io_utils.list_tables(config["loaddata_dir"])
+
+
+def _pool_groups(config: dict) -> tuple[dict, dict]:
+    registry_df = plate_utils.load_plate_registry(
+        config["output_directory"] / "plate_registry.json",
+        config["index_directory"].resolve(strict=True),
+        config["config_dir"].absolute(),
+    )
+    groups, reimaged, _ = plate_utils.group_loaddata_tables(registry_df, config["loaddata_dir"])
+    return groups, reimaged
+
+
+def _pool_outputs(config: dict) -> list[pathlib.Path]:
+    groups, _ = _pool_groups(config)
+    return [
+        io_utils.table_path(config["pooled_dir"] / f"{br_id}_concatenated", config["output_format"])
+        for br_id in groups
+    ]
+
+
+def _run_pool(config: dict):
+    loaddata_files = _pool_inputs(config)
+    if not loaddata_files:
+        raise FileNotFoundError(f"No CSV or Parquet files found in {config['loaddata_dir']}")
+    config["pooled_dir"].mkdir(parents=True, exist_ok=True)
+
+    # The original plate of the first barcode has the column order of the pooled tables
+    groups, reimaged = _pool_groups(config)
+    column_order = io_utils.read_columns(config["loaddata_dir"] / f"{list(groups)[0]}_loaddata_original")
+
+    _, unused_files = pool_utils.pool_loaddata_csvs(
+        loaddata_files,
+        config["pooled_dir"],
+        column_order=column_order,
+        file_format=config["output_format"],
+        n_workers=config["n_workers"],
+        skip_unchanged=True,
+        groups=groups,
+        reimaged=reimaged,
+        delta=config.get("delta", False),
+    )
+    for file in unused_files:
+        print(f"Unused: {file.name}")
+
+
+## qc: QC exclusion table from the whole image QC output of every plate
+
+def _qc_plates(config: dict) -> list[str]:
+    return sorted(plate.name for plate in config["qc_dir"].iterdir() if plate.is_dir())
+
+
+def _qc_inputs(config: dict) -> list[pathlib.Path]:
+    return [config["qc_config"]] + [config["qc_dir"] / plate / "Image.csv" for plate in _qc_plates(config)]
+
+
+def _qc_outputs(config: dict) -> list[pathlib.Path]:
+    return [io_utils.table_path(config["qc_output_dir"] / "qc_exclusion", config["output_format"])]
+
+
+def _run_qc(config: dict):
+    qc_utils.run_qc(
+        config["qc_dir"],
+        _qc_plates(config),
+        config["qc"]["channel_keys"],
+        qc_utils.load_qc_config(config["qc_config"]),
+        config["qc_output_dir"],
+        file_format=config["output_format"],
+        n_workers=config["n_workers"],
+        delta=config.get("delta", False),
+        streaming=config["qc"].get("streaming", False),
+    )
+
+
+## validate: status of every image referenced by the pooled tables, only changed files are re-read
+
+def _validate_outputs(config: dict) -> list[pathlib.Path]:
+    return [io_utils.table_path(config["output_directory"] / "image_validation", config["output_format"])]
+
+
+def _run_validate(config: dict):
+    image_df = pd.concat(
+        [
+            image_utils.image_paths(io_utils.read_table(f))
+            for f in io_utils.list_tables(config["pooled_dir"])
+        ],
+        ignore_index=True,
+    )
+    index_df = image_utils.validate_images(
+        image_df["path"],
+        index_path=config["output_directory"] / "image_index.parquet",
+        n_workers=config.get("validate", {}).get("n_workers", 32),
+    )
+    invalid_df = image_utils.invalid_images(image_df, index_df)
+    io_utils.write_table(invalid_df, _validate_outputs(config)[0], file_format=config["output_format"])
+    n_sites = invalid_df[qc_utils.SITE_COLUMNS].drop_duplicates().shape[0]
+    print(f"{len(invalid_df)} of {len(image_df)} images are invalid, from {n_sites} sites.")
+
+
+## intensity: per-(plate, channel) intensity histograms and statistics of the pooled images
+
+def _intensity_inputs(config: dict) -> list[pathlib.Path]:
+    return [config["config_path"]] + _pool_outputs(config) + _validate_outputs(config)
+
+
+def _intensity_outputs(config: dict) -> list[pathlib.Path]:
+    return [
+        io_utils.table_path(config["split_dir"] / "intensity_statistics", config["output_format"]),
+        config["split_dir"] / "intensity_statistics_histograms.npz",
+    ]
+
+
+def _run_intensity(config: dict):
+    intensity_config = config.get("intensity", {})
+    percentiles = intensity_config.get("percentiles", intensity_utils.DEFAULT_PERCENTILES)
+    config["split_dir"].mkdir(parents=True, exist_ok=True)
+
+    loaddata_df = pd.concat(
+        [io_utils.read_table(f) for f in io_utils.list_tables(config["pooled_dir"])], ignore_index=True
+    )
+    # Images flagged by the validate stage would fail to decode or skew the statistics
+    invalid_df = io_utils.read_table(_validate_outputs(config)[0], columns=["path"])
+    accumulator = intensity_utils.compute_intensity_statistics(
+        loaddata_df,
+        channels=intensity_config.get("channels"),
+        exclude_paths=set(invalid_df["path"]),
+        sites_per_plate=intensity_config.get("sites_per_plate"),
+        n_workers=config["n_workers"],
+    )
+    stats_df = intensity_utils.write_intensity_statistics(
+        accumulator, _intensity_outputs(config)[0], percentiles=percentiles, file_format=config["output_format"]
+    )
+    print(f"Intensity statistics of {stats_df.shape[0]} plate and channel combos saved.")
+
+
+## thumbnails: downsampled images and per-plate montages of the QC-excluded sites and a sample of passing sites
+
+def _thumbnails_inputs(config: dict) -> list[pathlib.Path]:
+    return [config["config_path"]] + _pool_outputs(config) + _validate_outputs(config) + _qc_outputs(config)
+
+
+def _thumbnails_outputs(config: dict) -> list[pathlib.Path]:
+    return [io_utils.table_path(config["output_directory"] / "thumbnails" / "thumbnail_index", config["output_format"])]
+
+
+def _run_thumbnails(config: dict):
+    thumbnails_config = config.get("thumbnails", {})
+    output_dir = config["output_directory"] / "thumbnails"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    loaddata_df = pd.concat(
+        [io_utils.read_table(f) for f in io_utils.list_tables(config["pooled_dir"])], ignore_index=True
+    )
+    review_df = thumbnail_utils.select_review_sites(
+        loaddata_df,
+        io_utils.read_table(_qc_outputs(config)[0]),
+        n_passing=thumbnails_config.get("n_passing_per_plate", 8),
+        seed=thumbnails_config.get("seed", 0),
+    )
+    # Sites with an image flagged by the validate stage can't be decoded
+    invalid_df = io_utils.read_table(_validate_outputs(config)[0])
+    n_review = len(review_df)
+    review_df = site_key_utils.exclude_sites(review_df, invalid_df)
+    if len(review_df) < n_review:
+        print(f"{n_review - len(review_df)} sites with invalid images are left out of the thumbnails.")
+
+    channels = thumbnails_config.get("channels") or [
+        c[len("FileName_"):] for c in loaddata_df.columns if c.startswith("FileName_")
+    ]
+    index_df = thumbnail_utils.build_review_thumbnails(
+        review_df,
+        output_dir,
+        channels,
+        size=thumbnails_config.get("size", 128),
+        n_levels=thumbnails_config.get("n_levels", 3),
+        n_workers=config["n_workers"],
+        max_montage_sites=thumbnails_config.get("max_montage_sites", thumbnail_utils.MAX_MONTAGE_SITES),
+    )
+    io_utils.write_table(index_df, _thumbnails_outputs(config)[0], file_format=config["output_format"])
+    n_excluded = int((index_df["qc_status"] == thumbnail_utils.EXCLUDED_STATUS).sum())
+    print(f"Thumbnails of {n_excluded} excluded and {len(index_df) - n_excluded} passing sites saved to {output_dir}.")
+
+
+## split: split manifest of the pooled sites passing QC and with valid images
+
+def _split_inputs(config: dict) -> list[pathlib.Path]:
+    inputs = [config["config_path"]] + io_utils.list_tables(config["pooled_dir"])
+    inputs += sorted(config["platemap_dir"].glob("*.csv"))
+    if config["split"].get("qc", True):
+        inputs += _qc_outputs(config)
+    if config["split"].get("drop_invalid_images", False):
+        inputs += _validate_outputs(config)
+    return inputs
+
+
+def _split_outputs(config: dict) -> list[pathlib.Path]:
+    return [io_utils.table_path(config["split_dir"] / "split_manifest", config["output_format"])]
+
+
+def _run_split(config: dict):
+    split_config = config["split"]
+    metadata_df = metadata_utils.load_platemap_metadata(
+        config["platemap_dir"], cache_path=config["output_directory"] / "platemap_metadata.parquet"
+    )
+    exclude_dfs = []
+    if split_config.get("qc", True):
+        exclude_dfs.append(io_utils.read_table(_qc_outputs(config)[0], columns=qc_utils.SITE_COLUMNS))
+    if split_config.get("drop_invalid_images", False):
+        exclude_dfs.append(io_utils.read_table(_validate_outputs(config)[0], columns=qc_utils.SITE_COLUMNS))
+
+    datasplit_utils.run_split(
+        io_utils.list_tables(config["pooled_dir"]),
+        metadata_df,
+        split_config["train_conditions"],
+        config["split_dir"],
+        exclude_df=pd.concat(exclude_dfs, ignore_index=True) if exclude_dfs else None,
+        seeds=split_config.get("seeds", datasplit_utils.DEFAULT_SEEDS),
+        n_heldout_wells=split_config.get("n_heldout_wells", 1),
+        n_folds=split_config.get("n_folds"),
+        file_format=config["output_format"],
+        delta=config.get("delta", False),
+        streaming=split_config.get("streaming", False),
+    )
+
+
+## pack: memory-mapped tensor store of one split, read by training instead of the TIFFs
+
+def _pack_inputs(config: dict) -> list[pathlib.Path]:
+    return [config["config_path"]] + _split_outputs(config) + io_utils.list_tables(config["pooled_dir"])
+
+
+def _pack_outputs(config: dict) -> list[pathlib.Path]:
+    return [
+        io_utils.table_path(config["store_dir"] / tensor_store_utils.STORE_INDEX_NAME, config["output_format"]),
+        config["store_dir"] / tensor_store_utils.STORE_METADATA_NAME,
+    ]
+
+
+def _run_pack(config: dict):
+    pack_config = config.get("pack", {})
+    index_df = tensor_store_utils.build_split_store(
+        _split_outputs(config)[0],
+        config["pooled_dir"],
+        config["store_dir"],
+        channels=pack_config.get("channels"),
+        label=pack_config.get("label", datasplit_utils.TRAIN_LABEL),
+        split_column=pack_config.get("split_column"),
+        sites_per_shard=pack_config.get("sites_per_shard", 64),
+        n_workers=config["n_workers"],
+        file_format=config["output_format"],
+    )
+    print(f"{index_df.shape[0]} sites packed into {index_df['shard'].nunique()} shards under {config['store_dir']}.")
+
+
+## crop: cell centers of the split's sites with whether their patch fits in the field of view
+
+def _crop_inputs(config: dict) -> list[pathlib.Path]:
+    inputs = [config["config_path"]] + _split_outputs(config)
+    if config.get("sc_features_dir") is not None:
+        inputs += sorted(config["sc_features_dir"].glob(crop_index_utils.SC_FEATURES_NAME.format(plate="*")))
+    return inputs
+
+
+def _crop_outputs(config: dict) -> list[pathlib.Path]:
+    return [io_utils.table_path(config["split_dir"] / "crop_index", config["output_format"])]
+
+
+def _run_crop(config: dict):
+    if config.get("sc_features_dir") is None:
+        raise ValueError("The crop stage needs the sc_features_dir entry of the pipeline config")
+    crop_config = config.get("crop", {})
+    crop_index_df = crop_index_utils.build_crop_index(
+        _split_outputs(config)[0],
+        config["sc_features_dir"],
+        _crop_outputs(config)[0],
+        patch_size=crop_config.get("patch_size", 256),
+        fov=tuple(crop_config.get("fov", (1080, 1080))),
+        label=crop_config.get("label", datasplit_utils.TRAIN_LABEL),
+        split_column=crop_config.get("split_column"),
+        n_workers=config["n_workers"],
+        file_format=config["output_format"],
+    )
+    n_valid = int(crop_index_df["valid_patch"].sum())
+    print(f"{n_valid} of {crop_index_df.shape[0]} cells can be cropped.")
+
+
+# Stages in the order they run, each with the stages it depends on and its inputs, outputs and runner
+STAGES = {
+    "generate": {"depends": [], "inputs": lambda config: None, "outputs": _generate_outputs, "run": _run_generate},
+    "pool": {"depends": ["generate"], "inputs": _pool_inputs, "outputs": _pool_outputs, "run": _run_pool},
+    "validate": {"depends": ["pool"], "inputs": _pool_outputs, "outputs": _validate_outputs, "run": _run_validate},
+    "qc": {"depends": [], "inputs": _qc_inputs, "outputs": _qc_outputs, "run": _run_qc},
+    "intensity": {
+        "depends": ["pool", "validate"], "inputs": _intensity_inputs, "outputs": _intensity_outputs, "run": _run_intensity
+    },
+    "thumbnails": {
+        "depends": ["pool", "validate", "qc"], "inputs": _thumbnails_inputs, "outputs": _thumbnails_outputs, "run": _run_thumbnails
+    },
+    "split": {"depends": ["pool", "validate", "qc"], "inputs": _split_inputs, "outputs": _split_outputs, "run": _run_split},
+    "pack": {"depends": ["split"], "inputs": _pack_inputs, "outputs": _pack_outputs, "run": _run_pack},
+    "crop": {"depends": ["split"], "inputs": _crop_inputs, "outputs": _crop_outputs, "run": _run_crop},
+}
+
+
+def run_pipeline(config: dict, stages: list[str] | None = None, force: bool = False) -> pd.DataFrame:
+    """
+    Run the stale stages of the pipeline in dependency order
+
+    A stage whose dependency failed in this run is not run.
+
+    Parameters
+    ----------
+    config : dict
+        config from `load_pipeline_config`
+    stages : list[str] | None
+        stages to consider, None considers every stage
+    force : bool
+        run the stages even when their outputs are up to date
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per stage with the stage name, status (success/skipped/failed/blocked), elapsed seconds and error message
+    """
+    stages = list(STAGES) if stages is None else stages
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}, expected some of {list(STAGES)}")
+
+    results, not_done = [], set()
+    for name in [name for name in STAGES if name in stages]:
+        stage = STAGES[name]
+        start = time.perf_counter()
+        status, error = "success", ""
+
+        if not_done.intersection(stage["depends"]):
+            status = "blocked"
+        elif not force and not is_stale(stage["inputs"](config), stage["outputs"](config)):
+            status = "skipped"
+        else:
+            print(f"Running stage: {name}")
+            try:
+                with instrument_utils.record_step(name, step="stage"):
+                    stage["run"](config)
+            except Exception as e:
+                status, error = "failed", str(e)
+
+        if status in ("failed", "blocked"):
+            not_done.add(name)
+        results.append({
+            "stage": name,
+            "status": status,
+            "elapsed_s": time.perf_counter() - start,
+            "error": error,
+        })
+        print(f"{name}: {status} ({results[-1]['elapsed_s']:.1f}s) {error}".rstrip())
+
+    return pd.DataFrame(results, columns=["stage", "status", "elapsed_s", "error"])
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Entry point of the `alpine-vs-preprocess` command
+
+    Parameters
+    ----------
+    argv : list[str] | None
+        command line arguments, None reads them from `sys.argv`
+
+    Returns
+    -------
+    int
+        exit code, 1 if a stage failed
+    """
+    parser = argparse.ArgumentParser(prog="alpine-vs-preprocess", description="Preprocess a batch of plates")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the stale stages of the pipeline for one batch")
+    run_parser.add_argument("--batch", required=True, help="batch name, e.g. SN0313537")
+    run_parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="stages to run")
+    run_parser.add_argument("--config", type=pathlib.Path, default=PIPELINE_CONFIG_PATH, help="pipeline config file")
+    run_parser.add_argument("--force", action="store_true", help="run the stages even when they are up to date")
+    args = parser.parse_args(argv)
+
+    config = load_pipeline_config(args.config, args.batch)
+    report_df = run_pipeline(config, args.stages, force=args.force)
+
+    config["output_directory"].mkdir(parents=True, exist_ok=True)
+    report_path = config["output_directory"] / "pipeline_report.csv"
+    report_df.to_csv(report_path, index=False)
+    print(f"Pipeline report saved to {report_path}")
+
+    # Wall time, peak memory and rows/bytes of every stage and of every plate within a stage
+    run_report_path = instrument_utils.write_run_report(
+        config["output_directory"] / "run_reports" / "pipeline_run_report.json", batch=config["batch"]
+    )
+    print(f"Run report saved to {run_report_path}")
+    return int((report_df["status"] == "failed").any())
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
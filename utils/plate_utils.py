@@ -0,0 +1,292 @@
+"""
+This file contains functions to discover the plates of a batch: the `Images` folder of every plate is
+found with a bounded-depth walk of the batch tree that lists each level's folders in a thread pool
+and never descends into an `Images` folder, then each plate's name, barcode, re-imaged flag and
+pe2loaddata config are resolved once.
+
+The result is persisted as a plate registry with the modification time of every walked folder, so
+later runs and stages reuse it after a few stat calls instead of walking the tree again.
+"""
+
+
+import json
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from . import io_utils, pool_utils
+
+
+IMAGES_FOLDER = "Images"
+
+# Plate folders sit at most two levels under the batch folder, the Images folder one level below
+MAX_DEPTH = 3
+
+PLATE_REGISTRY_COLUMNS = ["plate_name", "barcode", "reimaged", "images_dir", "config_path"]
+
+
+def _list_subfolders(folder: str) -> list[os.DirEntry]:
+    try:
+        with os.scandir(folder) as entries:
+            return [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+    except (FileNotFoundError, PermissionError):
+        return []
+
+
+def scan_image_folders(
+    index_directory: pathlib.Path,
+    max_depth: int = MAX_DEPTH,
+    n_workers: int = 16,
+) -> tuple[list[pathlib.Path], dict]:
+    """
+    Find the `Images` folders of a batch, one tree level at a time
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the batch folder containing the plate folders
+    max_depth : int
+        deepest level searched for `Images` folders, the batch folder's children are level 1
+    n_workers : int
+        number of folders listed at the same time
+
+    Returns
+    -------
+    tuple[list[pathlib.Path], dict]
+        the sorted `Images` folders, and the `st_mtime_ns` of every folder that was listed
+    """
+    image_folders, folder_mtimes = [], {}
+    level = [str(index_directory)]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for _ in range(max_depth):
+            if not level:
+                break
+            next_level = []
+            for folder, subfolders in zip(level, executor.map(_list_subfolders, level)):
+                folder_mtimes[folder] = os.stat(folder).st_mtime_ns
+                for entry in subfolders:
+                    if entry.name == IMAGES_FOLDER:
+                        image_folders.append(pathlib.Path(entry.path))
+                    else:
+                        next_level.append(entry.path)
+            level = next_level
+    return sorted(image_folders), folder_mtimes
+
+
+def resolve_plate(
+    images_dir: pathlib.Path,
+    index_directory: pathlib.Path,
+    config_files: list[pathlib.Path],
+    default_config: pathlib.Path,
+) -> dict | None:
+    """
+    Resolve the name, barcode, re-imaged flag and config of the plate of an `Images` folder
+
+    Original plates (`BR00*` folders) use the default config, re-imaged plates (`2024*` folders) use
+    the config whose file name starts with the cell line of the folder.
+
+    Parameters
+    ----------
+    images_dir : pathlib.Path
+        path to the `Images` folder of the plate
+    index_directory : pathlib.Path
+        path to the batch folder
+    config_files : list[pathlib.Path]
+        the `*.yml` files of the config folder
+    default_config : pathlib.Path
+        config of the original plates
+
+    Returns
+    -------
+    dict | None
+        one row of the plate registry, None if the folder does not follow a known pattern or has no config
+    """
+    parts = images_dir.relative_to(index_directory).parts
+    first_folder = parts[0]
+
+    if first_folder.startswith("BR00"):
+        plate_name = first_folder.split("_")[0]
+        return {
+            "plate_name": plate_name,
+            "barcode": plate_name,
+            "reimaged": False,
+            "images_dir": str(images_dir),
+            "config_path": str(default_config),
+        }
+
+    if first_folder.startswith("2024") and len(parts) > 2:
+        # "CellLine_Re-imaged" from the first folder and the barcode from the second folder
+        reimaged_name = "_".join(first_folder.split("_")[-2:])
+        barcode = parts[1].split("_")[0]
+        cell_line = reimaged_name.split("_")[0]
+        matching_configs = sorted(c for c in config_files if c.name.startswith(f"{cell_line}_"))
+        if not matching_configs:
+            print(f"No matching config file for: {reimaged_name}")
+            return None
+        return {
+            "plate_name": f"{reimaged_name}_{barcode}",
+            "barcode": barcode,
+            "reimaged": True,
+            "images_dir": str(images_dir),
+            "config_path": str(matching_configs[0]),
+        }
+
+    print(f"Unexpected folder pattern: {images_dir}")
+    return None
+
+
+def discover_plates(
+    index_directory: pathlib.Path,
+    config_dir_path: pathlib.Path,
+    max_depth: int = MAX_DEPTH,
+    n_workers: int = 16,
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Walk a batch folder and resolve every plate
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the batch folder containing the plate folders
+    config_dir_path : pathlib.Path
+        path to the folder with the pe2loaddata config files
+    max_depth : int
+        deepest level searched for `Images` folders
+    n_workers : int
+        number of folders listed at the same time
+
+    Returns
+    -------
+    tuple[pd.DataFrame, dict]
+        the plate registry sorted by plate name, and the `st_mtime_ns` of every walked folder
+    """
+    image_folders, folder_mtimes = scan_image_folders(index_directory, max_depth=max_depth, n_workers=n_workers)
+    config_files = sorted(config_dir_path.glob("*.yml"))
+    plates = [
+        resolve_plate(folder, index_directory, config_files, config_dir_path / "config.yml")
+        for folder in image_folders
+    ]
+    registry_df = pd.DataFrame([p for p in plates if p is not None], columns=PLATE_REGISTRY_COLUMNS)
+    return registry_df.sort_values("plate_name", ignore_index=True), folder_mtimes
+
+
+def _registry_is_current(
+    registry: dict,
+    index_directory: pathlib.Path,
+    config_dir_path: pathlib.Path,
+    n_workers: int,
+) -> bool:
+    if registry.get("index_directory") != str(index_directory) or registry.get("config_dir") != str(config_dir_path):
+        return False
+    # A plate folder added or removed anywhere in the walked tree changes the mtime of its parent
+    folders = [str(config_dir_path)] + list(registry["folder_mtimes"])
+    expected = [registry["config_dir_mtime"]] + list(registry["folder_mtimes"].values())
+
+    def mtime(folder: str) -> int | None:
+        try:
+            return os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        return list(executor.map(mtime, folders)) == expected
+
+
+def load_plate_registry(
+    registry_path: pathlib.Path,
+    index_directory: pathlib.Path,
+    config_dir_path: pathlib.Path,
+    refresh: bool = False,
+    max_depth: int = MAX_DEPTH,
+    n_workers: int = 16,
+) -> pd.DataFrame:
+    """
+    Load the plate registry of a batch, walking the batch folder only when it changed since the
+    registry was saved
+
+    Parameters
+    ----------
+    registry_path : pathlib.Path
+        path to the plate registry json file, written when the batch folder is walked
+    index_directory : pathlib.Path
+        path to the batch folder containing the plate folders
+    config_dir_path : pathlib.Path
+        path to the folder with the pe2loaddata config files
+    refresh : bool
+        walk the batch folder even when the registry is current
+    max_depth : int
+        deepest level searched for `Images` folders
+    n_workers : int
+        number of folders listed or stat-ed at the same time
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per plate with its `plate_name`, `barcode`, `reimaged` flag, `images_dir` and `config_path`
+    """
+    index_directory, config_dir_path = pathlib.Path(index_directory), pathlib.Path(config_dir_path)
+    if not refresh and registry_path.exists():
+        with open(registry_path, "r") as f:
+            registry = json.load(f)
+        if _registry_is_current(registry, index_directory, config_dir_path, n_workers):
+            return pd.DataFrame(registry["plates"], columns=PLATE_REGISTRY_COLUMNS)
+
+    registry_df, folder_mtimes = discover_plates(
+        index_directory, config_dir_path, max_depth=max_depth, n_workers=n_workers
+    )
+    registry = {
+        "index_directory": str(index_directory),
+        "config_dir": str(config_dir_path),
+        "config_dir_mtime": os.stat(config_dir_path).st_mtime_ns,
+        "folder_mtimes": folder_mtimes,
+        "plates": registry_df.to_dict(orient="records"),
+    }
+    registry_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = registry_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(registry, f, indent=2)
+    os.replace(tmp_path, registry_path)
+    print(f"Found {len(registry_df)} plates in {index_directory}, registry saved to {registry_path}")
+    return registry_df
+
+
+def group_loaddata_tables(
+    registry_df: pd.DataFrame,
+    loaddata_dir: pathlib.Path,
+) -> tuple[dict, dict, list[pathlib.Path]]:
+    """
+    Group the per-plate LoadData tables by the barcode of their plate in the registry
+
+    Parameters
+    ----------
+    registry_df : pd.DataFrame
+        plate registry from `load_plate_registry`
+    loaddata_dir : pathlib.Path
+        folder with the `{plate_name}_loaddata_original` tables
+
+    Returns
+    -------
+    tuple[dict, dict, list[pathlib.Path]]
+        barcode to its table paths (sorted by barcode number, tables of plates not in the registry are
+        grouped by the barcode in their file name as before), the registry's re-imaged flag of every
+        table of a registered plate, and the tables without a barcode
+    """
+    barcodes = dict(zip(registry_df["plate_name"], registry_df["barcode"]))
+    reimaged_plates = dict(zip(registry_df["plate_name"], registry_df["reimaged"].astype(bool)))
+    suffix = "_loaddata_original"
+    groups, reimaged, unregistered = {}, {}, []
+    for path in io_utils.list_tables(loaddata_dir):
+        plate_name = path.stem[:-len(suffix)] if path.stem.endswith(suffix) else None
+        if plate_name in barcodes:
+            groups.setdefault(barcodes[plate_name], []).append(path)
+            reimaged[path] = bool(reimaged_plates[plate_name])
+        else:
+            unregistered.append(path)
+
+    extra_groups, unused = pool_utils.group_loaddata_csvs(unregistered)
+    for barcode, paths in extra_groups.items():
+        groups.setdefault(barcode, []).extend(paths)
+    groups = {barcode: sorted(groups[barcode]) for barcode in sorted(groups, key=lambda x: int(x[4:]))}
+    return groups, reimaged, unused
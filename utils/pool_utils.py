@@ -0,0 +1,321 @@
+"""
+This file contains functions to pool the per-plate LoadData csvs of original and re-imaged plates
+into one LoadData csv per barcode, keeping the re-imaged site whenever a site was imaged twice.
+
+The size and modification time of every barcode's input tables are saved next to the pooled tables,
+so a delta run re-pools only the barcodes whose inputs changed, e.g. when a re-imaged plate arrives.
+"""
+
+
+import json
+import os
+import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from . import instrument_utils, io_utils
+
+
+BR00_PATTERN = re.compile(r"(BR00\d+)")
+
+# Columns holding a handful of distinct, long strings that are stored as categoricals
+CATEGORICAL_PREFIXES = ("FileName_", "PathName_")
+CATEGORICAL_COLUMNS = ("Metadata_Plate", "Metadata_Well")
+
+# A site is identified by its well and site within a barcode
+SITE_COLUMNS = ["Metadata_Well", "Metadata_Site"]
+SORT_COLUMNS = ["Metadata_Col", "Metadata_Row", "Metadata_Site"]
+
+# Barcode to the name, size and st_mtime_ns of each input table of its last pooling
+POOL_STATE_NAME = "pool_state.json"
+
+
+def loaddata_dtypes(columns: list[str]) -> dict:
+    """
+    Get the explicit dtypes used to read a LoadData csv
+
+    Parameters
+    ----------
+    columns : list[str]
+        columns of the LoadData csv
+
+    Returns
+    -------
+    dict
+        column name to dtype for the path, file name, plate and well columns
+    """
+    return {
+        column: "category"
+        for column in columns
+        if column.startswith(CATEGORICAL_PREFIXES) or column in CATEGORICAL_COLUMNS
+    }
+
+
+def concat_loaddata(loaddata_dfs: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate LoadData tables while keeping categorical columns categorical
+
+    Parameters
+    ----------
+    loaddata_dfs : list[pd.DataFrame]
+        LoadData tables with the same columns
+
+    Returns
+    -------
+    pd.DataFrame
+        the concatenated table
+    """
+    # pd.concat only keeps the categorical dtype when every frame shares the same categories
+    for column in loaddata_dfs[0].columns:
+        if isinstance(loaddata_dfs[0][column].dtype, pd.CategoricalDtype):
+            categories = pd.Index([])
+            for df in loaddata_dfs:
+                categories = categories.union(df[column].astype("category").cat.categories)
+            loaddata_dfs = [
+                df.assign(**{column: df[column].astype(pd.CategoricalDtype(categories))})
+                for df in loaddata_dfs
+            ]
+    return pd.concat(loaddata_dfs, ignore_index=True)
+
+
+def pool_loaddata(
+    loaddata_dfs: list[pd.DataFrame],
+    reimaged: list[bool],
+    column_order: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    Pool the LoadData tables of one barcode, keeping the re-imaged row of every site imaged twice
+
+    Parameters
+    ----------
+    loaddata_dfs : list[pd.DataFrame]
+        LoadData tables of the original and re-imaged plates of one barcode
+    reimaged : list[bool]
+        whether each table comes from a re-imaged plate
+    column_order : list[str] | None
+        column order of the pooled table, defaults to the column order of the first original plate
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per site with a `Metadata_Reimaged` column, sorted by column, row and site
+    """
+    if column_order is None:
+        first_original = reimaged.index(False) if False in reimaged else 0
+        column_order = loaddata_dfs[first_original].columns.tolist()
+
+    pooled_df = concat_loaddata(
+        [df[column_order].assign(Metadata_Reimaged=flag) for df, flag in zip(loaddata_dfs, reimaged)]
+    )
+
+    # idxmax picks the first re-imaged row of each site, or its first row if it was never re-imaged
+    keep = pooled_df.groupby(SITE_COLUMNS, observed=True, sort=False)["Metadata_Reimaged"].idxmax()
+
+    return pooled_df.loc[keep.to_numpy()].sort_values(SORT_COLUMNS, ignore_index=True)
+
+
+def group_loaddata_csvs(csv_files: list[pathlib.Path]) -> tuple[dict, list[pathlib.Path]]:
+    """
+    Group per-plate LoadData csvs by the barcode in their file name
+
+    Parameters
+    ----------
+    csv_files : list[pathlib.Path]
+        paths to the per-plate LoadData csvs
+
+    Returns
+    -------
+    tuple[dict, list[pathlib.Path]]
+        barcode to its csv paths (sorted by barcode number), and the csvs without a barcode
+    """
+    groups, unused = {}, []
+    for csv_file in csv_files:
+        match = BR00_PATTERN.search(csv_file.stem)
+        if match:
+            groups.setdefault(match.group(1), []).append(csv_file)
+        else:
+            unused.append(csv_file)
+    groups = {br_id: sorted(groups[br_id]) for br_id in sorted(groups, key=lambda x: int(x[4:]))}
+    return groups, unused
+
+
+def _input_state(files: list[pathlib.Path]) -> list[list]:
+    """Get the name, size and st_mtime_ns of every input table of a barcode"""
+    return [[path.name, path.stat().st_size, path.stat().st_mtime_ns] for path in sorted(files)]
+
+
+def load_pool_state(pooled_csv_dir: pathlib.Path) -> dict:
+    """
+    Load the input state of every barcode saved by the last pooling
+
+    Parameters
+    ----------
+    pooled_csv_dir : pathlib.Path
+        path to the folder of the pooled tables
+
+    Returns
+    -------
+    dict
+        barcode to the name, size and st_mtime_ns of each of its input tables, empty if never saved
+    """
+    state_path = pooled_csv_dir / POOL_STATE_NAME
+    if not state_path.exists():
+        return {}
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def changed_barcodes(
+    groups: dict,
+    pooled_csv_dir: pathlib.Path,
+    file_format: str = "csv",
+) -> list[str]:
+    """
+    Find the barcodes whose input tables were added, removed or modified since they were last pooled
+
+    Parameters
+    ----------
+    groups : dict
+        barcode to its per-plate tables
+    pooled_csv_dir : pathlib.Path
+        path to the folder of the pooled tables
+    file_format : str
+        "csv" or "parquet" for the pooled tables
+
+    Returns
+    -------
+    list[str]
+        the barcodes to pool again, in the order of `groups`, including those without a pooled table
+    """
+    state = load_pool_state(pooled_csv_dir)
+    return [
+        br_id for br_id, files in groups.items()
+        if state.get(br_id) != _input_state(files)
+        or not io_utils.table_path(pooled_csv_dir / f"{br_id}_concatenated", file_format).exists()
+    ]
+
+
+def _pool_barcode(
+    br_id: str,
+    files: list[pathlib.Path],
+    reimaged: list[bool],
+    pooled_csv_dir: pathlib.Path,
+    column_order: list[str] | None,
+    file_format: str,
+    skip_unchanged: bool,
+) -> pathlib.Path:
+    """Pool and write the tables of one barcode, unless its pooled table is newer than all of them"""
+    output_path = io_utils.table_path(pooled_csv_dir / f"{br_id}_concatenated", file_format)
+    if skip_unchanged and output_path.exists():
+        if output_path.stat().st_mtime >= max(csv_file.stat().st_mtime for csv_file in files):
+            print(f"Unchanged: {output_path}")
+            return output_path
+
+    with instrument_utils.record_step("pool", step="pool", plate=br_id) as record:
+        # The pooled columns give the categorical dtypes at read time, the remaining path, plate and well
+        # columns of a table are made categorical once it is loaded, so no header is read on its own
+        dtype = loaddata_dtypes(column_order) if column_order is not None else None
+        loaddata_dfs = []
+        for csv_file in files:
+            df = io_utils.read_table(csv_file, dtype=dtype)
+            loaddata_dfs.append(df.astype(loaddata_dtypes(df.columns)))
+
+        pooled_df = pool_loaddata(loaddata_dfs, reimaged=reimaged, column_order=column_order)
+
+        output_path = io_utils.write_table(
+            pooled_df, pooled_csv_dir / f"{br_id}_concatenated", file_format=file_format
+        )
+        record.update(
+            rows_in=sum(len(df) for df in loaddata_dfs),
+            rows_out=len(pooled_df),
+            bytes_in=instrument_utils.file_bytes(files),
+            bytes_out=instrument_utils.file_bytes(output_path),
+        )
+    print(f"Saved: {output_path}")
+    return output_path
+
+
+def pool_loaddata_csvs(
+    csv_files: list[pathlib.Path],
+    pooled_csv_dir: pathlib.Path,
+    column_order: list[str] | None = None,
+    file_format: str = "csv",
+    n_workers: int = 1,
+    skip_unchanged: bool = False,
+    groups: dict | None = None,
+    reimaged: dict | None = None,
+    delta: bool = False,
+) -> tuple[list[pathlib.Path], list[pathlib.Path]]:
+    """
+    Pool the per-plate LoadData tables of every barcode and write one `{barcode}_concatenated` table per barcode
+
+    Parameters
+    ----------
+    csv_files : list[pathlib.Path]
+        paths to the per-plate LoadData csv or Parquet tables of original (`BR00*`) and re-imaged (`*Re-imaged*`) plates
+    pooled_csv_dir : pathlib.Path
+        path to the folder where the pooled csvs are written
+    column_order : list[str] | None
+        column order of the pooled csvs, defaults to the column order of each barcode's original plate
+    file_format : str
+        "csv" or "parquet" for the pooled tables
+    n_workers : int
+        number of barcodes pooled at the same time
+    skip_unchanged : bool
+        keep the pooled table of a barcode when it is newer than every per-plate table of the barcode
+    groups : dict | None
+        barcode to its per-plate tables, e.g. from `plate_utils.group_loaddata_tables`, None groups
+        `csv_files` by the barcode in their file name
+    reimaged : dict | None
+        table path to whether it comes from a re-imaged plate, e.g. the registry flags from
+        `plate_utils.group_loaddata_tables`, tables not in it are re-imaged if their name contains "Re-imaged"
+    delta : bool
+        pool only the barcodes returned by `changed_barcodes` and keep the pooled tables of the others
+
+    Returns
+    -------
+    tuple[list[pathlib.Path], list[pathlib.Path]]
+        paths of the pooled tables, and the input tables that were not used
+    """
+    if groups is None:
+        groups, unused = group_loaddata_csvs(csv_files)
+    else:
+        grouped = {path for paths in groups.values() for path in paths}
+        unused = [csv_file for csv_file in csv_files if csv_file not in grouped]
+
+    pool_groups = groups
+    if delta:
+        changed = changed_barcodes(groups, pooled_csv_dir, file_format)
+        print(f"{len(changed)} of {len(groups)} barcodes changed: {changed}")
+        for br_id in load_pool_state(pooled_csv_dir).keys() - groups.keys():
+            print(f"Warning: {br_id} has no input tables anymore, its pooled table is left as is")
+        pool_groups = {br_id: groups[br_id] for br_id in changed}
+
+    reimaged = reimaged or {}
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        pooled = dict(zip(pool_groups, executor.map(
+            lambda item: _pool_barcode(
+                *item,
+                [reimaged.get(path, "Re-imaged" in path.stem) for path in item[1]],
+                pooled_csv_dir,
+                column_order,
+                file_format,
+                skip_unchanged,
+            ),
+            pool_groups.items(),
+        )))
+    concat_files = [
+        pooled.get(br_id, io_utils.table_path(pooled_csv_dir / f"{br_id}_concatenated", file_format))
+        for br_id in groups
+    ]
+
+    # Saved after every barcode was pooled, so an interrupted run pools its barcodes again
+    state = {**load_pool_state(pooled_csv_dir), **{br_id: _input_state(files) for br_id, files in groups.items()}}
+    tmp_path = pooled_csv_dir / f"{POOL_STATE_NAME}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, pooled_csv_dir / POOL_STATE_NAME)
+
+    return concat_files, unused
@@ -0,0 +1,822 @@
+"""
+This file contains functions to load the CellProfiler whole-image QC tables (`Image.csv`) of each
+plate, keeping only the metadata and the image quality metrics used to flag low quality sites,
+reshape them into one row per plate, well, site and channel, and score the sites against a
+configurable threshold spec, either in memory or streaming one plate at a time. The in-memory long
+table is cached, and `update_qc_long_cache` only reads the plates added or modified since. `run_qc`
+runs the whole QC step for both `3.qc_sites.py` and the pipeline runner.
+"""
+
+
+import pathlib
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from . import instrument_utils, io_utils
+
+
+# Blur and saturation metrics measured per channel by MeasureImageQuality
+QC_METRICS = ["ImageQuality_PowerLogLogSlope", "ImageQuality_PercentMaximal"]
+
+# Columns the statistics of a metric are grouped by for each scope
+QC_SCOPES = {
+    "global": [],
+    "plate": ["Metadata_Plate"],
+    "channel": ["Channel"],
+    "plate_channel": ["Metadata_Plate", "Channel"],
+}
+QC_ESTIMATORS = ("mean_std", "median_mad")
+
+# Scales the median absolute deviation to the standard deviation of normally distributed values
+MAD_SCALE = 1.4826
+
+# A site is identified by its plate, well and site
+SITE_COLUMNS = ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+
+# Long QC table of the previous run, kept in the QC output folder
+QC_CACHE_NAME = "qc_metrics.parquet"
+
+
+def qc_metric_columns(channel_keys: list[str], metrics: list[str] = QC_METRICS) -> list[str]:
+    """
+    Get the per-channel metric columns of an `Image.csv`
+
+    Parameters
+    ----------
+    channel_keys : list[str]
+        channel names, e.g. "OrigDNA"
+    metrics : list[str]
+        metric names without the channel suffix, e.g. "ImageQuality_PercentMaximal"
+
+    Returns
+    -------
+    list[str]
+        one `{metric}_{channel}` column per metric and channel
+    """
+    return [f"{metric}_{channel}" for channel in channel_keys for metric in metrics]
+
+
+def load_plate_qc(
+    qc_dir: pathlib.Path,
+    plate: str,
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+) -> pd.DataFrame:
+    """
+    Load the `Metadata_*` columns and the requested metric columns of one plate's `Image.csv`
+
+    Parameters
+    ----------
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    plate : str
+        name of the plate folder
+    channel_keys : list[str]
+        channels to load the metrics of
+    metrics : list[str]
+        metric names without the channel suffix
+
+    Returns
+    -------
+    pd.DataFrame
+        the pruned QC table of the plate
+    """
+    metric_columns = set(qc_metric_columns(channel_keys, metrics))
+    return pd.read_csv(
+        qc_dir / plate / "Image.csv",
+        usecols=lambda column: column.startswith("Metadata_") or column in metric_columns,
+    )
+
+
+def load_qc_tables(
+    qc_dir: pathlib.Path,
+    plates: list[str],
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+    n_workers: int = 8,
+) -> dict[str, pd.DataFrame]:
+    """
+    Load the pruned QC tables of many plates concurrently
+
+    Parameters
+    ----------
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    plates : list[str]
+        names of the plate folders
+    channel_keys : list[str]
+        channels to load the metrics of
+    metrics : list[str]
+        metric names without the channel suffix
+    n_workers : int
+        number of plates read at the same time
+
+    Returns
+    -------
+    dict[str, pd.DataFrame]
+        plate name to its pruned QC table, in the order of `plates`
+    """
+    def load(plate: str) -> pd.DataFrame:
+        with instrument_utils.record_step("qc", step="read", plate=plate) as record:
+            qc_df = load_plate_qc(qc_dir, plate, channel_keys, metrics)
+            record.update(rows_in=len(qc_df), bytes_in=instrument_utils.file_bytes(qc_dir / plate / "Image.csv"))
+        return qc_df
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        qc_dfs = executor.map(load, plates)
+        return dict(zip(plates, qc_dfs))
+
+
+def plate_qc_long(
+    plate: str,
+    qc_df: pd.DataFrame,
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+) -> pd.DataFrame:
+    """
+    Reshape one plate's wide QC table into one row per site and channel with one column per metric
+
+    Parameters
+    ----------
+    plate : str
+        plate name stored in the `Metadata_Plate` column
+    qc_df : pd.DataFrame
+        wide QC table with the `Metadata_*` columns and one `{metric}_{channel}` column per metric and channel
+    channel_keys : list[str]
+        channels to keep
+    metrics : list[str]
+        metric names without the channel suffix
+
+    Returns
+    -------
+    pd.DataFrame
+        the `Metadata_*` columns, a categorical `Channel` column and one column per metric
+    """
+    metadata_columns = [c for c in qc_df.columns if c.startswith("Metadata_")]
+    n_sites, n_channels = len(qc_df), len(channel_keys)
+
+    # Rows are channel-major: every site of the first channel, then every site of the next one
+    long_df = qc_df[metadata_columns].iloc[np.tile(np.arange(n_sites), n_channels)].reset_index(drop=True)
+    long_df["Metadata_Plate"] = plate
+    long_df["Channel"] = pd.Categorical.from_codes(
+        np.repeat(np.arange(n_channels), n_sites), categories=channel_keys
+    )
+    for metric in metrics:
+        long_df[metric] = qc_df[[f"{metric}_{channel}" for channel in channel_keys]].to_numpy().ravel(order="F")
+    return long_df
+
+
+def iter_qc_long(
+    qc_dfs: Iterable[tuple[str, pd.DataFrame]],
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+) -> Iterator[pd.DataFrame]:
+    """
+    Reshape plates one at a time so that callers can process them in batches or as a stream
+
+    Parameters
+    ----------
+    qc_dfs : Iterable[tuple[str, pd.DataFrame]]
+        (plate name, wide QC table) pairs, e.g. `dict.items()` or a generator of loaded plates
+    channel_keys : list[str]
+        channels to keep
+    metrics : list[str]
+        metric names without the channel suffix
+
+    Yields
+    ------
+    pd.DataFrame
+        the long QC table of each plate
+    """
+    for plate, qc_df in qc_dfs:
+        yield plate_qc_long(plate, qc_df, channel_keys, metrics)
+
+
+def qc_long_table(
+    qc_dfs: dict[str, pd.DataFrame],
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+) -> pd.DataFrame:
+    """
+    Reshape the wide QC tables of many plates into one long table
+
+    Parameters
+    ----------
+    qc_dfs : dict[str, pd.DataFrame]
+        plate name to its wide QC table
+    channel_keys : list[str]
+        channels to keep
+    metrics : list[str]
+        metric names without the channel suffix
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per plate, well, site and channel with one column per metric
+    """
+    long_df = pd.concat(list(iter_qc_long(qc_dfs.items(), channel_keys, metrics)), ignore_index=True)
+    long_df["Metadata_Plate"] = long_df["Metadata_Plate"].astype("category")
+    return long_df
+
+
+def load_qc_long_cache(
+    cache_path: pathlib.Path,
+    qc_dir: pathlib.Path,
+    plates: list[str],
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+) -> pd.DataFrame | None:
+    """
+    Load a cached long QC table if it is newer than every `Image.csv` and holds the requested plates,
+    channels and metrics
+
+    Parameters
+    ----------
+    cache_path : pathlib.Path
+        path to the cached long QC table (Parquet)
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    plates : list[str]
+        names of the plate folders
+    channel_keys : list[str]
+        channels the table must hold
+    metrics : list[str]
+        metric columns the table must hold
+
+    Returns
+    -------
+    pd.DataFrame | None
+        the cached table, or None if it is missing or stale
+    """
+    if not cache_path.exists():
+        return None
+    cache_mtime = cache_path.stat().st_mtime
+    if any((qc_dir / plate / "Image.csv").stat().st_mtime > cache_mtime for plate in plates):
+        return None
+
+    long_df = pd.read_parquet(cache_path)
+    if (
+        set(long_df["Metadata_Plate"].unique()) != set(plates)
+        or list(long_df["Channel"].cat.categories) != list(channel_keys)
+        or not set(metrics) <= set(long_df.columns)
+    ):
+        return None
+    return long_df
+
+
+def update_qc_long_cache(
+    cache_path: pathlib.Path,
+    qc_dir: pathlib.Path,
+    plates: list[str],
+    channel_keys: list[str],
+    metrics: list[str] = QC_METRICS,
+    n_workers: int = 8,
+) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Update the cached long QC table plate by plate: the rows of plates whose `Image.csv` is older than
+    the cache are kept, only new or modified plates are read, and plates no longer listed are dropped
+
+    Only the metrics are cached: the statistics of each scope are computed again from the whole table,
+    so with a global or per-channel scope adding a plate can add or remove exclusions of unchanged
+    plates, see `compare_exclusions`.
+
+    Parameters
+    ----------
+    cache_path : pathlib.Path
+        path to the cached long QC table (Parquet), rewritten when a plate changed
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    plates : list[str]
+        names of the plate folders
+    channel_keys : list[str]
+        channels the table must hold
+    metrics : list[str]
+        metric columns the table must hold
+    n_workers : int
+        number of plates read at the same time
+
+    Returns
+    -------
+    tuple[pd.DataFrame, list[str]]
+        the long QC table of every plate, and the plates that were read
+    """
+    cached_df = None
+    if cache_path.exists():
+        cached_df = pd.read_parquet(cache_path)
+        # A cache of other channels or metrics can't be reused for any plate
+        if list(cached_df["Channel"].cat.categories) != list(channel_keys) or not set(metrics) <= set(cached_df.columns):
+            cached_df = None
+
+    changed_plates = list(plates)
+    if cached_df is not None:
+        cache_mtime = cache_path.stat().st_mtime
+        cached_plates = set(cached_df["Metadata_Plate"].unique())
+        changed_plates = [
+            plate for plate in plates
+            if plate not in cached_plates or (qc_dir / plate / "Image.csv").stat().st_mtime > cache_mtime
+        ]
+        kept_plates = set(plates) - set(changed_plates)
+        if not changed_plates and kept_plates == cached_plates:
+            return cached_df, []
+        cached_df = cached_df[cached_df["Metadata_Plate"].isin(kept_plates)]
+
+    qc_dfs = load_qc_tables(qc_dir, changed_plates, channel_keys, metrics=metrics, n_workers=n_workers)
+    long_dfs = [] if cached_df is None else [cached_df]
+    long_df = pd.concat(long_dfs + list(iter_qc_long(qc_dfs.items(), channel_keys, metrics)), ignore_index=True)
+    long_df["Metadata_Plate"] = long_df["Metadata_Plate"].astype(str).astype("category")
+    long_df.to_parquet(cache_path, index=False)
+    return long_df, changed_plates
+
+
+def compare_exclusions(
+    previous_df: pd.DataFrame,
+    exclusion_df: pd.DataFrame,
+    plates: list[str],
+) -> tuple[int, int]:
+    """
+    Count the exclusions of some plates that a new QC run added or removed
+
+    Parameters
+    ----------
+    previous_df : pd.DataFrame
+        plate, well and site of the sites excluded by the previous run
+    exclusion_df : pd.DataFrame
+        plate, well and site of the sites excluded by the new run
+    plates : list[str]
+        plates to compare, e.g. the plates whose metrics did not change
+
+    Returns
+    -------
+    tuple[int, int]
+        the number of sites newly excluded, and the number of sites no longer excluded
+    """
+    def site_index(df: pd.DataFrame) -> pd.MultiIndex:
+        df = df.loc[df["Metadata_Plate"].astype(str).isin(plates), SITE_COLUMNS]
+        return pd.MultiIndex.from_frame(df.astype(str))
+
+    previous, current = site_index(previous_df), site_index(exclusion_df)
+    return int((~current.isin(previous)).sum()), int((~previous.isin(current)).sum())
+
+
+def load_qc_config(config_path: pathlib.Path) -> dict:
+    """
+    Load and validate the QC threshold spec
+
+    Parameters
+    ----------
+    config_path : pathlib.Path
+        path to the `qc_config.yml` file with the `scope`, `estimator` and per-metric thresholds
+
+    Returns
+    -------
+    dict
+        the `scope`, `estimator` and `metrics` (metric name to absolute score threshold)
+    """
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    qc_config = {
+        "scope": config.get("scope", "global"),
+        "estimator": config.get("estimator", "mean_std"),
+        "metrics": {metric: float(thresh) for metric, thresh in config["metrics"].items()},
+    }
+    if qc_config["scope"] not in QC_SCOPES:
+        raise ValueError(f"Unknown QC scope: {qc_config['scope']}, expected one of {list(QC_SCOPES)}")
+    if qc_config["estimator"] not in QC_ESTIMATORS:
+        raise ValueError(f"Unknown QC estimator: {qc_config['estimator']}, expected one of {QC_ESTIMATORS}")
+    return qc_config
+
+
+def _group_keys(long_df: pd.DataFrame, scope: str) -> list:
+    """Get the keys to group the long QC table by, a single constant group for the global scope"""
+    columns = QC_SCOPES[scope]
+    if not columns:
+        return [np.zeros(len(long_df), dtype=np.int8)]
+    return [long_df[column] for column in columns]
+
+
+def compute_qc_statistics(
+    long_df: pd.DataFrame,
+    metrics: list[str],
+    scope: str = "global",
+    estimator: str = "mean_std",
+) -> pd.DataFrame:
+    """
+    Compute the center and scale of every metric within each group of the scope in one grouped pass
+
+    Parameters
+    ----------
+    long_df : pd.DataFrame
+        long QC table with one row per plate, well, site and channel
+    metrics : list[str]
+        metric columns to compute the statistics of
+    scope : str
+        "global", "plate", "channel" or "plate_channel"
+    estimator : str
+        "mean_std" or "median_mad"
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per group with a `{metric}_center` and `{metric}_scale` column per metric
+    """
+    grouped = long_df[metrics].groupby(_group_keys(long_df, scope), observed=True)
+    if estimator == "mean_std":
+        # Population standard deviation, like scipy.stats.zscore
+        center, scale = grouped.mean(), grouped.std(ddof=0)
+    elif estimator == "median_mad":
+        center = grouped.median()
+        deviation = (long_df[metrics] - grouped.transform("median")).abs()
+        scale = deviation.groupby(_group_keys(long_df, scope), observed=True).median() * MAD_SCALE
+    else:
+        raise ValueError(f"Unknown QC estimator: {estimator}, expected one of {QC_ESTIMATORS}")
+
+    stats = pd.concat([center.add_suffix("_center"), scale.add_suffix("_scale")], axis=1)
+    if QC_SCOPES[scope]:
+        stats.index.names = QC_SCOPES[scope]
+    else:
+        stats.index = pd.Index(["all"], name="scope")
+    return stats
+
+
+def score_qc(
+    long_df: pd.DataFrame,
+    stats: pd.DataFrame,
+    metrics: list[str],
+    scope: str = "global",
+) -> pd.DataFrame:
+    """
+    Score every row of the long QC table against the statistics of its group
+
+    Parameters
+    ----------
+    long_df : pd.DataFrame
+        long QC table with one row per plate, well, site and channel
+    stats : pd.DataFrame
+        statistics from `compute_qc_statistics` computed with the same scope
+    metrics : list[str]
+        metric columns to score
+    scope : str
+        "global", "plate", "channel" or "plate_channel"
+
+    Returns
+    -------
+    pd.DataFrame
+        one score column per metric, aligned with the rows of `long_df`
+    """
+    columns = QC_SCOPES[scope]
+    if columns:
+        aligned = long_df[columns].merge(stats, left_on=columns, right_index=True, how="left")
+        center = aligned[[f"{m}_center" for m in metrics]].to_numpy()
+        scale = aligned[[f"{m}_scale" for m in metrics]].to_numpy()
+    else:
+        center = stats[[f"{m}_center" for m in metrics]].to_numpy()
+        scale = stats[[f"{m}_scale" for m in metrics]].to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (long_df[metrics].to_numpy() - center) / scale
+    return pd.DataFrame(scores, columns=metrics, index=long_df.index)
+
+
+def flag_sites(
+    long_df: pd.DataFrame,
+    scores: pd.DataFrame,
+    thresholds: dict[str, float],
+) -> pd.DataFrame:
+    """
+    Flag sites where any channel has an absolute score above the threshold of a metric
+
+    Parameters
+    ----------
+    long_df : pd.DataFrame
+        long QC table with one row per plate, well, site and channel
+    scores : pd.DataFrame
+        scores from `score_qc`, aligned with the rows of `long_df`
+    thresholds : dict[str, float]
+        metric name to absolute score threshold
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per site with the largest absolute score of each metric across channels
+        and a boolean `QC_Fail` column
+    """
+    metrics = list(thresholds)
+    abs_scores = scores[metrics].abs()
+    site_df = (
+        abs_scores.groupby([long_df[c] for c in SITE_COLUMNS], observed=True, sort=False)
+        .max()
+        .reset_index()
+    )
+    site_df["QC_Fail"] = (site_df[metrics] > pd.Series(thresholds)).any(axis=1)
+    return site_df
+
+
+class QCStatisticsAccumulator:
+    """
+    Accumulate the statistics of `compute_qc_statistics` one chunk (e.g. one plate) at a time.
+
+    Means and standard deviations are merged exactly from each chunk's count, mean and sum of
+    squared deviations. Medians and median absolute deviations are estimated from a bounded,
+    weighted random sample per group and metric, exact while a group holds at most `max_samples` values.
+    """
+
+    def __init__(
+        self,
+        metrics: list[str],
+        scope: str = "global",
+        estimator: str = "mean_std",
+        max_samples: int = 100_000,
+        seed: int = 0,
+    ):
+        if scope not in QC_SCOPES:
+            raise ValueError(f"Unknown QC scope: {scope}, expected one of {list(QC_SCOPES)}")
+        if estimator not in QC_ESTIMATORS:
+            raise ValueError(f"Unknown QC estimator: {estimator}, expected one of {QC_ESTIMATORS}")
+        self.metrics = metrics
+        self.scope = scope
+        self.estimator = estimator
+        self.max_samples = max_samples
+        self.rng = np.random.default_rng(seed)
+        self.moments = None
+        self.samples = {}
+
+    def update(self, long_df: pd.DataFrame):
+        """Add the rows of a long QC table chunk"""
+        grouped = long_df[self.metrics].groupby(_group_keys(long_df, self.scope), observed=True)
+        if self.estimator == "mean_std":
+            self._update_moments(grouped)
+        else:
+            self._update_samples(grouped)
+
+    def _update_moments(self, grouped):
+        count, mean = grouped.count(), grouped.mean()
+        m2 = grouped.var(ddof=0) * count
+        if self.moments is None:
+            self.moments = (count, mean, m2)
+            return
+
+        # Chan et al. parallel merge of (count, mean, sum of squared deviations)
+        old_count, old_mean, old_m2 = (
+            m.reindex(m.index.union(count.index)).fillna(0) for m in self.moments
+        )
+        count, mean, m2 = (m.reindex(old_count.index).fillna(0) for m in (count, mean, m2))
+        total = old_count + count
+        delta = mean - old_mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            new_mean = (old_mean + delta * count / total).fillna(0)
+            new_m2 = old_m2 + m2 + (delta**2 * old_count * count / total).fillna(0)
+        self.moments = (total, new_mean, new_m2)
+
+    def _update_samples(self, grouped):
+        for key, group in grouped:
+            # Grouping by a list of one key yields 1-tuples
+            key = key[0] if len(key) == 1 else key
+            for metric in self.metrics:
+                values = group[metric].dropna().to_numpy()
+                seen, sample = self.samples.get((key, metric), (0, np.empty(0)))
+                merged = np.concatenate([sample, values])
+                if len(merged) > self.max_samples:
+                    # Each kept value stands for seen / len(sample) values of the earlier chunks
+                    weights = np.concatenate([
+                        np.full(len(sample), seen / max(len(sample), 1)), np.ones(len(values))
+                    ])
+                    keep = self.rng.choice(
+                        len(merged), size=self.max_samples, replace=False, p=weights / weights.sum()
+                    )
+                    merged = merged[keep]
+                self.samples[(key, metric)] = (seen + len(values), merged)
+
+    def finalize(self) -> pd.DataFrame:
+        """
+        Get the accumulated statistics
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per group with a `{metric}_center` and `{metric}_scale` column per metric,
+            in the same layout as `compute_qc_statistics`
+        """
+        if self.estimator == "mean_std":
+            count, center, m2 = self.moments
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scale = np.sqrt(m2 / count)
+        else:
+            keys = sorted({key for key, _ in self.samples})
+            center = pd.DataFrame(index=pd.Index(keys), columns=self.metrics, dtype=float)
+            scale = center.copy()
+            for (key, metric), (_, sample) in self.samples.items():
+                median = np.median(sample) if len(sample) else np.nan
+                center.loc[key, metric] = median
+                scale.loc[key, metric] = (
+                    np.median(np.abs(sample - median)) * MAD_SCALE if len(sample) else np.nan
+                )
+            if len(QC_SCOPES[self.scope]) > 1:
+                center.index = scale.index = pd.MultiIndex.from_tuples(keys)
+
+        stats = pd.concat([center.add_suffix("_center"), scale.add_suffix("_scale")], axis=1)
+        if QC_SCOPES[self.scope]:
+            stats.index.names = QC_SCOPES[self.scope]
+        else:
+            stats.index = pd.Index(["all"], name="scope")
+        return stats
+
+
+def stream_qc_exclusions(
+    qc_dir: pathlib.Path,
+    plates: list[str],
+    channel_keys: list[str],
+    qc_config: dict,
+    exclusion_path: pathlib.Path,
+    file_format: str = "csv",
+    scores_path: pathlib.Path | None = None,
+) -> tuple[pd.DataFrame, int, int]:
+    """
+    Flag low quality sites in two passes over the plates so that only one plate is in memory at a time.
+    The first pass accumulates the statistics of each metric, the second scores every plate and
+    appends its failing sites to the exclusion table and its site scores to the scores table.
+
+    Parameters
+    ----------
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    plates : list[str]
+        names of the plate folders
+    channel_keys : list[str]
+        channels to score
+    qc_config : dict
+        the `scope`, `estimator` and `metrics` thresholds from `load_qc_config`
+    exclusion_path : pathlib.Path
+        path to the exclusion table with the plate, well and site of every failing site, the
+        extension is set by `file_format`
+    file_format : str
+        "csv" or "parquet"
+    scores_path : pathlib.Path | None
+        path to the table of the largest absolute score of each metric and the `QC_Fail` flag of every
+        site, as written by the in-memory path, None doesn't write it
+
+    Returns
+    -------
+    tuple[pd.DataFrame, int, int]
+        the statistics, the number of scored sites and the number of excluded sites
+    """
+    metrics = list(qc_config["metrics"])
+    scope = qc_config["scope"]
+
+    def load_plate(plate: str) -> pd.DataFrame:
+        qc_df = load_plate_qc(qc_dir, plate, channel_keys, metrics)
+        return plate_qc_long(plate, qc_df, channel_keys, metrics)
+
+    accumulator = QCStatisticsAccumulator(metrics, scope=scope, estimator=qc_config["estimator"])
+    for plate in plates:
+        with instrument_utils.record_step("qc", step="statistics", plate=plate) as record:
+            long_df = load_plate(plate)
+            accumulator.update(long_df)
+            record["rows_in"] = len(long_df)
+    stats = accumulator.finalize()
+
+    n_sites, n_removed = 0, 0
+    scores_writer = None
+    if scores_path is not None:
+        scores_columns = SITE_COLUMNS + metrics + ["QC_Fail"]
+        scores_writer = io_utils.TableWriter(scores_path, file_format=file_format, columns=scores_columns)
+    with io_utils.TableWriter(exclusion_path, file_format=file_format, columns=SITE_COLUMNS) as writer:
+        for plate in plates:
+            with instrument_utils.record_step("qc", step="score", plate=plate) as record:
+                long_df = load_plate(plate)
+                site_df = flag_sites(long_df, score_qc(long_df, stats, metrics, scope=scope), qc_config["metrics"])
+                removed = site_df.loc[site_df["QC_Fail"], SITE_COLUMNS]
+                # Plates without failing sites are skipped, so the first chunk gives the Parquet schema real types
+                if len(removed):
+                    writer.write(removed)
+                if scores_writer is not None and len(site_df):
+                    scores_writer.write(site_df)
+                record.update(rows_in=len(long_df), rows_out=len(removed))
+            n_sites += len(site_df)
+            n_removed += len(removed)
+    if scores_writer is not None:
+        scores_writer.close()
+
+    return stats, n_sites, n_removed
+
+
+def run_qc(
+    qc_dir: pathlib.Path,
+    plates: list[str],
+    channel_keys: list[str],
+    qc_config: dict,
+    output_dir: pathlib.Path,
+    file_format: str = "csv",
+    n_workers: int = 8,
+    delta: bool = False,
+    streaming: bool = False,
+) -> tuple[pd.DataFrame, int, int]:
+    """
+    Flag the low quality sites of a batch and save the QC statistics, site scores and exclusion table,
+    shared by `3.qc_sites.py` and the QC stage of the pipeline runner
+
+    The in-memory path caches the long QC table as `qc_metrics.parquet` in `output_dir` and reuses it
+    while no `Image.csv` changed, the streaming path reads the plates one at a time with `stream_qc_exclusions`.
+
+    Parameters
+    ----------
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    plates : list[str]
+        names of the plate folders
+    channel_keys : list[str]
+        channels to score
+    qc_config : dict
+        the `scope`, `estimator` and `metrics` thresholds from `load_qc_config`
+    output_dir : pathlib.Path
+        folder of the `qc_statistics.csv`, `qc_site_scores` and `qc_exclusion` tables
+    file_format : str
+        "csv" or "parquet" for the site scores and exclusion tables
+    n_workers : int
+        number of plates whose `Image.csv` is read at the same time (in memory only)
+    delta : bool
+        only read the `Image.csv` of plates added or modified since the cached table, see `update_qc_long_cache`
+    streaming : bool
+        score the plates one at a time for batches that don't fit in memory
+
+    Returns
+    -------
+    tuple[pd.DataFrame, int, int]
+        the statistics, the number of scored sites and the number of excluded sites
+    """
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    metrics = list(qc_config["metrics"])
+
+    if streaming:
+        stats, n_sites, n_removed = stream_qc_exclusions(
+            qc_dir,
+            plates,
+            channel_keys,
+            qc_config,
+            output_dir / "qc_exclusion",
+            file_format=file_format,
+            scores_path=output_dir / "qc_site_scores",
+        )
+        stats.to_csv(output_dir / "qc_statistics.csv")
+        print(f"{n_removed} of {n_sites} plate, well and site combos removed due to low quality.")
+        return stats, n_sites, n_removed
+
+    # Reuse the long QC table of a previous run when no Image.csv changed, so re-scoring does not re-read them
+    cache_path = output_dir / QC_CACHE_NAME
+    long_df = load_qc_long_cache(cache_path, qc_dir, plates, channel_keys, metrics=metrics)
+    changed_plates = None
+    if long_df is None and delta:
+        with instrument_utils.record_step("qc", step="update") as record:
+            long_df, changed_plates = update_qc_long_cache(
+                cache_path, qc_dir, plates, channel_keys, metrics=metrics, n_workers=n_workers
+            )
+            record.update(rows_out=len(long_df), bytes_out=instrument_utils.file_bytes(cache_path))
+        print(f"Read the QC metrics of {len(changed_plates)} added or modified plates: {changed_plates}")
+    elif long_df is None:
+        qc_dfs = load_qc_tables(qc_dir, plates, channel_keys, metrics=metrics, n_workers=n_workers)
+        with instrument_utils.record_step("qc", step="reshape") as record:
+            long_df = qc_long_table(qc_dfs, channel_keys, metrics=metrics)
+            long_df.to_parquet(cache_path, index=False)
+            record.update(
+                rows_in=sum(len(qc_df) for qc_df in qc_dfs.values()),
+                rows_out=len(long_df),
+                bytes_out=instrument_utils.file_bytes(cache_path),
+            )
+    else:
+        print(f"Reusing cached QC metrics from {cache_path}")
+
+    # Score every metric against the statistics of its scope (global, per plate and/or per channel)
+    with instrument_utils.record_step("qc", step="score") as record:
+        stats = compute_qc_statistics(long_df, metrics, scope=qc_config["scope"], estimator=qc_config["estimator"])
+        scores = score_qc(long_df, stats, metrics, scope=qc_config["scope"])
+        site_df = flag_sites(long_df, scores, qc_config["metrics"])
+        record.update(rows_in=len(long_df), rows_out=len(site_df))
+    exclusion_df = site_df.loc[site_df["QC_Fail"], SITE_COLUMNS]
+
+    if changed_plates is not None:
+        # The statistics are computed over the whole batch, so exclusions of unchanged plates can move
+        try:
+            previous_df = io_utils.read_table(io_utils.find_table(output_dir / "qc_exclusion"))
+            n_added, n_dropped = compare_exclusions(
+                previous_df, exclusion_df, [plate for plate in plates if plate not in changed_plates]
+            )
+            print(f"Unchanged plates: {n_added} sites newly excluded and {n_dropped} no longer excluded.")
+        except FileNotFoundError:
+            print("No previous QC exclusion table to compare with")
+
+    with instrument_utils.record_step("qc", step="write") as record:
+        stats.to_csv(output_dir / "qc_statistics.csv")
+        output_paths = [
+            io_utils.write_table(site_df, output_dir / "qc_site_scores", file_format=file_format),
+            io_utils.write_table(exclusion_df, output_dir / "qc_exclusion", file_format=file_format),
+        ]
+        record.update(rows_out=len(site_df) + len(exclusion_df), bytes_out=instrument_utils.file_bytes(output_paths))
+
+    n_sites, n_removed = len(site_df), len(exclusion_df)
+    print(f"{n_removed} of {n_sites} plate, well and site combos removed due to low quality.")
+    return stats, n_sites, n_removed
@@ -0,0 +1,230 @@
+"""
+This file contains functions to encode a (plate, well, site) triple as one compact integer key so that
+QC exclusion, deduplication and split membership become vectorized `isin` lookups instead of merges
+of wide LoadData tables.
+
+A key is `(plate_number * N_WELLS + well_index) * N_SITES + site`, where the plate number is the
+digits following `BR00` in the barcode, so keys are stable across scripts and runs without any
+shared lookup table. When those digits start with a zero (e.g. `BR000012345`) their count is added
+as `n_digits * PLATE_DIGITS_SCALE`, so the barcode decodes back with its leading zeros. Rows missing a plate, well or site get the key -1, which never matches a site.
+"""
+
+
+import re
+
+import numpy as np
+import pandas as pd
+
+
+PLATE_COLUMN = "Metadata_Plate"
+WELL_COLUMN = "Metadata_Well"
+SITE_COLUMN = "Metadata_Site"
+SITE_KEY_COLUMN = "Metadata_SiteKey"
+
+# Room for up to 32 rows x 64 columns of wells and 4096 sites per well
+N_ROWS, N_COLS = 32, 64
+N_WELLS = N_ROWS * N_COLS
+N_SITES = 4096
+
+PLATE_PATTERN = re.compile(r"^BR00(\d+)$")
+WELL_PATTERN = r"^([A-Z]+)(\d+)$"
+
+MISSING_KEY = -1
+
+# Plate numbers have at most 10 digits, the digit count of zero-padded ones is stored above them
+MAX_PLATE_DIGITS = 10
+PLATE_DIGITS_SCALE = 10**MAX_PLATE_DIGITS
+
+
+def _encode_categories(values: pd.Series, encode) -> np.ndarray:
+    """Apply an encoding to the distinct values of a column only, then broadcast it to every row"""
+    codes, uniques = pd.factorize(values)
+    if len(uniques) == 0:
+        return np.full(len(codes), MISSING_KEY, dtype=np.int64)
+    encoded = np.asarray(encode(pd.Series(uniques)), dtype=np.int64)
+    return np.where(codes < 0, MISSING_KEY, encoded[codes])
+
+
+def _plate_numbers(plates: pd.Series) -> np.ndarray:
+    digits = plates.astype(str).str.extract(PLATE_PATTERN, expand=False)
+    if digits.isna().any():
+        raise ValueError(f"Plates must be barcodes like BR00143976, got {plates[digits.isna()].tolist()}")
+    n_digits = digits.str.len()
+    if (n_digits > MAX_PLATE_DIGITS).any():
+        raise ValueError(f"Plate numbers have at most {MAX_PLATE_DIGITS} digits, got {plates[n_digits > MAX_PLATE_DIGITS].tolist()}")
+    # Only zero-padded numbers record their digit count, the keys of other barcodes are the plain number
+    padded = digits.str.startswith("0") & (n_digits > 1)
+    return (digits.astype(np.int64) + np.where(padded, n_digits, 0) * PLATE_DIGITS_SCALE).to_numpy(dtype=np.int64)
+
+
+def _plate_names(plate_numbers: np.ndarray) -> list[str]:
+    widths, numbers = np.divmod(np.asarray(plate_numbers, dtype=np.int64), PLATE_DIGITS_SCALE)
+    return [f"BR00{number:0{width}d}" if width else f"BR00{number}" for width, number in zip(widths, numbers)]
+
+
+def _well_indices(wells: pd.Series) -> np.ndarray:
+    parts = wells.astype(str).str.extract(WELL_PATTERN)
+    if parts.isna().any().any():
+        raise ValueError(f"Wells must look like C03, got {wells[parts.isna().any(axis=1)].tolist()}")
+    # Rows A..Z then AA..AF, as on 1536-well plates
+    rows = parts[0].map(lambda r: sum((ord(c) - ord("A") + 1) * 26**i for i, c in enumerate(reversed(r))) - 1)
+    cols = parts[1].astype(np.int64) - 1
+    if ((rows < 0) | (rows >= N_ROWS) | (cols < 0) | (cols >= N_COLS)).any():
+        raise ValueError("Well row or column out of range")
+    return (rows * N_COLS + cols).to_numpy(dtype=np.int64)
+
+
+def encode_site_keys(plates: pd.Series, wells: pd.Series, sites: pd.Series) -> np.ndarray:
+    """
+    Encode plates, wells and sites as integer site keys
+
+    Parameters
+    ----------
+    plates : pd.Series
+        barcodes like "BR00143976"
+    wells : pd.Series
+        wells like "C03"
+    sites : pd.Series
+        integer site numbers
+
+    Returns
+    -------
+    np.ndarray
+        int64 site keys, -1 where the plate, well or site is missing
+    """
+    sites = pd.Series(sites)
+    missing_sites = sites.isna().to_numpy()
+    sites = sites.fillna(0).to_numpy(dtype=np.int64)
+    if ((sites < 0) | (sites >= N_SITES)).any():
+        raise ValueError(f"Site numbers must be in [0, {N_SITES})")
+    plate_numbers = _encode_categories(pd.Series(plates), _plate_numbers)
+    well_indices = _encode_categories(pd.Series(wells), _well_indices)
+
+    keys = (plate_numbers * N_WELLS + well_indices) * N_SITES + sites
+    missing = missing_sites | (plate_numbers == MISSING_KEY) | (well_indices == MISSING_KEY)
+    return np.where(missing, MISSING_KEY, keys)
+
+
+def site_keys(
+    df: pd.DataFrame,
+    plate_column: str = PLATE_COLUMN,
+    well_column: str = WELL_COLUMN,
+    site_column: str = SITE_COLUMN,
+) -> pd.Series:
+    """
+    Get the site key of every row of a table
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table with a plate, well and site column
+    plate_column : str
+        name of the plate column
+    well_column : str
+        name of the well column
+    site_column : str
+        name of the site column
+
+    Returns
+    -------
+    pd.Series
+        int64 site keys aligned with the rows of `df`
+    """
+    keys = encode_site_keys(df[plate_column], df[well_column], df[site_column])
+    return pd.Series(keys, index=df.index, name=SITE_KEY_COLUMN)
+
+
+def decode_site_keys(keys: np.ndarray | pd.Series) -> pd.DataFrame:
+    """
+    Decode site keys back into plates, wells and sites
+
+    Parameters
+    ----------
+    keys : np.ndarray | pd.Series
+        int64 site keys
+
+    Returns
+    -------
+    pd.DataFrame
+        the `Metadata_Plate`, `Metadata_Well` and `Metadata_Site` of each key
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    sites = keys % N_SITES
+    well_indices = (keys // N_SITES) % N_WELLS
+    plate_numbers = keys // (N_SITES * N_WELLS)
+
+    rows, cols = np.divmod(well_indices, N_COLS)
+
+    def row_name(row: int) -> str:
+        name = ""
+        row += 1
+        while row:
+            row, rem = divmod(row - 1, 26)
+            name = chr(ord("A") + rem) + name
+        return name
+
+    return pd.DataFrame({
+        PLATE_COLUMN: _plate_names(plate_numbers),
+        WELL_COLUMN: [f"{row_name(r)}{c + 1:02d}" for r, c in zip(rows, cols)],
+        SITE_COLUMN: sites,
+    })
+
+
+def key_plates(keys: np.ndarray | pd.Series) -> list[str]:
+    """
+    Get the distinct plates of site keys without decoding every key
+
+    Parameters
+    ----------
+    keys : np.ndarray | pd.Series
+        int64 site keys
+
+    Returns
+    -------
+    list[str]
+        the sorted barcodes of the plates of the keys
+    """
+    plate_numbers = np.unique(np.asarray(keys, dtype=np.int64) // (N_SITES * N_WELLS))
+    return sorted(_plate_names(plate_numbers))
+
+
+def exclude_sites(df: pd.DataFrame, exclude_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Remove the rows of a table whose site is listed in another table (an anti-join on the site key)
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table with a plate, well and site column
+    exclude_df : pd.DataFrame
+        table with the plate, well and site of the sites to remove, e.g. the QC exclusion table
+
+    Returns
+    -------
+    pd.DataFrame
+        the rows of `df` whose site is not in `exclude_df`
+    """
+    if exclude_df.empty:
+        return df
+    exclude_keys = site_keys(exclude_df)
+    return df[~site_keys(df).isin(exclude_keys[exclude_keys != MISSING_KEY])]
+
+
+def drop_duplicate_sites(df: pd.DataFrame, keep: str = "first") -> pd.DataFrame:
+    """
+    Keep one row per site
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table with a plate, well and site column
+    keep : str
+        which duplicate to keep, as in `pd.DataFrame.drop_duplicates`
+
+    Returns
+    -------
+    pd.DataFrame
+        the table without repeated sites, rows missing a plate, well or site are all kept
+    """
+    keys = site_keys(df)
+    return df[~(keys.duplicated(keep=keep) & (keys != MISSING_KEY))]
@@ -0,0 +1,369 @@
+"""
+This file contains functions to synthesize a batch shaped like the real ALSF pilot data at any
+scale: Harmony `Index.idx.xml` trees of original and `2024*_Re-imaged` plates with their (empty)
+image files, the channelid pe2loaddata configs, wide CellProfiler `Image.csv` QC tables like
+`whole_img_qc_output/`, the barcode and platemap csvs, and a pipeline config pointing at all of
+them, so that the pipeline can be benchmarked without the cluster data.
+"""
+
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import yaml
+
+
+HARMONY_NAMESPACE = "http://www.perkinelmer.com/PEHH/HarmonyV5"
+
+# Harmony channel id to channel name and the channel key of the default config
+HARMONY_CHANNELS = {
+    1: ("Brightfield high", "OrigBrightfield"),
+    2: ("Alexa 488", "OrigER"),
+    3: ("Alexa 568", "OrigAGP"),
+    4: ("Alexa 647", "OrigMito"),
+    5: ("HOECHST 33342", "OrigDNA"),
+    6: ("Alexa 488 Long (CP)", "OrigRNA"),
+}
+
+CONFIG_METADATA = [
+    "Row", "Col", "FieldID", "PlaneID", "ChannelID", "PositionX", "PositionY", "PositionZ", "AbsPositionZ"
+]
+
+# Metrics measured per channel by MeasureImageQuality, the QC stage only reads some of them
+IMAGE_QUALITY_METRICS = [
+    "FocusScore",
+    "LocalFocusScore_20",
+    "Correlation_20",
+    "PowerLogLogSlope",
+    "TotalArea",
+    "TotalIntensity",
+    "MeanIntensity",
+    "MedianIntensity",
+    "StdIntensity",
+    "MADIntensity",
+    "MinIntensity",
+    "MaxIntensity",
+    "PercentMaximal",
+    "PercentMinimal",
+    "ThresholdOtsu",
+]
+
+CELL_LINES = ["U2-OS", "A-673", "SK-N-MC", "KNS-42", "SH-SY5Y", "NB-1"]
+SEEDING_DENSITIES = [1_000, 2_000, 4_000, 8_000, 12_000]
+PLATEMAP_FILES = ["Assay_Plate1_platemap", "Assay_Plate2_platemap"]
+FIRST_BARCODE = 143976
+
+
+def well_names(n_wells: int) -> list[str]:
+    """
+    Get the names of the first wells of a 384-well plate, column by column from C03
+
+    Parameters
+    ----------
+    n_wells : int
+        number of wells, at most 12 rows x 20 columns
+
+    Returns
+    -------
+    list[str]
+        well names like "C03"
+    """
+    if n_wells > 240:
+        raise ValueError("At most 240 wells (rows C..N, columns 3..22) are synthesized")
+    return [f"{chr(ord('A') + row - 1)}{col:02d}" for col in range(3, 23) for row in range(3, 15)][:n_wells]
+
+
+def write_index_file(
+    images_dir: pathlib.Path,
+    barcode: str,
+    wells: list[str],
+    n_sites: int,
+    rng: np.random.Generator,
+    touch_images: bool = True,
+) -> pathlib.Path:
+    """
+    Write a Harmony `Index.idx.xml` of one plate, and optionally an empty file per image
+
+    Parameters
+    ----------
+    images_dir : pathlib.Path
+        path to the plate's `Images` folder
+    barcode : str
+        plate name written in the index file
+    wells : list[str]
+        well names like "C03"
+    n_sites : int
+        number of fields per well
+    rng : np.random.Generator
+        generator of the stage positions
+    touch_images : bool
+        create the image files, without them the LoadData tables are empty since missing images are dropped
+
+    Returns
+    -------
+    pathlib.Path
+        path of the index file
+    """
+    images_dir.mkdir(parents=True, exist_ok=True)
+    index_path = images_dir / "Index.idx.xml"
+
+    well_ids = {}
+    for well in wells:
+        row, col = ord(well[0]) - ord("A") + 1, int(well[1:])
+        well_ids[well] = (f"{row:02d}{col:02d}", row, col)
+
+    # The document is written element by element so large plates never build a tree in memory
+    with open(index_path, "w") as f:
+        f.write(f'<?xml version="1.0" encoding="utf-8"?>\n<EvaluationInputData xmlns="{HARMONY_NAMESPACE}" Version="2">\n')
+        f.write(f"<Plates><Plate><PlateID>{barcode}</PlateID><Name>{barcode}</Name>")
+        f.writelines(f'<Well id="{well_id}" />' for well_id, _, _ in well_ids.values())
+        f.write("</Plate></Plates>\n<Wells>\n")
+        for well_id, row, col in well_ids.values():
+            f.write(f"<Well><id>{well_id}</id><Row>{row}</Row><Col>{col}</Col>")
+            f.writelines(
+                f'<Image id="{well_id}K1F{site}P1R{channel}" />'
+                for site in range(1, n_sites + 1)
+                for channel in HARMONY_CHANNELS
+            )
+            f.write("</Well>\n")
+        f.write("</Wells>\n<Maps><Map>")
+        f.writelines(
+            f'<Entry ChannelID="{channel}"><ChannelName>{name}</ChannelName></Entry>'
+            for channel, (name, _) in HARMONY_CHANNELS.items()
+        )
+        f.write("</Map></Maps>\n<Images>\n")
+        for well_id, row, col in well_ids.values():
+            positions = rng.uniform(-1e-3, 1e-3, size=(n_sites, 2))
+            for site in range(1, n_sites + 1):
+                for channel, (name, _) in HARMONY_CHANNELS.items():
+                    url = f"r{row:02d}c{col:02d}f{site:02d}p01-ch{channel}sk1fk1fl1.tiff"
+                    if touch_images:
+                        (images_dir / url).touch()
+                    f.write(
+                        f'<Image Version="1"><id>{well_id}K1F{site}P1R{channel}</id><State>Ok</State>'
+                        f"<URL>{url}</URL><Row>{row}</Row><Col>{col}</Col><FieldID>{site}</FieldID>"
+                        f"<PlaneID>1</PlaneID><TimepointID>1</TimepointID><ChannelID>{channel}</ChannelID>"
+                        f"<ChannelName>{name}</ChannelName>"
+                        f'<PositionX Unit="m">{positions[site - 1, 0]}</PositionX>'
+                        f'<PositionY Unit="m">{positions[site - 1, 1]}</PositionY>'
+                        f'<PositionZ Unit="m">{channel * 1e-6}</PositionZ>'
+                        f'<AbsPositionZ Unit="m">0.1</AbsPositionZ></Image>\n'
+                    )
+        f.write("</Images>\n</EvaluationInputData>\n")
+    return index_path
+
+
+def write_configs(config_dir: pathlib.Path, cell_lines: list[str] = CELL_LINES):
+    """
+    Write the default `config.yml` and one `{cell_line}_config.yml` per cell line, as channelid configs
+
+    Parameters
+    ----------
+    config_dir : pathlib.Path
+        path to the config folder
+    cell_lines : list[str]
+        cell lines that have re-imaged plates
+    """
+    config_dir.mkdir(parents=True, exist_ok=True)
+    # Written by hand to keep `channels:` empty, as in the Harmony v7 configs of `config_files/`
+    lines = ["channels:", "channelid:"]
+    lines += [f"    {channel}: {key}" for channel, (_, key) in HARMONY_CHANNELS.items()]
+    lines += ["metadata:"] + [f"    {key}: {key}" for key in CONFIG_METADATA]
+    for name in ["config"] + [f"{cell_line}_config" for cell_line in cell_lines]:
+        (config_dir / f"{name}.yml").write_text("\n".join(lines) + "\n")
+
+
+def write_platemaps(
+    platemap_dir: pathlib.Path,
+    barcodes: list[str],
+    wells: list[str],
+    rng: np.random.Generator,
+) -> pd.DataFrame:
+    """
+    Write the barcode csv and the platemaps, alternating the platemaps across barcodes
+
+    Parameters
+    ----------
+    platemap_dir : pathlib.Path
+        path to the platemap folder
+    barcodes : list[str]
+        barcodes of the original plates
+    wells : list[str]
+        well names like "C03"
+    rng : np.random.Generator
+        generator of the cell line and seeding density of each well
+
+    Returns
+    -------
+    pd.DataFrame
+        the barcode table
+    """
+    platemap_dir.mkdir(parents=True, exist_ok=True)
+    barcode_df = pd.DataFrame({
+        "barcode": barcodes,
+        "time_point": [24 * (1 + i // len(PLATEMAP_FILES)) for i in range(len(barcodes))],
+        "platemap_file": [PLATEMAP_FILES[i % len(PLATEMAP_FILES)] for i in range(len(barcodes))],
+    })
+    barcode_df.to_csv(platemap_dir / "Barcode_platemap_synthetic_data.csv", index=False)
+
+    for platemap in PLATEMAP_FILES:
+        pd.DataFrame({
+            "cell_line": rng.choice(CELL_LINES, size=len(wells)),
+            "row": [well[0] for well in wells],
+            "column": [int(well[1:]) for well in wells],
+            "well": wells,
+            "seeding_density": rng.choice(SEEDING_DENSITIES, size=len(wells)),
+        }).to_csv(platemap_dir / f"{platemap}.csv", index=False)
+    return barcode_df
+
+
+def write_qc_table(
+    qc_dir: pathlib.Path,
+    barcode: str,
+    wells: list[str],
+    n_sites: int,
+    rng: np.random.Generator,
+    outlier_fraction: float = 0.02,
+) -> pathlib.Path:
+    """
+    Write a wide `Image.csv` with every MeasureImageQuality metric of every channel for one plate
+
+    Parameters
+    ----------
+    qc_dir : pathlib.Path
+        path to the folder with one `{plate}/Image.csv` per plate
+    barcode : str
+        plate name
+    wells : list[str]
+        well names like "C03"
+    n_sites : int
+        number of sites per well
+    rng : np.random.Generator
+        generator of the metric values
+    outlier_fraction : float
+        fraction of sites with blurry or saturated values
+
+    Returns
+    -------
+    pathlib.Path
+        path of the written table
+    """
+    n_rows = len(wells) * n_sites
+    qc_df = pd.DataFrame({
+        "ImageNumber": np.arange(1, n_rows + 1),
+        "Metadata_Plate": barcode,
+        "Metadata_Well": np.repeat(wells, n_sites),
+        "Metadata_Site": np.tile(np.arange(1, n_sites + 1), len(wells)),
+    })
+
+    outliers = rng.random(n_rows) < outlier_fraction
+    metric_columns = {}
+    for _, channel_key in HARMONY_CHANNELS.values():
+        for metric in IMAGE_QUALITY_METRICS:
+            values = rng.normal(size=n_rows)
+            if metric == "PowerLogLogSlope":
+                values = -2.0 + 0.1 * values - 1.0 * outliers
+            elif metric == "PercentMaximal":
+                values = np.abs(0.01 * values) + 5.0 * outliers
+            metric_columns[f"ImageQuality_{metric}_{channel_key}"] = values
+    qc_df = pd.concat([qc_df, pd.DataFrame(metric_columns)], axis=1)
+
+    plate_dir = qc_dir / barcode
+    plate_dir.mkdir(parents=True, exist_ok=True)
+    qc_df.to_csv(plate_dir / "Image.csv", index=False)
+    return plate_dir / "Image.csv"
+
+
+def synthesize_batch(
+    root: pathlib.Path,
+    batch: str = "SYNTHETIC",
+    n_plates: int = 6,
+    n_wells: int = 24,
+    n_sites: int = 4,
+    reimaged_fraction: float = 0.25,
+    touch_images: bool = True,
+    seed: int = 0,
+) -> pathlib.Path:
+    """
+    Synthesize a batch and the pipeline config to process it
+
+    Parameters
+    ----------
+    root : pathlib.Path
+        folder everything is written under
+    batch : str
+        batch name
+    n_plates : int
+        number of original plates
+    n_wells : int
+        number of wells per plate
+    n_sites : int
+        number of sites per well
+    reimaged_fraction : float
+        fraction of the original plates that are re-imaged, re-imaged plates image half of the wells again
+    touch_images : bool
+        create an empty file per image so that the LoadData tables hold every site
+    seed : int
+        seed of every random value
+
+    Returns
+    -------
+    pathlib.Path
+        path to the pipeline config of the batch
+    """
+    root = pathlib.Path(root).absolute()
+    rng = np.random.default_rng(seed)
+    wells = well_names(n_wells)
+    barcodes = [f"BR00{FIRST_BARCODE + i}" for i in range(n_plates)]
+
+    index_dir = root / "index" / batch
+    for barcode in barcodes:
+        write_index_file(index_dir / f"{barcode}__2024-01-01T00_00_00-Measurement 1" / "Images", barcode, wells, n_sites, rng, touch_images)
+        write_qc_table(root / "whole_img_qc_output", barcode, wells, n_sites, rng)
+
+    # Re-imaged plates live under `{date}_{cell line}_Re-imaged/{barcode}__{timestamp}/Images`
+    n_reimaged = int(round(n_plates * reimaged_fraction))
+    for i, barcode in enumerate(rng.choice(barcodes, size=n_reimaged, replace=False)):
+        cell_line = CELL_LINES[i % len(CELL_LINES)]
+        images_dir = index_dir / f"20240301_{cell_line}_Re-imaged" / f"{barcode}__2024-03-01T00_00_00-Measurement 2" / "Images"
+        write_index_file(images_dir, barcode, wells[: max(len(wells) // 2, 1)], n_sites, rng, touch_images)
+
+    write_configs(root / "config_files")
+    write_platemaps(root / "metadata" / "platemaps", barcodes, wells, rng)
+
+    with open(root / "qc_config.yml", "w") as f:
+        yaml.safe_dump(
+            {"scope": "global", "estimator": "mean_std", "metrics": {
+                "ImageQuality_PowerLogLogSlope": 2.5, "ImageQuality_PercentMaximal": 2
+            }},
+            f,
+            sort_keys=False,
+        )
+
+    pipeline_config = {
+        "index_directory": str(root / "index" / "{batch}"),
+        "output_directory": str(root / "output" / "{batch}"),
+        "config_dir": str(root / "config_files"),
+        "qc_dir": str(root / "whole_img_qc_output"),
+        "qc_output_dir": str(root / "output" / "{batch}" / "qc_output"),
+        "qc_config": str(root / "qc_config.yml"),
+        "platemap_dir": str(root / "metadata" / "platemaps"),
+        "n_workers": 8,
+        "loaddata_engine": "native",
+        "output_format": "csv",
+        "qc": {"channel_keys": ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"], "streaming": False},
+        "validate": {"n_workers": 32},
+        "split": {
+            "qc": True,
+            "drop_invalid_images": False,
+            "train_conditions": {"cell_line": CELL_LINES[0], "platemap_file": PLATEMAP_FILES[0]},
+            "seeds": [42],
+            "n_heldout_wells": 1,
+            "n_folds": None,
+        },
+    }
+    config_path = root / "pipeline_config.yml"
+    with open(config_path, "w") as f:
+        yaml.safe_dump(pipeline_config, f, sort_keys=False)
+    return config_path
@@ -0,0 +1,277 @@
+"""
+This file contains functions to pack the images of a split into a tensor store, so that training
+reads zero-copy slices of memory-mapped arrays instead of decoding every 16-bit TIFF each epoch.
+
+A store is a folder of `.npy` shards of shape (site, channel, y, x) in uint16, a `store_index` table
+giving the shard and offset of every site key (in the order of the split manifest), and a
+`store.json` file with the channels, image shape and source split.
+"""
+
+
+import json
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from . import datasplit_utils, io_utils, site_key_utils
+
+
+STORE_DTYPE = np.uint16
+STORE_INDEX_NAME = "store_index"
+STORE_METADATA_NAME = "store.json"
+SHARD_NAME = "shard_{:05d}.npy"
+
+INDEX_COLUMNS = [
+    site_key_utils.SITE_KEY_COLUMN,
+    site_key_utils.PLATE_COLUMN,
+    site_key_utils.WELL_COLUMN,
+    site_key_utils.SITE_COLUMN,
+    "shard",
+    "offset",
+]
+
+
+def read_image(path: str) -> np.ndarray:
+    """
+    Decode a single-channel 16-bit TIFF
+
+    Parameters
+    ----------
+    path : str
+        path to the image
+
+    Returns
+    -------
+    np.ndarray
+        the (y, x) uint16 image
+    """
+    with Image.open(path) as image:
+        return np.asarray(image, dtype=STORE_DTYPE)
+
+
+def _fill_shard(
+    shard: np.ndarray,
+    paths: np.ndarray,
+    executor: ThreadPoolExecutor,
+):
+    # Every (site, channel) image is written to its own slice, so the threads never overlap
+    def fill(i: int):
+        site, channel = divmod(i, paths.shape[1])
+        image = read_image(paths[site, channel])
+        if image.shape != shard.shape[2:]:
+            raise ValueError(
+                f"{paths[site, channel]} has shape {image.shape}, expected {shard.shape[2:]}"
+            )
+        shard[site, channel] = image
+
+    list(executor.map(fill, range(paths.size)))
+
+
+def build_tensor_store(
+    loaddata_df: pd.DataFrame,
+    store_dir: pathlib.Path,
+    channels: list[str],
+    sites_per_shard: int = 64,
+    n_workers: int = 8,
+    file_format: str = "csv",
+    metadata: dict | None = None,
+) -> pd.DataFrame:
+    """
+    Pack the images of LoadData rows into memory-mapped `.npy` shards
+
+    Parameters
+    ----------
+    loaddata_df : pd.DataFrame
+        LoadData rows to pack, in the order they are stored, with `PathName_{channel}` and
+        `FileName_{channel}` columns for every channel
+    store_dir : pathlib.Path
+        folder of the store, existing shards are overwritten
+    channels : list[str]
+        channels to pack, in the order of the channel axis
+    sites_per_shard : int
+        number of sites per shard
+    n_workers : int
+        number of images decoded at the same time
+    file_format : str
+        "csv" or "parquet" for the store index
+    metadata : dict | None
+        extra entries for `store.json`, e.g. the split the sites come from
+
+    Returns
+    -------
+    pd.DataFrame
+        the store index, one row per site with its site key, plate, well, site, shard and offset
+    """
+    missing = [c for c in channels if f"FileName_{c}" not in loaddata_df.columns]
+    if missing:
+        raise ValueError(f"Channels not found in the LoadData table: {missing}")
+    if loaddata_df.empty:
+        raise ValueError("No sites to pack")
+
+    paths = np.stack([
+        (loaddata_df[f"PathName_{c}"].astype(str).str.rstrip("/") + "/" + loaddata_df[f"FileName_{c}"].astype(str)).to_numpy()
+        for c in channels
+    ], axis=1)
+    image_shape = read_image(paths[0, 0]).shape
+
+    store_dir.mkdir(parents=True, exist_ok=True)
+    for stale_shard in store_dir.glob(SHARD_NAME.replace("{:05d}", "*")):
+        stale_shard.unlink()
+
+    n_sites = paths.shape[0]
+    n_shards = -(-n_sites // sites_per_shard)
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for shard_number in range(n_shards):
+            start = shard_number * sites_per_shard
+            shard_paths = paths[start:start + sites_per_shard]
+            shard = np.lib.format.open_memmap(
+                store_dir / SHARD_NAME.format(shard_number),
+                mode="w+",
+                dtype=STORE_DTYPE,
+                shape=(shard_paths.shape[0], len(channels), *image_shape),
+            )
+            _fill_shard(shard, shard_paths, executor)
+            shard.flush()
+            del shard
+
+    site_columns = [site_key_utils.PLATE_COLUMN, site_key_utils.WELL_COLUMN, site_key_utils.SITE_COLUMN]
+    index_df = loaddata_df[site_columns].reset_index(drop=True)
+    index_df.insert(0, site_key_utils.SITE_KEY_COLUMN, site_key_utils.site_keys(index_df).to_numpy())
+    index_df["shard"] = np.arange(n_sites) // sites_per_shard
+    index_df["offset"] = np.arange(n_sites) % sites_per_shard
+    io_utils.write_table(index_df[INDEX_COLUMNS], store_dir / STORE_INDEX_NAME, file_format=file_format)
+
+    with open(store_dir / STORE_METADATA_NAME, "w") as f:
+        json.dump({
+            **(metadata or {}),
+            "channels": list(channels),
+            "image_shape": list(image_shape),
+            "dtype": np.dtype(STORE_DTYPE).name,
+            "n_sites": n_sites,
+            "sites_per_shard": sites_per_shard,
+            "n_shards": n_shards,
+        }, f, indent=4)
+    return index_df[INDEX_COLUMNS]
+
+
+def build_split_store(
+    manifest_path: pathlib.Path,
+    loaddata_dir: pathlib.Path,
+    store_dir: pathlib.Path,
+    channels: list[str] | None = None,
+    label: str = datasplit_utils.TRAIN_LABEL,
+    split_column: str | None = None,
+    sites_per_shard: int = 64,
+    n_workers: int = 8,
+    file_format: str = "csv",
+) -> pd.DataFrame:
+    """
+    Pack one split of a split manifest, with the sites in the order of the manifest
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        path to the split manifest, with or without a file extension
+    loaddata_dir : pathlib.Path
+        folder with the pooled LoadData tables
+    store_dir : pathlib.Path
+        folder of the store
+    channels : list[str] | None
+        channels to pack, in the order of the channel axis, None packs every channel of the LoadData
+    label : str
+        "train", "heldout" or "eval"
+    split_column : str | None
+        label column of the manifest, None uses the first one
+    sites_per_shard : int
+        number of sites per shard
+    n_workers : int
+        number of images decoded at the same time
+    file_format : str
+        "csv" or "parquet" for the store index
+
+    Returns
+    -------
+    pd.DataFrame
+        the store index
+    """
+    if split_column is None:
+        split_column = datasplit_utils.split_columns(manifest_path)[0]
+    if channels is None:
+        loaddata_columns = io_utils.read_columns(io_utils.list_tables(loaddata_dir)[0])
+        channels = [c[len("FileName_"):] for c in loaddata_columns if c.startswith("FileName_")]
+    columns = [f"{prefix}{c}" for c in channels for prefix in ("PathName_", "FileName_")]
+    split_df = datasplit_utils.read_split(
+        manifest_path, loaddata_dir, label=label, split_column=split_column, columns=columns
+    )
+
+    # Same site order as the manifest, so the store index lines up with the manifest rows of the split
+    manifest_df = io_utils.read_table(manifest_path, columns=[site_key_utils.SITE_KEY_COLUMN, split_column])
+    keys = manifest_df.loc[manifest_df[split_column] == label, site_key_utils.SITE_KEY_COLUMN]
+    split_df = split_df.set_index(site_key_utils.site_keys(split_df).to_numpy())
+    split_df = split_df.loc[keys[keys.isin(split_df.index)].to_numpy()].reset_index(drop=True)
+
+    return build_tensor_store(
+        split_df,
+        store_dir,
+        channels,
+        sites_per_shard=sites_per_shard,
+        n_workers=n_workers,
+        file_format=file_format,
+        metadata={"split_column": split_column, "label": label},
+    )
+
+
+def open_tensor_store(store_dir: pathlib.Path) -> tuple[pd.DataFrame, list[np.ndarray], dict]:
+    """
+    Open a tensor store without reading its images
+
+    Parameters
+    ----------
+    store_dir : pathlib.Path
+        folder of the store
+
+    Returns
+    -------
+    tuple[pd.DataFrame, list[np.ndarray], dict]
+        the store index, the read-only memory-mapped shards and the `store.json` metadata
+    """
+    with open(store_dir / STORE_METADATA_NAME, "r") as f:
+        metadata = json.load(f)
+    index_df = io_utils.read_table(io_utils.find_table(store_dir / STORE_INDEX_NAME))
+    shards = [
+        np.load(store_dir / SHARD_NAME.format(shard_number), mmap_mode="r")
+        for shard_number in range(metadata["n_shards"])
+    ]
+    return index_df, shards, metadata
+
+
+def read_site(
+    index_df: pd.DataFrame,
+    shards: list[np.ndarray],
+    i: int,
+    channels: list[int] | slice = slice(None),
+) -> np.ndarray:
+    """
+    Get the (channel, y, x) images of one site of a store
+
+    Parameters
+    ----------
+    index_df : pd.DataFrame
+        store index from `open_tensor_store`
+    shards : list[np.ndarray]
+        memory-mapped shards from `open_tensor_store`
+    i : int
+        row of the store index
+    channels : list[int] | slice
+        positions of the channels to get, a slice keeps the result a view of the shard
+
+    Returns
+    -------
+    np.ndarray
+        uint16 array of shape (channel, y, x), read from disk only when accessed
+    """
+    row = index_df.iloc[i]
+    return shards[int(row["shard"])][int(row["offset"]), channels]
@@ -0,0 +1,369 @@
+"""
+This file contains functions to build a thumbnail cache for visual review of the QC decisions: the
+sites excluded by QC and a random sample of passing sites are downsampled per channel into a small
+pyramid, stored per plate keyed by site key, and laid out as one montage image per plate.
+
+Thumbnails already in a plate's cache are reused while their site's images are the same files, so adding
+sites to review only decodes their images, and a site pointed at new files (e.g. by a re-imaged plate) is
+decoded again. Montages hold at most `MAX_MONTAGE_SITES` sites, larger plates get one montage per page.
+"""
+
+
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+
+from . import site_key_utils, tensor_store_utils
+
+
+EXCLUDED_STATUS = "excluded"
+PASSING_STATUS = "passing"
+
+# Border color of the montage tiles of each status
+STATUS_COLORS = {EXCLUDED_STATUS: (220, 40, 40), PASSING_STATUS: (40, 180, 70)}
+
+# Sites (montage rows) per montage image, so plates with many exclusions give several readable pages
+MAX_MONTAGE_SITES = 64
+
+THUMBNAIL_INDEX_COLUMNS = [
+    site_key_utils.SITE_KEY_COLUMN,
+    site_key_utils.PLATE_COLUMN,
+    site_key_utils.WELL_COLUMN,
+    site_key_utils.SITE_COLUMN,
+    "qc_status",
+]
+
+
+def select_review_sites(
+    loaddata_df: pd.DataFrame,
+    exclusion_df: pd.DataFrame,
+    n_passing: int = 8,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Select the sites to review: every excluded site and a random sample of passing sites per plate
+
+    Parameters
+    ----------
+    loaddata_df : pd.DataFrame
+        LoadData table with the plate, well and site columns
+    exclusion_df : pd.DataFrame
+        plate, well and site of the sites excluded by QC
+    n_passing : int
+        number of passing sites drawn per plate
+    seed : int
+        seed of the sampling
+
+    Returns
+    -------
+    pd.DataFrame
+        the LoadData rows of the selected sites with a `qc_status` column, excluded sites first
+    """
+    excluded = site_key_utils.site_keys(loaddata_df).isin(site_key_utils.site_keys(exclusion_df)).to_numpy()
+
+    # Rank the passing sites of each plate by a random draw and keep the first ones
+    draws = pd.Series(np.random.default_rng(seed).random(len(loaddata_df)), index=loaddata_df.index)
+    plates = loaddata_df.loc[~excluded, site_key_utils.PLATE_COLUMN]
+    ranks = draws[~excluded].groupby(plates, observed=True).rank(method="first")
+    passing = loaddata_df.index.isin(ranks.index[ranks <= n_passing])
+
+    return pd.concat([
+        loaddata_df[excluded].assign(qc_status=EXCLUDED_STATUS),
+        loaddata_df[passing].assign(qc_status=PASSING_STATUS),
+    ], ignore_index=True)
+
+
+def downsample(image: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Downsample an image by averaging blocks of `factor` x `factor` pixels
+
+    Parameters
+    ----------
+    image : np.ndarray
+        (y, x) image, rows and columns beyond a multiple of `factor` are dropped
+    factor : int
+        block size
+
+    Returns
+    -------
+    np.ndarray
+        the downsampled image, with the dtype of `image`
+    """
+    if factor <= 1:
+        return image
+    h, w = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:h * factor, :w * factor].reshape(h, factor, w, factor)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+
+def image_pyramid(image: np.ndarray, size: int = 128, n_levels: int = 3) -> list[np.ndarray]:
+    """
+    Build a pyramid of thumbnails of an image, each level half the size of the previous one
+
+    Parameters
+    ----------
+    image : np.ndarray
+        (y, x) image
+    size : int
+        largest side of the first level, in pixels
+    n_levels : int
+        number of levels
+
+    Returns
+    -------
+    list[np.ndarray]
+        the levels, from the largest to the smallest
+    """
+    levels = [downsample(image, max(1, -(-max(image.shape) // size)))]
+    for _ in range(n_levels - 1):
+        levels.append(downsample(levels[-1], 2))
+    return levels
+
+
+def _plate_cache_path(cache_dir: pathlib.Path, plate: str) -> pathlib.Path:
+    return cache_dir / f"{plate}_thumbnails.npz"
+
+
+def build_plate_thumbnails(
+    sites_df: pd.DataFrame,
+    cache_dir: pathlib.Path,
+    channels: list[str],
+    size: int = 128,
+    n_levels: int = 3,
+    executor: ThreadPoolExecutor | None = None,
+) -> pathlib.Path:
+    """
+    Add the thumbnails of the sites of one plate to the plate's cache
+
+    The cache is an `.npz` file with the `site_keys`, the `sources` (the image paths of each site
+    joined by "|"), the `channels`, `size` and one `level_{k}` array of shape (site, channel, y, x) per
+    pyramid level. A cached site whose images are other files than in `sites_df` is decoded again.
+
+    Parameters
+    ----------
+    sites_df : pd.DataFrame
+        LoadData rows of one plate, with `PathName_{channel}` and `FileName_{channel}` columns
+    cache_dir : pathlib.Path
+        folder of the per-plate caches
+    channels : list[str]
+        channels of the thumbnails
+    size : int
+        largest side of the first level, in pixels
+    n_levels : int
+        number of pyramid levels
+    executor : ThreadPoolExecutor | None
+        pool decoding the images, None decodes them one after another
+
+    Returns
+    -------
+    pathlib.Path
+        path to the plate's cache
+    """
+    plate = str(sites_df[site_key_utils.PLATE_COLUMN].iloc[0])
+    cache_path = _plate_cache_path(cache_dir, plate)
+    keys = site_key_utils.site_keys(sites_df).to_numpy()
+    # Image paths of every site, one per channel, and their joined form recorded as the site's source
+    channel_paths = [
+        [str(path).rstrip("/") + "/" + str(name) for path, name in zip(sites_df[f"PathName_{c}"], sites_df[f"FileName_{c}"])]
+        for c in channels
+    ]
+    site_paths = [list(paths) for paths in zip(*channel_paths)]
+    sources = ["|".join(paths) for paths in site_paths]
+
+    cached, cached_sources = {}, {}
+    if cache_path.exists():
+        with np.load(cache_path) as cache:
+            # Thumbnails of other channels, sizes or pyramid depths, or without their sources, can't be reused
+            n_cached_levels = sum(name.startswith("level_") for name in cache.files)
+            if (
+                "sources" in cache.files
+                and list(cache["channels"]) == list(channels)
+                and int(cache["size"]) == size
+                and n_cached_levels == n_levels
+            ):
+                levels = [cache[f"level_{level}"] for level in range(n_levels)]
+                cached = {k: [level[i] for level in levels] for i, k in enumerate(cache["site_keys"])}
+                cached_sources = dict(zip(cache["site_keys"], cache["sources"]))
+
+    new_rows = [i for i, key in enumerate(keys) if key not in cached or cached_sources[key] != sources[i]]
+    paths = [path for i in new_rows for path in site_paths[i]]
+    pyramids = list((executor.map if executor else map)(
+        lambda path: image_pyramid(tensor_store_utils.read_image(path), size, n_levels), paths
+    ))
+    for j, i in enumerate(new_rows):
+        site_pyramids = pyramids[j * len(channels):(j + 1) * len(channels)]
+        cached[keys[i]] = [np.stack([p[level] for p in site_pyramids]) for level in range(n_levels)]
+        cached_sources[keys[i]] = sources[i]
+
+    all_keys = np.array(sorted(cached), dtype=np.int64)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        cache_path,
+        site_keys=all_keys,
+        sources=np.array([cached_sources[k] for k in all_keys]),
+        channels=np.array(channels),
+        size=np.array(size),
+        **{f"level_{level}": np.stack([cached[k][level] for k in all_keys]) for level in range(n_levels)},
+    )
+    print(f"{plate}: {len(new_rows)} new thumbnails, {len(keys) - len(new_rows)} cached")
+    return cache_path
+
+
+def read_thumbnails(
+    cache_dir: pathlib.Path,
+    plate: str,
+    site_keys: np.ndarray | None = None,
+    level: int = 0,
+) -> tuple[np.ndarray, np.ndarray, list[str]]:
+    """
+    Read the thumbnails of one plate from its cache
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        folder of the per-plate caches
+    plate : str
+        barcode of the plate
+    site_keys : np.ndarray | None
+        keys of the sites to read in this order, None reads every cached site
+    level : int
+        pyramid level
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, list[str]]
+        the (site, channel, y, x) thumbnails, their site keys and the channels
+    """
+    with np.load(_plate_cache_path(cache_dir, plate)) as cache:
+        keys, thumbnails = cache["site_keys"], cache[f"level_{level}"]
+        channels = list(cache["channels"])
+    if site_keys is not None:
+        positions = pd.Index(keys).get_indexer(np.asarray(site_keys, dtype=np.int64))
+        if (positions < 0).any():
+            raise KeyError(f"Sites not in the thumbnail cache of {plate}")
+        keys, thumbnails = keys[positions], thumbnails[positions]
+    return thumbnails, keys, channels
+
+
+def write_montage(
+    thumbnails: np.ndarray,
+    labels: list[str],
+    statuses: list[str],
+    output_path: pathlib.Path,
+    percentiles: tuple[float, float] = (0.5, 99.5),
+    border: int = 2,
+) -> pathlib.Path:
+    """
+    Lay out thumbnails as a grid of one row per site and one column per channel, each channel
+    contrast stretched between percentiles of its thumbnails and each site framed by its QC status
+
+    Parameters
+    ----------
+    thumbnails : np.ndarray
+        (site, channel, y, x) thumbnails
+    labels : list[str]
+        label drawn on the first tile of each site, e.g. its well and site
+    statuses : list[str]
+        QC status of each site, see `STATUS_COLORS`
+    output_path : pathlib.Path
+        path to the montage image, the format follows the extension (e.g. `.png`)
+    percentiles : tuple[float, float]
+        intensity percentiles mapped to black and white
+    border : int
+        width of the status frame, in pixels
+
+    Returns
+    -------
+    pathlib.Path
+        path of the written montage
+    """
+    n_sites, n_channels, h, w = thumbnails.shape
+    low = np.percentile(thumbnails, percentiles[0], axis=(0, 2, 3)).reshape(1, -1, 1, 1)
+    high = np.percentile(thumbnails, percentiles[1], axis=(0, 2, 3)).reshape(1, -1, 1, 1)
+    scaled = np.clip((thumbnails - low) / np.maximum(high - low, 1), 0, 1)
+    scaled = (scaled * 255).astype(np.uint8)
+
+    tile_h, tile_w = h + 2 * border, w + 2 * border
+    montage = np.zeros((n_sites * tile_h, n_channels * tile_w, 3), dtype=np.uint8)
+    for i, status in enumerate(statuses):
+        montage[i * tile_h:(i + 1) * tile_h] = STATUS_COLORS[status]
+        for c in range(n_channels):
+            y, x = i * tile_h + border, c * tile_w + border
+            montage[y:y + h, x:x + w] = scaled[i, c, :, :, None]
+
+    image = Image.fromarray(montage)
+    draw = ImageDraw.Draw(image)
+    for i, label in enumerate(labels):
+        draw.text((border + 2, i * tile_h + border + 1), label, fill=(255, 255, 0))
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    image.save(output_path)
+    return output_path
+
+
+def build_review_thumbnails(
+    review_df: pd.DataFrame,
+    output_dir: pathlib.Path,
+    channels: list[str],
+    size: int = 128,
+    n_levels: int = 3,
+    n_workers: int = 8,
+    max_montage_sites: int = MAX_MONTAGE_SITES,
+) -> pd.DataFrame:
+    """
+    Build the thumbnail caches and montages of the review sites of every plate
+
+    Parameters
+    ----------
+    review_df : pd.DataFrame
+        LoadData rows of the sites to review with their `qc_status`, from `select_review_sites`
+    output_dir : pathlib.Path
+        folder of the per-plate caches and montages, `{plate}_montage.png` for the first page of a plate
+        and `{plate}_montage_{page}.png` for the next ones
+    channels : list[str]
+        channels of the thumbnails, one montage column each
+    size : int
+        largest side of the first level, in pixels
+    n_levels : int
+        number of pyramid levels
+    n_workers : int
+        number of images decoded at the same time
+    max_montage_sites : int
+        sites per montage page
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per reviewed site with its site key, plate, well, site, QC status and montage file name,
+        in montage order
+    """
+    index_df = review_df[THUMBNAIL_INDEX_COLUMNS[1:]].reset_index(drop=True)
+    index_df.insert(0, site_key_utils.SITE_KEY_COLUMN, site_key_utils.site_keys(index_df).to_numpy())
+    montages = np.empty(len(index_df), dtype=object)
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for plate, plate_df in review_df.groupby(site_key_utils.PLATE_COLUMN, observed=True, sort=True):
+            build_plate_thumbnails(plate_df, output_dir, channels, size=size, n_levels=n_levels, executor=executor)
+
+            # Pages of a previous run with more sites would otherwise be left behind
+            for stale_path in output_dir.glob(f"{plate}_montage_*.png"):
+                stale_path.unlink()
+
+            plate_rows = np.flatnonzero((index_df[site_key_utils.PLATE_COLUMN] == plate).to_numpy())
+            for page, start in enumerate(range(0, len(plate_rows), max_montage_sites)):
+                page_index_df = index_df.iloc[plate_rows[start:start + max_montage_sites]]
+                montage_name = f"{plate}_montage.png" if page == 0 else f"{plate}_montage_{page + 1}.png"
+                thumbnails, _, _ = read_thumbnails(output_dir, plate, page_index_df[site_key_utils.SITE_KEY_COLUMN])
+                write_montage(
+                    thumbnails,
+                    labels=[
+                        f"{well} s{site}" for well, site in
+                        zip(page_index_df[site_key_utils.WELL_COLUMN], page_index_df[site_key_utils.SITE_COLUMN])
+                    ],
+                    statuses=page_index_df["qc_status"].tolist(),
+                    output_path=output_dir / montage_name,
+                )
+                montages[plate_rows[start:start + max_montage_sites]] = montage_name
+    return index_df.assign(montage=montages)